@@ -0,0 +1,368 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+asyncio check engine.
+
+All the GitHub reads needed by a cycle are fanned out concurrently from one
+event loop over a pooled keep-alive HTTP session. The unchanged
+MergeQueue.check logic then runs against the prefetched snapshot, anything it
+did not anticipate (writes, deep chains...) goes through the same loop.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Thread
+from types import SimpleNamespace
+from typing import Any, Dict, Hashable, List, Mapping, Optional, Set, Tuple
+import asyncio
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from mergequeue import MergeQueue, MergeQueueException
+from pr import PR, PRTransitionParams
+from tracing import current, span, tracer
+
+log = logging.getLogger(__name__)
+
+GITHUB_API = 'https://api.github.com'
+DEFAULT_CONCURRENCY = 32
+DEFAULT_POOL_SIZE = 64
+DEFAULT_CHECK_THREADS = 8
+KEEPALIVE_TIMEOUT = 60
+REQUEST_TIMEOUT = 30
+PER_PAGE = 100
+
+CheckResult = List[Tuple[PR, List[PRTransitionParams]]]
+
+
+class AsyncGithubError(Exception):
+    def __init__(self, status: int, data: Any):
+        super().__init__(f'GitHub answered {status}: {data}')
+        self.status = status
+        self.data = data
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ') if value else None
+
+
+def gh_user(data: Optional[Mapping]):
+    return SimpleNamespace(login=data['login'] if data else None)
+
+
+class AsyncGithubClient:
+    """
+    Minimal GitHub REST client sharing one pooled keep-alive session.
+    """
+
+    def __init__(self,
+                 token: str,
+                 base_url: str = GITHUB_API,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 pool_size: int = DEFAULT_POOL_SIZE):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.session = None
+        self.semaphore = None
+        self.request_count = 0
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                                             headers={'Authorization': f'token {self.token}',
+                                                      'Accept': 'application/vnd.github.v3+json'})
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, verb: str, path: str, params: Mapping = None,
+                      json: Any = None) -> Tuple[int, Any, Mapping]:
+        """
+        :return: status, decoded body and the parsed Link header.
+        """
+        url = path if path.startswith('http') else self.base_url + path
+        async with self.semaphore:
+            self.request_count += 1
+            async with self.session.request(verb, url, params=params, json=json) as response:
+                data = await response.json(content_type=None) if response.status != 204 else None
+                if response.status >= 400:
+                    raise AsyncGithubError(response.status, data)
+                return response.status, data, response.links
+
+    async def get(self, path: str, params: Mapping = None) -> Any:
+        _, data, _ = await self.request('GET', path, params=params)
+        return data
+
+    async def get_all(self, path: str, params: Mapping = None) -> List:
+        """
+        GET every page of a list endpoint.
+        """
+        items = []
+        params = dict(params or {}, per_page=PER_PAGE)
+        while path:
+            _, data, links = await self.request('GET', path, params=params)
+            items.extend(data)
+            next_page = links.get('next')
+            path = str(next_page['url']) if next_page else None
+            params = None  # already part of the next url
+        return items
+
+
+class SnapshotPull:
+    """
+    PyGithub-like pull request built from a REST payload.
+    """
+
+    def __init__(self, repo: 'SnapshotRepo', data: Mapping, reviews: List[Mapping] = None):
+        self._repo = repo
+        self._reviews = reviews
+        self._use_attributes(data)
+
+    def _use_attributes(self, data: Mapping):
+        self.raw_data = data
+        self.number = data['number']
+        self.node_id = data.get('node_id')
+        self.html_url = data['html_url']
+        self.user = gh_user(data.get('user'))
+        self.state = data['state']
+        self.merged = data.get('merged', False)
+        self.mergeable = data.get('mergeable')
+        self.mergeable_state = data.get('mergeable_state', 'unknown')
+        self.title = data['title']
+        self.body = data.get('body')
+        self.head = SimpleNamespace(ref=data['head']['ref'], sha=data['head']['sha'])
+        self.base = SimpleNamespace(ref=data['base']['ref'], sha=data['base']['sha'])
+        self.labels = [SimpleNamespace(name=label['name']) for label in data.get('labels', ())]
+        self.updated_at = parse_date(data.get('updated_at'))
+
+    def get_reviews(self):
+        if self._reviews is None:
+            self._reviews = self._repo.call(self._repo.client.get_all(f'{self._repo.path}/pulls/{self.number}/reviews'))
+        return [SimpleNamespace(user=gh_user(review.get('user')), state=review['state']) for review in self._reviews]
+
+    def merge(self, commit_message=None, commit_title=None, sha=None, merge_method=None):
+        self._repo.invalidate(self.number)
+        parameters = {'commit_message': commit_message, 'commit_title': commit_title, 'sha': sha,
+                      'merge_method': merge_method}
+        _, data, _ = self._repo.call(self._repo.client.request(
+            'PUT', f'{self._repo.path}/pulls/{self.number}/merge',
+            json={key: value for key, value in parameters.items() if value is not None}))
+        return SimpleNamespace(merged=data.get('merged'), sha=data.get('sha'), message=data.get('message'))
+
+    def edit(self, title=None, body=None, state=None, base=None):
+        self._repo.pulls_by_base.clear()
+        parameters = {'title': title, 'body': body, 'state': state, 'base': base}
+        _, data, _ = self._repo.call(self._repo.client.request(
+            'PATCH', f'{self._repo.path}/pulls/{self.number}',
+            json={key: value for key, value in parameters.items() if value is not None}))
+        self._use_attributes(data)
+
+
+class SnapshotRepo:
+    """
+    PyGithub-like repository answering from the data prefetched for one cycle.
+
+    Its sync methods are called from a check thread; whatever was not
+    prefetched is fetched through the engine loop.
+    """
+
+    def __init__(self, engine: 'AsyncCheckEngine', full_name: str):
+        self.engine = engine
+        self.client = engine.client
+        self.full_name = full_name
+        self.path = f'/repos/{full_name}'
+        self.pulls: Dict[int, SnapshotPull] = {}
+        self.pulls_by_base: Dict[str, List[int]] = {}
+        self.branches: Dict[str, Mapping] = {}
+        self.statuses: Dict[str, List[Mapping]] = {}
+
+    def call(self, coroutine):
+        return self.engine.call(coroutine)
+
+    def invalidate(self, pr_nb: int):
+        """
+        Forget a PR written to, another room sharing the snapshot will fetch it again.
+        """
+        self.pulls.pop(pr_nb, None)
+        self.pulls_by_base.clear()
+
+    async def fetch_pull(self, pr_nb: int) -> SnapshotPull:
+        data, reviews = await asyncio.gather(self.client.get(f'{self.path}/pulls/{pr_nb}'),
+                                             self.client.get_all(f'{self.path}/pulls/{pr_nb}/reviews'))
+        pull = SnapshotPull(self, data, reviews)
+        self.pulls[pr_nb] = pull
+        return pull
+
+    async def fetch_dependents(self, head: str) -> List[int]:
+        listed = await self.client.get_all(f'{self.path}/pulls', {'base': head, 'state': 'open'})
+        dependents = [data['number'] for data in listed]
+        self.pulls_by_base[head] = dependents
+        return dependents
+
+    async def fetch_statuses(self, pull: SnapshotPull):
+        branch, statuses = await asyncio.gather(
+            self.client.get(f'{self.path}/branches/{pull.base.ref}'),
+            self.client.get_all(f'{self.path}/commits/{pull.head.ref}/statuses'))
+        self.branches[pull.base.ref] = branch
+        self.statuses[pull.head.ref] = statuses
+
+    async def prefetch_pr(self, pr_nb: int, seen: Set[int]):
+        seen.add(pr_nb)
+        pull = await self.fetch_pull(pr_nb)
+        fetches = [self.fetch_dependents(pull.head.ref)]
+        if pull.mergeable_state == 'unstable':
+            fetches.append(self.fetch_statuses(pull))
+        dependents, *_ = await asyncio.gather(*fetches)
+        await asyncio.gather(*(self.prefetch_pr(nb, seen) for nb in dependents if nb not in seen))
+
+    async def prefetch(self, pr_nbs: List[int]):
+        """
+        Fetch the PRs of a queue with their reviews and their chained PRs.
+        """
+        seen = set()
+        results = await asyncio.gather(*(self.prefetch_pr(nb, seen) for nb in pr_nbs), return_exceptions=True)
+        for pr_nb, result in zip(pr_nbs, results):
+            if isinstance(result, Exception):
+                log.warning('Could not prefetch PR %s of %s: %s', pr_nb, self.full_name, result)
+
+    # PyGithub Repository interface used by MergeQueue.
+
+    # The check threads of other rooms may invalidate the cache at any time:
+    # use what was just fetched rather than reading the dicts again.
+
+    def get_pull(self, pr_nb: int) -> SnapshotPull:
+        pull = self.pulls.get(pr_nb)
+        if pull is None:
+            pull = self.call(self.fetch_pull(pr_nb))
+        return pull
+
+    def get_pulls(self, base: str = None) -> List[SnapshotPull]:
+        dependents = self.pulls_by_base.get(base)
+        if dependents is None:
+            dependents = self.call(self.fetch_dependents(base))
+        return [self.get_pull(pr_nb) for pr_nb in dependents]
+
+    def get_branch(self, branch: str):
+        if branch not in self.branches:
+            self.branches[branch] = self.call(self.client.get(f'{self.path}/branches/{branch}'))
+        checks = (self.branches[branch].get('protection') or {}).get('required_status_checks') or {}
+        return SimpleNamespace(name=branch, contexts=checks.get('contexts', []))
+
+    def get_commit(self, sha: str):
+        if sha not in self.statuses:
+            self.statuses[sha] = self.call(self.client.get_all(f'{self.path}/commits/{sha}/statuses'))
+        statuses = [SimpleNamespace(context=status['context'], state=status['state'])
+                    for status in self.statuses[sha]]
+        return SimpleNamespace(sha=sha, get_statuses=lambda: statuses)
+
+    def get_git_ref(self, ref: str):
+        path = f'{self.path}/git/refs/{ref}'
+        return SimpleNamespace(ref=f'refs/{ref}', delete=lambda: self.call(self.client.request('DELETE', path)))
+
+    def merge(self, base: str, head: str, commit_message: str = None):
+        parameters = {'base': base, 'head': head}
+        if commit_message is not None:
+            parameters['commit_message'] = commit_message
+        status, data, _ = self.call(self.client.request('POST', f'{self.path}/merges', json=parameters))
+        return data if status == 201 else None  # 204: nothing to merge
+
+
+class AsyncCheckEngine:
+    """
+    Checks the queues of many rooms from a single event-loop thread.
+    """
+
+    def __init__(self,
+                 token: str,
+                 base_url: str = GITHUB_API,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 check_threads: int = DEFAULT_CHECK_THREADS):
+        if aiohttp is None:
+            raise MergeQueueException('The asyncio check engine requires aiohttp.')
+        self.client = AsyncGithubClient(token, base_url=base_url, concurrency=concurrency, pool_size=pool_size)
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='merge-async-engine', daemon=True)
+        self.executor = ThreadPoolExecutor(check_threads, thread_name_prefix='merge-check')
+
+    def start(self):
+        self.thread.start()
+        self.call(self.client.open())
+
+    def stop(self):
+        self.call(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown()
+
+    def call(self, coroutine):
+        """
+        Run a coroutine on the engine loop and wait for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def check_all(self, queues: Mapping[Hashable, MergeQueue],
+                  budgets: Mapping[Hashable, int] = None) -> Dict[Hashable, CheckResult]:
+        """
+        Equivalent of calling check() on every queue.
+        :param budgets: maximum number of PRs to refresh per queue.
+        :return: the transitions for every queue, queues that failed are left out.
+        """
+        return self.call(self._check_all(queues, budgets or {}, current()))
+
+    async def _check_all(self, queues: Mapping[Hashable, MergeQueue], budgets: Mapping[Hashable, int],
+                         parent=None) -> Dict[Hashable, CheckResult]:
+        # Rooms queuing the same repository share its snapshot, each PR is fetched once.
+        by_repo: Dict[str, SnapshotRepo] = {}
+        wanted: Dict[str, List[int]] = {}
+        snapshots = {}
+        for key, merge_queue in queues.items():
+            full_name = merge_queue.gh_repo.full_name
+            if full_name not in by_repo:
+                by_repo[full_name] = SnapshotRepo(self, full_name)
+                wanted[full_name] = []
+            snapshots[key] = by_repo[full_name]
+            wanted[full_name].extend(pr.nb for _, pr in merge_queue.to_refresh(budgets.get(key))
+                                     if pr.nb not in wanted[full_name])
+        await asyncio.gather(*(by_repo[full_name].prefetch(pr_nbs) for full_name, pr_nbs in wanted.items()))
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(loop.run_in_executor(self.executor, self.run_check, merge_queue,
+                                                              snapshots[key], budgets.get(key), parent)
+                                         for key, merge_queue in queues.items()), return_exceptions=True)
+        checked = {}
+        for key, result in zip(queues, results):
+            if isinstance(result, Exception):
+                log.error('Check failed for %s: %s', key, result)
+                continue
+            checked[key] = result
+        return checked
+
+    @staticmethod
+    def run_check(merge_queue: MergeQueue, snapshot: SnapshotRepo, max_prs: int = None,
+                  parent=None) -> CheckResult:
+        """
+        :param parent: span of the poll, the check runs in another thread.
+        """
+        with tracer.attach(parent), span('check', repo=merge_queue.gh_repo.full_name):
+            return list(merge_queue.check(max_prs, snapshot))
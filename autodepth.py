@@ -0,0 +1,126 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Pull depth tuned from what a queue goes through.
+
+By Little's law the number of PRs that need to be in CI at once is the rate
+the queue merges at times the time CI takes. Pulling fewer leaves the head of
+the queue waiting for CI after every merge, pulling more runs CI on PRs that
+will need to be pulled again after the next merge. Failed pulls take a slot
+without giving a mergeable PR, the depth is raised in proportion.
+"""
+from math import ceil
+from typing import Dict, List, Optional, Tuple
+import logging
+import time
+
+from pr import PR, PRTransition, PRTransitionParams
+
+log = logging.getLogger(__name__)
+
+# Weight of a new observation in the moving averages.
+SMOOTHING = 0.2
+# CI runs and merges to observe before touching the depth.
+MIN_SAMPLES = 3
+# The failure rate only scales the depth up to this factor.
+MAX_FAILURE_BOOST = 2.0
+
+
+def smooth(average: Optional[float], value: float) -> float:
+    return value if average is None else average + SMOOTHING * (value - average)
+
+
+class DepthTuner:
+    """
+    Follows the CI duration, merge interval and pull failure rate of a queue
+    from its transitions, and moves its depth one step at a time towards what
+    they call for, within the bounds set by the saints.
+    """
+
+    def __init__(self, min_depth: int, max_depth: int):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.ci_duration: Optional[float] = None  # seconds from a pull to the PR being clean
+        self.merge_interval: Optional[float] = None  # seconds between two merges
+        self.failure_rate = 0.0  # share of the pulls that failed
+        self.ci_samples = 0
+        self.merge_samples = 0
+        self.pulled_at: Dict[int, float] = {}  # PR -> when its last pull started CI
+        self.last_merge: Optional[float] = None
+        self.last_decision = 'waiting for enough merges and CI runs'
+
+    def observe_ci(self, pr_nb: int, now: float):
+        started = self.pulled_at.pop(pr_nb, None)
+        if started is not None:
+            self.ci_duration = smooth(self.ci_duration, now - started)
+            self.ci_samples += 1
+
+    def observe(self, queue: List[PR], transitions: List[Tuple[PR, List[PRTransitionParams]]], now: float = None):
+        """
+        :param queue: the queue after a check.
+        :param transitions: what the check reported.
+        """
+        now = time.time() if now is None else now
+        for pr, new_states in transitions:
+            for state, _ in new_states:
+                if state == PRTransition.PULLED_SUCCESS:
+                    self.pulled_at[pr.nb] = now  # CI starts over
+                    self.failure_rate = smooth(self.failure_rate, 0.0)
+                elif state == PRTransition.PULLED_FAILURE:
+                    self.pulled_at.pop(pr.nb, None)
+                    self.failure_rate = smooth(self.failure_rate, 1.0)
+                elif state == PRTransition.MERGED:
+                    # Not seen going clean: how long CI took is not known.
+                    self.pulled_at.pop(pr.nb, None)
+                    if self.last_merge is not None:
+                        self.merge_interval = smooth(self.merge_interval, now - self.last_merge)
+                        self.merge_samples += 1
+                    self.last_merge = now
+                elif state == PRTransition.CLOSED:
+                    self.pulled_at.pop(pr.nb, None)
+        for pr in queue:
+            if pr.nb in self.pulled_at and pr.mergeable_state == 'clean':
+                self.observe_ci(pr.nb, now)
+
+    def target(self) -> Optional[int]:
+        """
+        :return: the depth the observations call for, None until there are
+                 enough of them.
+        """
+        if self.ci_samples < MIN_SAMPLES or self.merge_samples < MIN_SAMPLES:
+            return None
+        in_ci = self.ci_duration / max(self.merge_interval, 1.0)
+        boost = min(1.0 / max(1.0 - self.failure_rate, 1e-6), MAX_FAILURE_BOOST)
+        return ceil(in_ci * boost)
+
+    def decide(self, depth: int) -> int:
+        """
+        :return: the new depth of the queue, from its current one.
+        """
+        target = self.target()
+        if target is None:
+            new_depth = depth
+        else:
+            # One step at a time, a burst of merges should not swing the depth.
+            new_depth = depth + (target > depth) - (target < depth)
+            self.last_decision = (f'aiming at {target}: CI takes {self.ci_duration / 60:.0f} min, a merge every '
+                                  f'{self.merge_interval / 60:.0f} min, {self.failure_rate:.0%} of the pulls fail')
+        new_depth = min(max(new_depth, self.min_depth), self.max_depth)
+        if new_depth != depth:
+            log.info('Pull depth %d -> %d, %s.', depth, new_depth, self.last_decision)
+        return new_depth
+
+    def status(self) -> str:
+        return f'Auto-tuned between {self.min_depth} and {self.max_depth}, {self.last_decision}.'
@@ -0,0 +1,84 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Benchmark MergeQueue.check offline, replaying a cassette recorded with
+`!merge record`:
+
+    python bench_check.py merge-cassette-1539000000.jsonl --iterations 20 --profile check.prof
+"""
+from typing import Dict, Mapping
+import argparse
+import cProfile
+import pstats
+import statistics
+import time
+
+from github_wrapper import Github, replaying
+from mergequeue import MergeQueue
+from pr import PR
+
+
+def load_queues(gh: Github, meta: Mapping) -> Dict[str, MergeQueue]:
+    """
+    Rebuild the queues as they were when the cassette was recorded.
+    """
+    queues = {}
+    for room, state in meta['queues'].items():
+        queues[room] = MergeQueue(gh.get_repo(state['repo'], lazy=True),
+                                  max_pulled_prs=state['max_pulled_prs'],
+                                  initial_queue=[PR.from_state(pr_state) for pr_state in state['queue']],
+                                  initial_pulled_prs=list(state['pulled_prs']))
+    return queues
+
+
+def bench(path: str, iterations: int, latency_factor: float, profile: str = None):
+    profiler = cProfile.Profile() if profile else None
+    timings = []
+    with replaying(path, latency_factor=latency_factor, repeat=True) as cassette:
+        gh = Github('replayed-token')
+        for _ in range(iterations):
+            cassette.rewind()
+            queues = load_queues(gh, cassette.meta)
+            start = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            for key, merge_queue in queues.items():
+                list(merge_queue.check(cassette.meta['queues'][key].get('max_prs')))
+            if profiler:
+                profiler.disable()
+            timings.append(time.perf_counter() - start)
+
+    print(f'{len(cassette.interactions)} recorded requests, {len(cassette.meta["queues"])} queues, '
+          f'{iterations} iterations.')
+    print(f'check cycle: min {min(timings) * 1000:.1f}ms, median {statistics.median(timings) * 1000:.1f}ms, '
+          f'max {max(timings) * 1000:.1f}ms.')
+    if profiler:
+        profiler.dump_stats(profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded check cycle and time it.')
+    parser.add_argument('cassette', help='Cassette recorded with !merge record')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Fraction of the recorded latency to simulate (0: none, 1: as recorded)')
+    parser.add_argument('--profile', help='Save a cProfile of the cycles in this file')
+    args = parser.parse_args()
+    bench(args.cassette, args.iterations, args.latency, args.profile)
+
+
+if __name__ == '__main__':
+    main()
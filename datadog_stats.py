@@ -13,7 +13,7 @@
 #    limitations under the License.
 
 from datadog import initialize, api
-from pr import PR
+from pr import PR, DEFAULT_LANE
 from stats import BaseStat
 
 
@@ -36,11 +36,13 @@ class Stats(BaseStat):
         """Send event to Datadog."""
         title = f'PR-{pr.nb} - {event_type}'
         text = f'PR-{pr.nb} triggered event {event_type} after being in the queue for {pr.get_queue_time()} seconds'
-        tags = [f'base_branch:{pr.base}', f'pr:{pr.nb}', f'event_type:{event_type}'] + self.default_tags
+        tags = [f'base_branch:{pr.base}', f'pr:{pr.nb}', f'event_type:{event_type}',
+                f'lane:{getattr(pr, "lane", DEFAULT_LANE)}'] + self.default_tags
 
         self.api.Event.create(title=title, text=text, tags=tags)
 
     def send_metric(self, metric_name: str, metric_value: float, pr: PR) -> None:
         """Send metric to Datadog."""
-        tags = [f'base_branch:{pr.base}', f'pr:{pr.nb}', f'metric:{metric_name}'] + self.default_tags
+        tags = [f'base_branch:{pr.base}', f'pr:{pr.nb}', f'metric:{metric_name}',
+                f'lane:{getattr(pr, "lane", DEFAULT_LANE)}'] + self.default_tags
         self.api.Metric.send(metric=metric_name, points=metric_value, tags=tags)
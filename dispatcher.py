@@ -0,0 +1,156 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Outbound chat message dispatcher, decoupled from the merge loop."""
+from queue import Queue, Full
+from threading import Thread, Lock
+from typing import Any, Callable, List
+import logging
+import random
+import time
+
+from tracing import current, span, tracer
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_QUEUED = 1000
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+_STOP = object()
+
+
+class MessageDispatcher:
+    """
+    Sends chat messages from a pool of worker threads.
+
+    Every destination is pinned to a single worker so messages to the same
+    room or user are delivered in the order they were enqueued. The queues are
+    bounded: when they are full, new messages are dropped rather than blocking
+    the caller.
+    """
+
+    def __init__(self,
+                 send: Callable[[Any, str], Any],
+                 workers: int = DEFAULT_WORKERS,
+                 max_queued: int = DEFAULT_MAX_QUEUED,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff: float = DEFAULT_BACKOFF):
+        self.send = send
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_queued = max_queued
+        per_worker = max(1, max_queued // max(1, workers))
+        self.queues = [Queue(maxsize=per_worker) for _ in range(max(1, workers))]
+        self.threads: List[Thread] = []
+        self.counters_lock = Lock()
+        self.enqueued = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.high_watermark = 0
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        if self.threads:
+            return
+        for idx, queue in enumerate(self.queues):
+            thread = Thread(target=self._run, args=(queue,), name=f'merge-dispatcher-{idx}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Ask the workers to finish what is already queued and stop.
+        """
+        for queue in self.queues:
+            try:
+                queue.put(_STOP, timeout=timeout)
+            except Full:
+                log.warning('Dispatcher queue still full on stop, some messages will be lost.')
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def enqueue(self, to: Any, text: str) -> bool:
+        """
+        Queue a message for delivery without blocking.
+        :return: False if the message was dropped because of backpressure.
+        """
+        queue = self.queues[hash(str(to)) % len(self.queues)]
+        try:
+            queue.put_nowait((to, text, current()))
+        except Full:
+            with self.counters_lock:
+                self.dropped += 1
+            log.warning('Outbound queue full, dropping message to %s.', to)
+            return False
+        with self.counters_lock:
+            self.enqueued += 1
+            self.high_watermark = max(self.high_watermark, self.depth())
+        return True
+
+    def depth(self) -> int:
+        """
+        Number of messages waiting to be sent.
+        """
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self) -> str:
+        """
+        Human readable backpressure metrics.
+        """
+        with self.counters_lock:
+            return f'Outbound messages: {self.depth()}/{self.max_queued} queued ' \
+                   f'(high watermark {self.high_watermark}), {self.enqueued} enqueued, {self.sent} sent, ' \
+                   f'{self.retried} retried, {self.failed} failed, {self.dropped} dropped.'
+
+    def _deliver(self, to: Any, text: str, parent=None):
+        """
+        :param parent: span that enqueued the message.
+        """
+        with tracer.attach(parent), span('send', to=str(to)) as send_span:
+            send_span.set(sent=self._send(to, text))
+
+    def _send(self, to: Any, text: str) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.send(to, text)
+                with self.counters_lock:
+                    self.sent += 1
+                return True
+            except Exception:
+                if attempt == self.max_retries:
+                    break
+                delay = min(MAX_BACKOFF, self.backoff * 2 ** attempt)
+                log.warning('Could not send message to %s, retrying in %.1fs.', to, delay, exc_info=True)
+                with self.counters_lock:
+                    self.retried += 1
+                time.sleep(delay * random.uniform(0.5, 1.0))
+        with self.counters_lock:
+            self.failed += 1
+        log.error('Giving up sending message to %s.', to)
+        return False
+
+    def _run(self, queue: Queue):
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            self._deliver(*item)
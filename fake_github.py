@@ -0,0 +1,634 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Local HTTP stand-in for the GitHub API, so that PyGithub, the github_wrapper
+patches and transport and the async engine can be exercised end to end under
+load (see load_test.py). It serves what the queues use: pulls, reviews,
+branches, statuses, merges, refs, git refs, the rate limit and the GraphQL
+queries and mutations of gh_graphql, from a state scripted in Python:
+
+    with FakeGitHub(latency=0.01, error_rate=0.01) as fake:
+        fake.add_repo('argoai/av')
+        fake.add_pull('argoai/av', 1, behind=True)
+        fake.at(2, lambda fake: fake.push('argoai/av', 'master'))
+        Github(base_url=fake.url).get_repo('argoai/av').get_pull(1)
+        fake.tick()  # CI runs finish, changes scheduled for tick 1 happen
+
+Latency, server errors (502), secondary rate limits (403 with Retry-After)
+and the primary rate limit (X-RateLimit-* headers, 403 once exhausted) are
+injected on every request.
+"""
+from base64 import b64decode, b64encode
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import RLock, Thread
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+from urllib.parse import parse_qsl, unquote, urlencode
+import json
+import logging
+import os
+import random
+import re
+import time
+
+from github_wrapper import ApiProfile
+
+log = logging.getLogger(__name__)
+
+Response = Tuple[int, Any, Dict[str, str]]
+
+DEFAULT_PER_PAGE = 30
+MAX_PER_PAGE = 100
+RATE_LIMIT_WINDOW = 3600
+REPO = r'/repos/(?P<repo>[^/]+/[^/]+)'
+# First match on (verb, path) wins.
+ROUTES = tuple((verb, re.compile(pattern), handler) for verb, pattern, handler in (
+    ('GET', r'/rate_limit', 'get_rate_limit'),
+    ('POST', r'(?:/api)?/graphql', 'graphql'),
+    ('GET', REPO, 'get_repo'),
+    ('GET', REPO + r'/pulls', 'list_pulls'),
+    ('GET', REPO + r'/pulls/(?P<nb>\d+)', 'get_pull'),
+    ('PATCH', REPO + r'/pulls/(?P<nb>\d+)', 'edit_pull'),
+    ('GET', REPO + r'/pulls/(?P<nb>\d+)/reviews', 'list_reviews'),
+    ('PUT', REPO + r'/pulls/(?P<nb>\d+)/merge', 'merge_pull'),
+    ('POST', REPO + r'/merges', 'merge_branches'),
+    ('GET', REPO + r'/branches/(?P<ref>.+)', 'get_branch'),
+    ('GET', REPO + r'/commits/(?P<ref>[^/]+)/statuses', 'list_statuses'),
+    ('GET', REPO + r'/statuses/(?P<ref>[^/]+)', 'list_statuses'),
+    ('GET', REPO + r'/commits/(?P<ref>[^/]+)', 'get_commit'),
+    ('GET', REPO + r'/git/refs?/heads/(?P<ref>.+)', 'get_ref'),
+    ('DELETE', REPO + r'/git/refs?/heads/(?P<ref>.+)', 'delete_ref'),
+))
+GRAPHQL_STRING = r'"(?:[^"\\]|\\.)*"'
+
+
+def new_sha() -> str:
+    return os.urandom(20).hex()
+
+
+def iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def node_id(kind: str, key: str) -> str:
+    return b64encode(f'{kind}:{key}'.encode()).decode()
+
+
+def parse_node_id(value: str) -> Tuple[str, str]:
+    kind, _, key = b64decode(value).decode().partition(':')
+    return kind, key
+
+
+class FakePull:
+    def __init__(self, number: int, head: str, base: str, user: str, title: str, body: str):
+        self.number = number
+        self.head = head
+        self.base = base
+        self.user = user
+        self.title = title
+        self.body = body
+        self.labels: List[str] = []
+        self.reviews: List[Tuple[str, str]] = []  # (login, state)
+        self.open = True
+        self.merged = False
+        self.conflict = False
+        self.ci = 'success'
+        self.ci_done = 0  # tick the pending CI run finishes at
+        self.merged_base: Optional[str] = None  # sha of the base branch last merged in the head
+        self.forced_state: Optional[str] = None  # mergeable_state reported whatever the rest says
+        self.created_at = self.updated_at = time.time()
+
+    def touch(self):
+        self.updated_at = time.time()
+
+    @property
+    def approved(self) -> bool:
+        return any(state == 'APPROVED' for _, state in self.reviews)
+
+
+class FakeRepo:
+    def __init__(self, full_name: str, default_branch: str, contexts: List[str]):
+        self.full_name = full_name
+        self.default_branch = default_branch
+        self.contexts = contexts  # required status checks of every branch
+        self.branches: Dict[str, str] = {default_branch: new_sha()}  # name -> sha of its head
+        self.pulls: Dict[int, FakePull] = {}
+
+    def pull_by_head(self, branch: str) -> Optional[FakePull]:
+        return next((pull for pull in self.pulls.values() if pull.open and pull.head == branch), None)
+
+    def pull_by_sha(self, sha: str) -> Optional[FakePull]:
+        return next((pull for pull in self.pulls.values() if self.branches.get(pull.head) == sha), None)
+
+    def resolve(self, ref: str) -> Optional[str]:
+        if ref in self.branches:
+            return self.branches[ref]
+        return ref if ref in self.branches.values() else None
+
+    def mergeable_state(self, pull: FakePull) -> str:
+        if pull.forced_state:
+            return pull.forced_state
+        if pull.conflict:
+            return 'dirty'
+        if pull.ci != 'success' or not pull.approved:
+            return 'blocked'
+        if pull.merged_base != self.branches.get(pull.base):
+            return 'behind'
+        return 'clean'
+
+
+class FakeGitHub:
+    """
+    The state of the fake GitHub and the HTTP server answering from it.
+
+    :param latency: seconds every request takes.
+    :param error_rate: share of the requests answered with a 502.
+    :param secondary_rate_limit: share of the requests answered with a
+                                 secondary rate limit 403, retry_after
+                                 seconds to wait.
+    :param rate_limit: requests allowed per hour, then 403 until the reset.
+    :param ci_ticks: ticks a CI run started by a pull takes.
+    :param ci_failure_rate: share of the CI runs that fail.
+    :param conflict_rate: share of the pulls that conflict (409).
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, secondary_rate_limit: float = 0.0,
+                 retry_after: float = 0.0, rate_limit: int = 5000, ci_ticks: int = 1, ci_failure_rate: float = 0.0,
+                 conflict_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.secondary_rate_limit = secondary_rate_limit
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.ci_ticks = ci_ticks
+        self.ci_failure_rate = ci_failure_rate
+        self.conflict_rate = conflict_rate
+        self.rng = random.Random(seed)
+        self.lock = RLock()
+        self.repos: Dict[str, FakeRepo] = {}
+        self.clock = 0
+        self.scheduled: Dict[int, List[Callable[['FakeGitHub'], None]]] = defaultdict(list)
+        self.calls = Counter()  # 'VERB endpoint' -> requests
+        self.injected = Counter()  # injected failure -> requests
+        self.remaining = rate_limit
+        self.reset_at = int(time.time()) + RATE_LIMIT_WINDOW
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    # Scripted state.
+
+    def add_repo(self, full_name: str, default_branch: str = 'master', contexts: List[str] = ('ci',)) -> FakeRepo:
+        with self.lock:
+            repo = self.repos[full_name] = FakeRepo(full_name, default_branch, list(contexts))
+            return repo
+
+    def add_pull(self, full_name: str, number: int = None, head: str = None, base: str = None, user: str = 'author',
+                 approved_by: List[str] = ('reviewer',), labels: List[str] = (), ci: str = 'success',
+                 behind: bool = False, conflict: bool = False, title: str = None, body: str = '') -> FakePull:
+        """
+        Open a PR, its head branch is created from its base.
+        :param behind: the base branch moved since the head was branched off.
+        """
+        with self.lock:
+            repo = self.repos[full_name]
+            number = number or max(repo.pulls, default=0) + 1
+            base = base or repo.default_branch
+            pull = FakePull(number, head or f'change-{number}', base, user, title or f'Change {number}', body)
+            pull.labels = list(labels)
+            pull.reviews = [(login, 'APPROVED') for login in approved_by]
+            pull.ci = ci
+            pull.conflict = conflict
+            pull.merged_base = None if behind else repo.branches[base]
+            repo.branches[pull.head] = new_sha()
+            repo.pulls[number] = pull
+            return pull
+
+    def pull(self, full_name: str, number: int) -> FakePull:
+        return self.repos[full_name].pulls[number]
+
+    def review(self, full_name: str, number: int, user: str, state: str = 'APPROVED'):
+        with self.lock:
+            pull = self.pull(full_name, number)
+            pull.reviews.append((user, state))
+            pull.touch()
+
+    def set_ci(self, full_name: str, number: int, state: str):
+        with self.lock:
+            pull = self.pull(full_name, number)
+            pull.ci = state
+            pull.touch()
+
+    def set_state(self, full_name: str, number: int, mergeable_state: Optional[str]):
+        """
+        Report a mergeable_state whatever the PR looks like ('unknown' while
+        GitHub computes it), None to go back to the computed one.
+        """
+        with self.lock:
+            pull = self.pull(full_name, number)
+            pull.forced_state = mergeable_state
+            pull.touch()
+
+    def close_pull(self, full_name: str, number: int):
+        with self.lock:
+            pull = self.pull(full_name, number)
+            pull.open = False
+            pull.touch()
+
+    def push(self, full_name: str, branch: str):
+        """
+        A commit lands on a branch, the PRs based on it are behind.
+        """
+        with self.lock:
+            repo = self.repos[full_name]
+            repo.branches[branch] = new_sha()
+            pull = repo.pull_by_head(branch)
+            if pull:
+                self.start_ci(pull)
+
+    def start_ci(self, pull: FakePull):
+        pull.ci = 'pending'
+        pull.ci_done = self.clock + self.ci_ticks
+        pull.touch()
+
+    def at(self, tick: int, change: Callable[['FakeGitHub'], None]):
+        """
+        Change the state when the clock reaches tick.
+        """
+        with self.lock:
+            self.scheduled[tick].append(change)
+
+    def tick(self):
+        """
+        Advance the clock: finish the CI runs that are over, then run the
+        changes scheduled for the new tick.
+        """
+        with self.lock:
+            self.clock += 1
+            for repo in self.repos.values():
+                for pull in repo.pulls.values():
+                    if pull.open and pull.ci == 'pending' and pull.ci_done <= self.clock:
+                        pull.ci = 'failure' if self.rng.random() < self.ci_failure_rate else 'success'
+                        pull.touch()
+            for change in self.scheduled.pop(self.clock, ()):
+                change(self)
+
+    def request_count(self) -> int:
+        with self.lock:
+            return sum(self.calls.values())
+
+    def merged_count(self) -> int:
+        with self.lock:
+            return sum(pull.merged for repo in self.repos.values() for pull in repo.pulls.values())
+
+    # Server.
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self, port: int = 0) -> 'FakeGitHub':
+        handler = type('Handler', (FakeGitHubHandler,), {'fake': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, name='fake-github', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def __enter__(self) -> 'FakeGitHub':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def rate_limit_headers(self) -> Dict[str, str]:
+        return {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(self.remaining),
+                'X-RateLimit-Reset': str(self.reset_at), 'X-RateLimit-Used': str(self.rate_limit - self.remaining),
+                'X-RateLimit-Resource': 'core'}
+
+    def handle(self, verb: str, target: str, body: Any) -> Response:
+        if self.latency:
+            time.sleep(self.latency)
+        path, _, query_string = target.partition('?')
+        query = dict(parse_qsl(query_string))
+        with self.lock:
+            self.calls[f'{verb} {ApiProfile.endpoint(path)}'] += 1
+            if time.time() >= self.reset_at:
+                self.remaining, self.reset_at = self.rate_limit, int(time.time()) + RATE_LIMIT_WINDOW
+            status, data, headers = self.answer(verb, path, query, body)
+            return status, data, dict(self.rate_limit_headers(), **headers)
+
+    def answer(self, verb: str, path: str, query: Mapping[str, str], body: Any) -> Response:
+        if path != '/rate_limit':
+            if self.remaining <= 0:
+                self.injected['rate_limited'] += 1
+                return 403, {'message': 'API rate limit exceeded for user.'}, {}
+            self.remaining -= 1
+        draw = self.rng.random()
+        if draw < self.secondary_rate_limit:
+            self.injected['secondary_rate_limited'] += 1
+            return 403, {'message': 'You have exceeded a secondary rate limit.'}, \
+                {'Retry-After': f'{self.retry_after:g}'}
+        if draw < self.secondary_rate_limit + self.error_rate:
+            self.injected['server_error'] += 1
+            return 502, {'message': 'Server Error'}, {}
+        for route_verb, pattern, handler in ROUTES:
+            match = pattern.fullmatch(path)
+            if route_verb != verb or not match:
+                continue
+            params = {key: unquote(value) for key, value in match.groupdict().items()}
+            if 'repo' in params:
+                repo = self.repos.get(params.pop('repo'))
+                if repo is None:
+                    return 404, {'message': 'Not Found'}, {}
+                params['repo'] = repo
+            try:
+                return getattr(self, handler)(query=query, body=body, **params)
+            except Exception:
+                log.exception('Fake GitHub failed on %s %s.', verb, path)
+                return 500, {'message': 'Fake GitHub error'}, {}
+        return 404, {'message': 'Not Found'}, {}
+
+    # REST endpoints.
+
+    def repo_url(self, repo: FakeRepo) -> str:
+        return f'{self.url}/repos/{repo.full_name}'
+
+    def pull_json(self, repo: FakeRepo, pull: FakePull) -> Dict:
+        state = repo.mergeable_state(pull)
+        return {'url': f'{self.repo_url(repo)}/pulls/{pull.number}', 'id': pull.number,
+                'node_id': node_id('PullRequest', f'{repo.full_name}#{pull.number}'),
+                'html_url': f'https://github.com/{repo.full_name}/pull/{pull.number}', 'number': pull.number,
+                'state': 'open' if pull.open else 'closed', 'title': pull.title, 'body': pull.body,
+                'user': {'login': pull.user}, 'labels': [{'name': label} for label in pull.labels],
+                'head': {'ref': pull.head, 'sha': repo.branches.get(pull.head, '0' * 40)},
+                'base': {'ref': pull.base, 'sha': repo.branches.get(pull.base, '0' * 40)},
+                'merged': pull.merged, 'mergeable': None if state == 'unknown' else not pull.conflict,
+                'mergeable_state': state, 'created_at': iso(pull.created_at), 'updated_at': iso(pull.updated_at)}
+
+    def page(self, path: str, query: Mapping[str, str], items: List) -> Response:
+        per_page = min(int(query.get('per_page', DEFAULT_PER_PAGE)), MAX_PER_PAGE)
+        page = int(query.get('page', 1))
+        last = max(1, -(-len(items) // per_page))
+        headers = {}
+        if page < last:
+            link = f'{self.url}{path}?{{}}'
+            headers['Link'] = ', '.join(f'<{link.format(urlencode(dict(query, page=nb)))}>; rel="{rel}"'
+                                        for nb, rel in ((page + 1, 'next'), (last, 'last')))
+        return 200, items[(page - 1) * per_page:page * per_page], headers
+
+    def get_rate_limit(self, query: Mapping, body: Any) -> Response:
+        core = {'limit': self.rate_limit, 'remaining': self.remaining, 'reset': self.reset_at,
+                'used': self.rate_limit - self.remaining}
+        return 200, {'resources': {'core': core, 'search': core, 'graphql': core}, 'rate': core}, {}
+
+    def get_repo(self, repo: FakeRepo, query: Mapping, body: Any) -> Response:
+        owner, name = repo.full_name.split('/')
+        return 200, {'id': abs(hash(repo.full_name)), 'name': name, 'full_name': repo.full_name,
+                     'owner': {'login': owner}, 'url': self.repo_url(repo), 'private': False,
+                     'html_url': f'https://github.com/{repo.full_name}', 'default_branch': repo.default_branch}, {}
+
+    def list_pulls(self, repo: FakeRepo, query: Mapping, body: Any) -> Response:
+        state = query.get('state', 'open')
+        pulls = [pull for pull in repo.pulls.values()
+                 if (state == 'all' or pull.open == (state == 'open'))
+                 and query.get('base', pull.base) == pull.base and query.get('head', pull.head) == pull.head]
+        sort = query.get('sort', 'created')
+        descending = query.get('direction', 'desc' if sort == 'created' else 'asc') == 'desc'
+        pulls.sort(key=lambda pull: (pull.updated_at if sort == 'updated' else pull.created_at, pull.number),
+                   reverse=descending)
+        return self.page(f'/repos/{repo.full_name}/pulls', query, [self.pull_json(repo, pull) for pull in pulls])
+
+    def get_pull(self, repo: FakeRepo, nb: str, query: Mapping, body: Any) -> Response:
+        pull = repo.pulls.get(int(nb))
+        if pull is None:
+            return 404, {'message': 'Not Found'}, {}
+        return 200, self.pull_json(repo, pull), {}
+
+    def edit_pull(self, repo: FakeRepo, nb: str, query: Mapping, body: Any) -> Response:
+        pull = repo.pulls.get(int(nb))
+        if pull is None:
+            return 404, {'message': 'Not Found'}, {}
+        body = body or {}
+        if 'base' in body:
+            if body['base'] not in repo.branches:
+                return 422, {'message': 'Validation Failed'}, {}
+            pull.base = body['base']
+        if 'state' in body:
+            pull.open = body['state'] == 'open'
+        pull.title = body.get('title', pull.title)
+        pull.body = body.get('body', pull.body)
+        pull.touch()
+        return 200, self.pull_json(repo, pull), {}
+
+    def list_reviews(self, repo: FakeRepo, nb: str, query: Mapping, body: Any) -> Response:
+        pull = repo.pulls.get(int(nb))
+        if pull is None:
+            return 404, {'message': 'Not Found'}, {}
+        reviews = [{'id': idx + 1, 'user': {'login': login}, 'state': state, 'body': ''}
+                   for idx, (login, state) in enumerate(pull.reviews)]
+        return self.page(f'/repos/{repo.full_name}/pulls/{nb}/reviews', query, reviews)
+
+    def merge_pull(self, repo: FakeRepo, nb: str, query: Mapping, body: Any) -> Response:
+        pull = repo.pulls.get(int(nb))
+        if pull is None:
+            return 404, {'message': 'Not Found'}, {}
+        if not pull.open or repo.mergeable_state(pull) != 'clean':
+            return 405, {'message': 'Pull Request is not mergeable'}, {}
+        pull.open, pull.merged = False, True
+        pull.touch()
+        sha = repo.branches[pull.base] = new_sha()
+        return 200, {'sha': sha, 'merged': True, 'message': 'Pull Request successfully merged'}, {}
+
+    def merge_branches(self, repo: FakeRepo, query: Mapping, body: Any) -> Response:
+        """
+        Merge the branch `head` into the branch `base`, what a pull does.
+        """
+        base, head = body['base'], body['head']
+        if base not in repo.branches or head not in repo.branches:
+            return 404, {'message': 'Base does not exist' if base not in repo.branches else 'Head does not exist'}, {}
+        pull = repo.pull_by_head(base)
+        if pull and pull.merged_base == repo.branches[head]:
+            return 204, None, {}
+        if pull and (pull.conflict or self.rng.random() < self.conflict_rate):
+            pull.conflict = True
+            pull.touch()
+            return 409, {'message': 'Merge Conflict'}, {}
+        sha = repo.branches[base] = new_sha()
+        if pull:
+            pull.merged_base = repo.branches[head]
+            self.start_ci(pull)
+        return 201, {'sha': sha, 'url': f'{self.repo_url(repo)}/commits/{sha}',
+                     'commit': {'message': body.get('commit_message', f'Merge {head} into {base}')}}, {}
+
+    def get_branch(self, repo: FakeRepo, ref: str, query: Mapping, body: Any) -> Response:
+        if ref not in repo.branches:
+            return 404, {'message': 'Branch not found'}, {}
+        sha = repo.branches[ref]
+        checks = {'enforcement_level': 'everyone', 'contexts': repo.contexts}
+        return 200, {'name': ref, 'commit': {'sha': sha, 'url': f'{self.repo_url(repo)}/commits/{sha}'},
+                     'protected': bool(repo.contexts),
+                     'protection': {'enabled': bool(repo.contexts), 'required_status_checks': checks}}, {}
+
+    def get_commit(self, repo: FakeRepo, ref: str, query: Mapping, body: Any) -> Response:
+        sha = repo.resolve(ref)
+        if sha is None:
+            return 422, {'message': f'No commit found for SHA: {ref}'}, {}
+        return 200, {'sha': sha, 'url': f'{self.repo_url(repo)}/commits/{sha}', 'commit': {'message': ''}}, {}
+
+    def list_statuses(self, repo: FakeRepo, ref: str, query: Mapping, body: Any) -> Response:
+        sha = repo.resolve(ref)
+        pull = repo.pull_by_sha(sha) if sha else None
+        state = pull.ci if pull else 'success'
+        statuses = [{'id': idx + 1, 'context': context, 'state': state, 'description': ''}
+                    for idx, context in enumerate(repo.contexts)] if sha else []
+        return self.page(f'/repos/{repo.full_name}/commits/{ref}/statuses', query, statuses)
+
+    def ref_json(self, repo: FakeRepo, branch: str) -> Dict:
+        sha = repo.branches[branch]
+        return {'ref': f'refs/heads/{branch}', 'node_id': node_id('Ref', f'{repo.full_name}:{branch}'),
+                'url': f'{self.repo_url(repo)}/git/refs/heads/{branch}',
+                'object': {'sha': sha, 'type': 'commit', 'url': f'{self.repo_url(repo)}/git/commits/{sha}'}}
+
+    def get_ref(self, repo: FakeRepo, ref: str, query: Mapping, body: Any) -> Response:
+        if ref not in repo.branches:
+            return 404, {'message': 'Not Found'}, {}
+        return 200, self.ref_json(repo, ref), {}
+
+    def delete_ref(self, repo: FakeRepo, ref: str, query: Mapping, body: Any) -> Response:
+        if not self.delete_branch(repo, ref):
+            return 422, {'message': 'Reference does not exist'}, {}
+        return 204, None, {}
+
+    def delete_branch(self, repo: FakeRepo, branch: str) -> bool:
+        """
+        Like GitHub, the PRs still based on a deleted branch are closed.
+        """
+        if branch not in repo.branches:
+            return False
+        del repo.branches[branch]
+        for pull in repo.pulls.values():
+            if pull.open and pull.base == branch:
+                pull.open = False
+                pull.touch()
+        return True
+
+    # GraphQL, only the queries and mutations of gh_graphql.
+
+    def pull_node(self, repo: FakeRepo, pull: FakePull) -> Dict:
+        state = repo.mergeable_state(pull)
+        return {'id': node_id('PullRequest', f'{repo.full_name}#{pull.number}'), 'number': pull.number,
+                'url': f'https://github.com/{repo.full_name}/pull/{pull.number}',
+                'state': 'MERGED' if pull.merged else 'OPEN' if pull.open else 'CLOSED',
+                'title': pull.title, 'body': pull.body,
+                'mergeable': 'UNKNOWN' if state == 'unknown' else 'CONFLICTING' if pull.conflict else 'MERGEABLE',
+                'mergeStateStatus': state.upper(), 'headRefName': pull.head, 'baseRefName': pull.base,
+                'updatedAt': iso(pull.updated_at), 'author': {'login': pull.user},
+                'labels': {'nodes': [{'name': label} for label in pull.labels]},
+                'reviews': {'nodes': [{'state': state, 'author': {'login': login}} for login, state in pull.reviews]}}
+
+    def graphql(self, query: Mapping, body: Any) -> Response:
+        text, variables = body['query'], body.get('variables') or {}
+        if text.lstrip().startswith('mutation'):
+            data, errors = self.graphql_mutations(text)
+        elif 'search(' in text:
+            data, errors = self.graphql_search(variables['query']), []
+        else:
+            data, errors = self.graphql_repository(text, variables)
+        response = {'data': data}
+        if errors:
+            response['errors'] = errors
+        return 200, response, {}
+
+    def graphql_repository(self, text: str, variables: Mapping) -> Tuple[Dict, List]:
+        repo = self.repos.get(f'{variables["owner"]}/{variables["name"]}')
+        if repo is None:
+            return {'repository': None}, [{'type': 'NOT_FOUND', 'message': 'Could not resolve to a Repository'}]
+        nodes, errors = {}, []
+        for alias, number in re.findall(r'(\w+): pullRequest\(number: (\d+)\)', text):
+            pull = repo.pulls.get(int(number))
+            nodes[alias] = self.pull_node(repo, pull) if pull else None
+            if pull is None:
+                errors.append({'type': 'NOT_FOUND', 'path': ['repository', alias],
+                               'message': f'Could not resolve to a PullRequest with the number of {number}.'})
+        for alias, name in re.findall(rf'(\w+): ref\(qualifiedName: ({GRAPHQL_STRING})\)', text):
+            branch = json.loads(name)[len('refs/heads/'):]
+            nodes[alias] = {'id': node_id('Ref', f'{repo.full_name}:{branch}')} if branch in repo.branches else None
+        return {'repository': nodes}, errors
+
+    def graphql_search(self, search: str) -> Dict:
+        terms = {key: quoted or plain for key, quoted, plain in re.findall(r'(\w+):(?:"([^"]*)"|(\S+))', search)}
+        repo = self.repos.get(terms.get('repo'))
+        pulls = [pull for pull in (repo.pulls.values() if repo else ()) if pull.open
+                 and ('label' not in terms or terms['label'] in pull.labels)
+                 and ('updated' not in terms or iso(pull.updated_at) >= terms['updated'].lstrip('>='))]
+        pulls.sort(key=lambda pull: pull.updated_at if terms.get('sort', '').startswith('updated') else
+                   pull.created_at)
+        return {'search': {'pageInfo': {'hasNextPage': False, 'endCursor': None},
+                           'nodes': [self.pull_node(repo, pull) for pull in pulls]}}
+
+    def graphql_mutations(self, text: str) -> Tuple[Dict, List]:
+        data, errors = {}, []
+        for alias, mutation, arguments in re.findall(r'(\w+): (updatePullRequest|deleteRef)\(input: \{(.*?)\}\)',
+                                                     text):
+            arguments = {key: json.loads(value) for key, value in
+                         re.findall(rf'(\w+): ({GRAPHQL_STRING})', arguments)}
+            done = False
+            if mutation == 'updatePullRequest':
+                _, key = parse_node_id(arguments['pullRequestId'])
+                full_name, _, number = key.partition('#')
+                repo = self.repos.get(full_name)
+                pull = repo.pulls.get(int(number)) if repo else None
+                if pull and arguments.get('baseRefName') in repo.branches:
+                    pull.base = arguments['baseRefName']
+                    pull.touch()
+                    done = True
+            else:
+                _, key = parse_node_id(arguments['refId'])
+                full_name, _, branch = key.partition(':')
+                repo = self.repos.get(full_name)
+                done = bool(repo) and self.delete_branch(repo, branch)
+            data[alias] = {'clientMutationId': None} if done else None
+            if not done:
+                errors.append({'type': 'UNPROCESSABLE', 'path': [alias], 'message': f'{mutation} failed'})
+        return data, errors
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the pooled transport expects
+    disable_nagle_algorithm = True  # headers and body are written apart
+    fake: FakeGitHub = None
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        status, data, headers = self.fake.handle(self.command, self.path, json.loads(raw) if raw else None)
+        payload = b'' if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,211 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Fetching many PRs with a handful of GraphQL requests instead of a couple of
+REST calls per PR, for adding a batch of PRs to a queue at once and for
+following the label that enqueues PRs automatically. The clean up after
+merges (moving the dependents, deleting the branches) is batched the same way.
+"""
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Mapping, Set
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+# PRs fetched per GraphQL request, GitHub caps the cost of a query.
+BATCH_SIZE = 50
+# Most PRs a search adds, so a loose query cannot flood the queue.
+MAX_SEARCH_RESULTS = 300
+
+PULL_FIELDS = """
+    number url state title body mergeable mergeStateStatus headRefName baseRefName updatedAt
+    author { login }
+    labels(first: 20) { nodes { name } }
+    reviews(last: 100) { nodes { state author { login } } }
+"""
+
+PULLS_QUERY = """
+query($owner: String!, $name: String!) {{
+  repository(owner: $owner, name: $name) {{
+    {aliases}
+  }}
+}}
+"""
+
+SEARCH_QUERY = """
+query($query: String!, $after: String) {
+  search(query: $query, type: ISSUE, first: 100, after: $after) {
+    pageInfo { hasNextPage endCursor }
+    nodes { ... on PullRequest { %s } }
+  }
+}
+""" % PULL_FIELDS
+
+MUTATION = """
+mutation {{
+  {aliases}
+}}
+"""
+
+MERGEABLE = {'MERGEABLE': True, 'CONFLICTING': False}
+
+
+def login(actor: Mapping) -> SimpleNamespace:
+    # Deleted accounts come back as null.
+    return SimpleNamespace(login=(actor or {}).get('login', 'ghost'))
+
+
+class GraphQLPull:
+    """
+    A PR from the GraphQL API, with the attributes of the PyGithub PullRequest
+    that PR reads.
+    """
+
+    def __init__(self, data: Mapping):
+        self.number = data['number']
+        self.html_url = data['url']
+        self.state = 'open' if data['state'] == 'OPEN' else 'closed'
+        self.title = data['title']
+        self.body = data['body']
+        self.mergeable = MERGEABLE.get(data['mergeable'])
+        self.mergeable_state = (data.get('mergeStateStatus') or 'unknown').lower()
+        self.head = SimpleNamespace(ref=data['headRefName'])
+        self.base = SimpleNamespace(ref=data['baseRefName'])
+        self.user = login(data['author'])
+        self.labels = [SimpleNamespace(name=label['name']) for label in data['labels']['nodes']]
+        self.updated_at = data['updatedAt']  # ISO 8601, as GitHub searches take it
+        self.reviews = [SimpleNamespace(state=review['state'], user=login(review['author']))
+                        for review in data['reviews']['nodes']]
+
+    def get_reviews(self) -> List[SimpleNamespace]:
+        return self.reviews
+
+
+def requester(gh_repo):
+    """
+    :return: the PyGithub requester of a repository, None for the ones that
+             cannot do GraphQL (fakes, snapshots).
+    """
+    return getattr(gh_repo, 'requester', None)
+
+
+def query(gh_repo, text: str, variables: Mapping) -> Dict:
+    """
+    Run a query, keeping the partial data GitHub returns along with errors
+    (a missing PR is an error but the others are still there).
+    """
+    gh_requester = requester(gh_repo)
+    _, response = gh_requester.requestJsonAndCheck('POST', gh_requester.graphql_url,
+                                                   input={'query': text, 'variables': dict(variables)})
+    for error in response.get('errors', ()):
+        log.debug('GraphQL error for %s: %s', gh_repo.full_name, error.get('message'))
+    if not response.get('data'):
+        raise IOError(f'GraphQL query failed: {response.get("errors")}')
+    return response['data']
+
+
+def fetch_pulls(gh_repo, pr_nbs: Iterable[int]) -> Dict[int, GraphQLPull]:
+    """
+    :return: the PRs found among pr_nbs, by number.
+    """
+    owner, name = gh_repo.full_name.split('/')
+    pr_nbs = list(dict.fromkeys(pr_nbs))
+    pulls = {}
+    for start in range(0, len(pr_nbs), BATCH_SIZE):
+        aliases = '\n'.join(f'pr{pr_nb}: pullRequest(number: {int(pr_nb)}) {{ {PULL_FIELDS} }}'
+                            for pr_nb in pr_nbs[start:start + BATCH_SIZE])
+        data = query(gh_repo, PULLS_QUERY.format(aliases=aliases), {'owner': owner, 'name': name})
+        for pull in (data.get('repository') or {}).values():
+            if pull:
+                pulls[pull['number']] = GraphQLPull(pull)
+    return pulls
+
+
+def search_pulls(gh_repo, search: str, sort: str = 'created-asc') -> List[GraphQLPull]:
+    """
+    Open PRs of the repository matching a GitHub search, in the order of
+    `sort` (a GitHub search sort qualifier).
+    """
+    text = f'{search} repo:{gh_repo.full_name} is:pr is:open sort:{sort}'
+    pulls, after = [], None
+    while len(pulls) < MAX_SEARCH_RESULTS:
+        result = query(gh_repo, SEARCH_QUERY, {'query': text, 'after': after})['search']
+        pulls.extend(GraphQLPull(node) for node in result['nodes'] if node)
+        if not result['pageInfo']['hasNextPage']:
+            break
+        after = result['pageInfo']['endCursor']
+    return pulls[:MAX_SEARCH_RESULTS]
+
+
+def node_ids(gh_repo, pr_nbs: Iterable[int] = (), branches: Iterable[str] = ()) -> Dict[str, str]:
+    """
+    :return: the GraphQL ids the mutations need, by alias: `pr<number>` for
+             PRs and `ref<index in branches>` for branches, missing ones left out.
+    """
+    owner, name = gh_repo.full_name.split('/')
+    aliases = [f'pr{int(pr_nb)}: pullRequest(number: {int(pr_nb)}) {{ id }}' for pr_nb in pr_nbs]
+    aliases.extend(f'ref{idx}: ref(qualifiedName: {json.dumps("refs/heads/" + branch)}) {{ id }}'
+                   for idx, branch in enumerate(branches))
+    ids = {}
+    for start in range(0, len(aliases), BATCH_SIZE):
+        data = query(gh_repo, PULLS_QUERY.format(aliases='\n'.join(aliases[start:start + BATCH_SIZE])),
+                     {'owner': owner, 'name': name})
+        ids.update((alias, node['id']) for alias, node in (data.get('repository') or {}).items() if node)
+    return ids
+
+
+def mutate(gh_repo, mutations: Mapping[str, str]) -> Set[str]:
+    """
+    Run mutations, by alias, BATCH_SIZE per request.
+    :return: the aliases that failed.
+    """
+    aliases = list(mutations)
+    failed = set()
+    for start in range(0, len(aliases), BATCH_SIZE):
+        batch = aliases[start:start + BATCH_SIZE]
+        try:
+            data = query(gh_repo, MUTATION.format(aliases='\n'.join(f'{alias}: {mutations[alias]}'
+                                                                    for alias in batch)), {})
+        except Exception:
+            log.exception('Mutations failed on %s.', gh_repo.full_name)
+            data = {}
+        failed.update(alias for alias in batch if not data.get(alias))
+    return failed
+
+
+def retarget_pulls(gh_repo, bases: Mapping[int, str]) -> Set[int]:
+    """
+    Change the base branch of PRs.
+    :param bases: new base branch by PR number.
+    :return: the PRs that could not be changed.
+    """
+    ids = node_ids(gh_repo, pr_nbs=bases)
+    failed = {pr_nb for pr_nb in bases if f'pr{pr_nb}' not in ids}
+    mutations = {f'pr{pr_nb}': f'updatePullRequest(input: {{pullRequestId: {json.dumps(ids[f"pr{pr_nb}"])}, '
+                               f'baseRefName: {json.dumps(base)}}}) {{ clientMutationId }}'
+                 for pr_nb, base in bases.items() if pr_nb not in failed}
+    return failed | {int(alias[2:]) for alias in mutate(gh_repo, mutations)}
+
+
+def delete_branches(gh_repo, branches: List[str]) -> Set[str]:
+    """
+    :return: the branches that could not be deleted.
+    """
+    ids = node_ids(gh_repo, branches=branches)
+    mutations = {f'ref{idx}': f'deleteRef(input: {{refId: {json.dumps(ids[f"ref{idx}"])}}}) {{ clientMutationId }}'
+                 for idx in range(len(branches)) if f'ref{idx}' in ids}
+    failed = mutate(gh_repo, mutations) | {f'ref{idx}' for idx in range(len(branches)) if f'ref{idx}' not in ids}
+    return {branches[int(alias[3:])] for alias in failed}
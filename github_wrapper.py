@@ -12,11 +12,30 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import Dict, List, Mapping, Tuple
+import json
+import logging
+import random
+import re
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
 from github.GithubObject import NotSet
 from github.PullRequest import PullRequest
 from github.PullRequestMergeStatus import PullRequestMergeStatus
+from github.Requester import Requester
 from github import Github  ## Do not remove
 
+from tracing import span
+
+log = logging.getLogger(__name__)
+
 ## This monkeypatches pygithub.
 
 
@@ -90,8 +109,400 @@ def merge(self, commit_message=NotSet, commit_title=NotSet, sha=NotSet, merge_me
         self.url + "/merge",
         input=post_parameters
     )
-    return PullRequestMergeStatus(self._requester, headers, data,
-                                  completed=True)
+    return PullRequestMergeStatus(self._requester, headers, data)
 
 
 PullRequest.merge = merge
+
+
+## Transport used by every PyGithub request once install_transport() is called.
+
+POOL_SIZE = 32
+DEFAULT_TIMEOUT = 15
+# First match on (verb, path) wins.
+ENDPOINT_TIMEOUTS = (
+    ('PUT', re.compile(r'/pulls/\d+/merge$'), 60),
+    ('POST', re.compile(r'/merges$'), 60),
+    ('GET', re.compile(r'/pulls$'), 30),
+)
+MAX_RETRIES = 4
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+RETRY_STATUSES = (502, 503, 504)
+# POST is not safe to replay: a /merges that went through would come back as "nothing to merge".
+# Neither is PUT, the merge of a PR: the next check sees it merged if it went through.
+IDEMPOTENT_VERBS = ('GET', 'HEAD', 'PATCH', 'DELETE')
+
+# Outcome of every request and attempt done through the transport.
+transport_stats = Counter()
+_stats_lock = Lock()
+
+
+def count(outcome: str):
+    with _stats_lock:
+        transport_stats[outcome] += 1
+
+
+class ApiProfile:
+    """
+    Requests made by one thread through the transport, by endpoint.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(list)  # (verb, endpoint) -> [(seconds, bytes)]
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """
+        Path of a request without its owner, repo, numbers, SHAs and branches.
+        """
+        path = url.split('?', 1)[0]
+        path = re.sub(r'^/repos/[^/]+/[^/]+', '/repos/:repo', path)
+        path = re.sub(r'/(branches|git/refs)/.+$', r'/\1/:ref', path)
+        path = re.sub(r'/[0-9a-f]{40}(?=/|$)', '/:sha', path)
+        return re.sub(r'/\d+(?=/|$)', '/:number', path)
+
+    def record(self, verb: str, url: str, seconds: float, size: int):
+        self.calls[verb, self.endpoint(url)].append((seconds, size))
+
+    def total_bytes(self) -> int:
+        return sum(size for calls in self.calls.values() for _, size in calls)
+
+    def summary(self) -> List[Tuple[str, int, float, float, int]]:
+        """
+        :return: (endpoint, calls, total seconds, slowest call, bytes), most
+                 time spent first.
+        """
+        rows = [(f'{verb} {endpoint}', len(calls), sum(seconds for seconds, _ in calls),
+                 max(seconds for seconds, _ in calls), sum(size for _, size in calls))
+                for (verb, endpoint), calls in self.calls.items()]
+        return sorted(rows, key=lambda row: -row[2])
+
+
+_profiles = local()
+
+
+@contextmanager
+def profiling_api():
+    """
+    Record the requests made by the current thread in the block.
+    """
+    profile = _profiles.current = ApiProfile()
+    try:
+        yield profile
+    finally:
+        _profiles.current = None
+
+
+def endpoint_timeout(verb: str, url: str, default: float = None) -> float:
+    path = url.split('?', 1)[0]
+    for endpoint_verb, pattern, timeout in ENDPOINT_TIMEOUTS:
+        if verb == endpoint_verb and pattern.search(path):
+            return timeout
+    return default or DEFAULT_TIMEOUT
+
+
+def is_secondary_rate_limit(response: requests.Response) -> bool:
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403 or response.headers.get('X-RateLimit-Remaining') == '0':
+        return False  # the primary rate limit resets after up to an hour, no point waiting for it here
+    return 'Retry-After' in response.headers or 'secondary rate limit' in response.text.lower() \
+        or 'abuse' in response.text.lower()
+
+
+def backoff_delay(attempt: int, retry_after: str = None) -> float:
+    """
+    Jittered exponential backoff, or what the server asked for.
+    """
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(MAX_BACKOFF, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class TransportResponse:
+    """
+    Mimics the httplib response object expected by PyGithub.
+    """
+
+    def __init__(self, response: requests.Response):
+        self.status = response.status_code
+        self.headers = response.headers
+        self.response = response
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.response.text or ''
+
+    def iter_content(self, chunk_size=1):
+        return self.response.iter_content(chunk_size=chunk_size)
+
+
+class PooledHTTPSConnection:
+    """
+    Mimics the httplib connection object expected by PyGithub.
+
+    All the connections share one requests session so sockets are kept alive
+    and reused across calls, and failed calls are retried with backoff.
+    """
+    protocol = 'https'
+    default_port = 443
+    _session = None
+    _session_lock = Lock()
+
+    def __init__(self, host, port=None, strict=False, timeout=None, **kwargs):
+        self.host = host
+        self.port = port if port else self.default_port
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+
+    @classmethod
+    def session(cls) -> requests.Session:
+        with cls._session_lock:
+            if PooledHTTPSConnection._session is None:
+                session = requests.Session()
+                session.auth = lambda request: request  # PyGithub sends its own auth, don't look in .netrc
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                PooledHTTPSConnection._session = session
+            return PooledHTTPSConnection._session
+
+    def request(self, verb, url, input, headers, stream=False):
+        self.verb = verb
+        self.url = url
+        self.input = input
+        self.headers = headers
+        self.stream = stream
+
+    def send(self) -> requests.Response:
+        return self.session().request(self.verb, f'{self.protocol}://{self.host}:{self.port}{self.url}',
+                                      headers=self.headers, data=self.input, stream=self.stream,
+                                      timeout=endpoint_timeout(self.verb, self.url, self.timeout),
+                                      verify=self.verify, allow_redirects=False)
+
+    def getresponse(self) -> TransportResponse:
+        for attempt in range(MAX_RETRIES + 1):
+            last_attempt = attempt == MAX_RETRIES
+            try:
+                started = time.perf_counter()
+                with span('http', verb=self.verb, endpoint=ApiProfile.endpoint(self.url)) as http_span:
+                    response = self.send()
+                    http_span.set(status=response.status_code)
+                profile = getattr(_profiles, 'current', None)
+                if profile is not None:
+                    profile.record(self.verb, self.url, time.perf_counter() - started,
+                                   0 if self.stream else len(response.content))
+            except requests.Timeout:
+                count('timeout')
+                if last_attempt or self.verb not in IDEMPOTENT_VERBS:
+                    count('gave_up')
+                    raise
+                delay = backoff_delay(attempt)
+            except requests.ConnectionError:
+                count('connection_error')
+                if last_attempt or self.verb not in IDEMPOTENT_VERBS:
+                    count('gave_up')
+                    raise
+                delay = backoff_delay(attempt)
+            else:
+                if is_secondary_rate_limit(response):
+                    count('rate_limited')
+                    delay = backoff_delay(attempt, response.headers.get('Retry-After'))
+                    if last_attempt or delay > MAX_BACKOFF:
+                        count('gave_up')
+                        return TransportResponse(response)
+                elif response.status_code in RETRY_STATUSES:
+                    count('server_error')
+                    if last_attempt or self.verb not in IDEMPOTENT_VERBS:
+                        count('gave_up')
+                        return TransportResponse(response)
+                    delay = backoff_delay(attempt, response.headers.get('Retry-After'))
+                else:
+                    count('client_error' if response.status_code >= 400 else 'success')
+                    return TransportResponse(response)
+            count('retried')
+            log.info('%s %s failed (attempt %d), retrying in %.1fs.', self.verb, self.url, attempt + 1, delay)
+            self.wait(delay)
+
+    def wait(self, delay: float):
+        time.sleep(delay)
+
+    def close(self):
+        pass  # the session is shared
+
+
+class PooledHTTPConnection(PooledHTTPSConnection):
+    protocol = 'http'
+    default_port = 80
+
+
+def install_transport(pool_size: int = POOL_SIZE):
+    """
+    Route every PyGithub request through the pooled, retrying transport.
+    """
+    global POOL_SIZE
+    POOL_SIZE = pool_size
+    Requester.injectConnectionClasses(PooledHTTPConnection, PooledHTTPSConnection)
+
+
+def transport_status() -> str:
+    with _stats_lock:
+        outcomes = ', '.join(f'{outcome}: {nb}' for outcome, nb in sorted(transport_stats.items()))
+    return f'GitHub requests - {outcomes or "none yet"}.'
+
+
+## Record/replay of the GitHub traffic, to reproduce and benchmark cycles offline.
+
+class CassetteMismatch(Exception):
+    pass
+
+
+class Cassette:
+    """
+    Sequence of the HTTP exchanges done with GitHub, stored as JSON lines
+    after a first line of free form metadata.
+    """
+
+    def __init__(self, interactions: List[Dict] = None, meta: Mapping = None):
+        self.interactions = interactions if interactions else []
+        self.meta = dict(meta) if meta else {}
+        self.lock = Lock()
+        self.pending = None
+
+    def record(self, interaction: Dict):
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            f.write(json.dumps({'meta': self.meta}) + '\n')
+            for interaction in self.interactions:
+                f.write(json.dumps(interaction) + '\n')
+
+    @classmethod
+    def load(cls, path: str) -> 'Cassette':
+        with open(path) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        meta = lines.pop(0)['meta'] if lines and 'meta' in lines[0] else {}
+        return cls(lines, meta)
+
+    def rewind(self):
+        """
+        Start serving the recorded answers from the beginning again.
+        """
+        with self.lock:
+            self.pending = None
+
+    def next_for(self, verb: str, url: str, repeat: bool) -> Dict:
+        """
+        Next recorded answer to this request. Requests are matched in order for
+        each verb and url, so concurrent rooms do not need to replay in the
+        exact same interleaving.
+        """
+        with self.lock:
+            if self.pending is None:
+                self.pending = defaultdict(deque)
+                for interaction in self.interactions:
+                    self.pending[(interaction['verb'], interaction['url'])].append(interaction)
+            answers = self.pending.get((verb, url))
+            if not answers:
+                raise CassetteMismatch(f'No recorded answer left for {verb} {url}')
+            if repeat and len(answers) == 1:
+                return answers[0]  # keep serving the last state for benchmarks looping over the cassette
+            return answers.popleft()
+
+
+class RecordingHTTPSConnection(PooledHTTPSConnection):
+    """
+    Real connection that also writes every attempt into a cassette.
+    """
+    cassette: Cassette = None
+
+    def send(self) -> requests.Response:
+        start = time.monotonic()
+        response = super().send()
+        self.cassette.record({
+            'verb': self.verb,
+            'url': self.url,
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'body': response.text,
+            'latency': time.monotonic() - start,
+        })
+        return response
+
+
+class RecordingHTTPConnection(RecordingHTTPSConnection):
+    protocol = 'http'
+    default_port = 80
+
+
+class ReplayingHTTPSConnection(PooledHTTPSConnection):
+    """
+    Serves the answers of a cassette instead of calling GitHub.
+    """
+    cassette: Cassette = None
+    latency_factor = 0.0
+    repeat = False
+
+    def send(self) -> requests.Response:
+        interaction = self.cassette.next_for(self.verb, self.url, self.repeat)
+        if self.latency_factor:
+            time.sleep(interaction['latency'] * self.latency_factor)
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response.headers.pop('Content-Encoding', None)  # the body was stored decoded
+        response._content = interaction['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = self.url
+        return response
+
+    def wait(self, delay: float):
+        if self.latency_factor:
+            super().wait(delay * self.latency_factor)
+
+
+class ReplayingHTTPConnection(ReplayingHTTPSConnection):
+    protocol = 'http'
+    default_port = 80
+
+
+@contextmanager
+def recording(path: str, meta: Mapping = None):
+    """
+    Record the GitHub traffic made inside this block into a cassette file.
+    The traffic of the asyncio engine is not captured.
+    """
+    cassette = Cassette(meta=meta)
+    RecordingHTTPSConnection.cassette = cassette
+    Requester.injectConnectionClasses(RecordingHTTPConnection, RecordingHTTPSConnection)
+    try:
+        yield cassette
+    finally:
+        Requester.injectConnectionClasses(PooledHTTPConnection, PooledHTTPSConnection)
+        cassette.save(path)
+
+
+@contextmanager
+def replaying(path: str, latency_factor: float = 0.0, repeat: bool = False):
+    """
+    Answer the GitHub requests made inside this block from a cassette file.
+    :param latency_factor: 0 answers immediately, 1 waits as long as when it was recorded.
+    :param repeat: keep answering with the last recorded state once a request is exhausted.
+    """
+    cassette = Cassette.load(path)
+    ReplayingHTTPSConnection.cassette = cassette
+    ReplayingHTTPSConnection.latency_factor = latency_factor
+    ReplayingHTTPSConnection.repeat = repeat
+    Requester.injectConnectionClasses(ReplayingHTTPConnection, ReplayingHTTPSConnection)
+    try:
+        yield cassette
+    finally:
+        Requester.injectConnectionClasses(PooledHTTPConnection, PooledHTTPSConnection)
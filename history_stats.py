@@ -0,0 +1,64 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Stats implementation keeping the history in a local file for report.py"""
+from threading import Lock
+import json
+import os
+import time
+
+from pr import PR, DEFAULT_LANE
+from stats import BaseStat
+
+
+def history_path(data_dir: str, name: str) -> str:
+    """
+    The file a room keeps its history in, under the data directory of the bot.
+    :raise ValueError: for an absolute path or one leaving the directory.
+    """
+    if os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+        raise ValueError(f'{name} needs to be a relative path in the data directory of the bot')
+    return os.path.join(data_dir, name)
+
+
+def pr_repo(pr: PR) -> str:
+    """owner/repo from the URL of the PR."""
+    return '/'.join(pr.url.split('/')[-4:-2]) if pr.url else ''
+
+
+class Stats(BaseStat):
+    """
+    Append the events and metrics as JSON lines, the "api key" is the path of
+    the file, relative to data_dir when it is given.
+    """
+
+    def __init__(self, api_key: str, data_dir: str = None) -> None:
+        super().__init__(api_key)
+        self.path = history_path(data_dir, api_key) if data_dir else api_key
+        self.lock = Lock()
+
+    def write(self, kind: str, name: str, value: float, pr: PR) -> None:
+        line = json.dumps({'time': time.time(), 'kind': kind, 'name': name, 'value': value, 'repo': pr_repo(pr),
+                           'pr': pr.nb, 'base': pr.base, 'lane': getattr(pr, 'lane', DEFAULT_LANE)})
+        with self.lock:
+            with open(self.path, 'a') as history:
+                history.write(line + '\n')
+
+    def send_event(self, event_type: str, pr: PR) -> None:
+        """Record the event with how long the PR has been queued."""
+        self.write('event', event_type, pr.get_queue_time(), pr)
+
+    def send_metric(self, metric_name: str, metric_value: float, pr: PR) -> None:
+        """Record the metric."""
+        self.write('metric', metric_name, metric_value, pr)
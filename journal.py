@@ -0,0 +1,235 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Append-only journal of the changes made to a merge queue.
+
+Every mutation of a queue and every transition of its PRs is appended as a
+JSON line. Lines are fsync'ed by batches, and right away before the writes
+GitHub cannot undo (merges and pulls). From time to time the journal is
+compacted into a snapshot of the queue. On startup the snapshot and the tail
+of the journal give back the queue as it was when the bot stopped, without
+asking GitHub. Every save of the queue in the storage is recorded too, only
+the changes made since the last one are applied over the storage.
+"""
+from threading import RLock
+from typing import Any, List, Mapping, Optional, Tuple
+import json
+import logging
+import os
+import time
+
+from pr import PR, PRTransitionParams
+
+log = logging.getLogger(__name__)
+
+# Records written before they are fsync'ed in any case.
+SYNC_EVERY = 64
+# Seconds after which pending records are fsync'ed with the next record.
+SYNC_INTERVAL = 1.0
+# Records after which the journal is worth compacting into a snapshot.
+COMPACT_EVERY = 1000
+
+
+class NoJournal:
+    """
+    Used when the queue is not journaled.
+    """
+    seq = 0
+    # PRs the replayed journal was merging, nobody knows if the merge went through.
+    merging = frozenset()
+
+    def record(self, op: str, **data: Any):
+        pass
+
+    def sync(self):
+        pass
+
+    def saved(self, seq: int):
+        pass
+
+
+class Journal(NoJournal):
+    """
+    Journal of one queue: `<prefix>.journal` and `<prefix>.snapshot`.
+    """
+
+    def __init__(self, prefix: str, sync_every: int = SYNC_EVERY, sync_interval: float = SYNC_INTERVAL,
+                 compact_every: int = COMPACT_EVERY):
+        self.journal_path = prefix + '.journal'
+        self.snapshot_path = prefix + '.snapshot'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.seq = 0
+        self.saved_seq: Optional[int] = None  # last record the storage has, None if unknown
+        self.merging = set()
+        self.since_compaction = 0
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.file = None
+        self.deleted = False
+        # Commands and checks record from different threads.
+        self.lock = RLock()
+
+    def record(self, op: str, **data: Any):
+        with self.lock:
+            if self.deleted:  # a check still running on a dropped queue
+                return
+            if self.file is None:
+                self.file = open(self.journal_path, 'a')
+            self.seq += 1
+            self.since_compaction += 1
+            self.file.write(json.dumps(dict(data, seq=self.seq, op=op, time=time.time()), default=str) + '\n')
+            self.pending += 1
+            if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.file is None or not self.pending:
+                return
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = 0
+            self.last_sync = time.monotonic()
+
+    def saved(self, seq: int):
+        """
+        Record that the storage has the queue as of the record seq.
+        """
+        with self.lock:
+            self.saved_seq = seq
+            self.record('saved', upto=seq)
+            self.sync()
+
+    def needs_compaction(self) -> bool:
+        return self.since_compaction >= self.compact_every
+
+    def compact(self, queue: List[PR], pulled_prs: List[int]):
+        """
+        Write a snapshot of the queue and start an empty journal.
+        """
+        with self.lock:
+            self.write_snapshot(queue, pulled_prs)
+
+    def write_snapshot(self, queue: List[PR], pulled_prs: List[int]):
+        self.sync()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as snapshot:
+            json.dump({'seq': self.seq, 'saved': self.saved_seq, 'queue': [pr.to_state() for pr in queue],
+                       'pulled_prs': list(pulled_prs)}, snapshot, default=str)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # The snapshot has the sequence number: a crash before the truncation
+        # only leaves records that will be skipped.
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, 'w')
+        self.since_compaction = 0
+
+    def replay(self, stored_queue: List[PR] = None,
+               stored_pulled_prs: List[int] = None) -> Optional[Tuple[List[PR], List[int]]]:
+        """
+        :param stored_queue: the queue from the storage, the changes it
+                             already has are not applied again.
+        :return: the queue and the pulled PRs from the snapshot or the
+                 storage and the journal, None if there is nothing more than
+                 in the storage.
+        """
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path) as snapshot:
+            state = json.load(snapshot)
+        self.seq = state['seq']
+        records = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        log.warning('Ignoring the torn end of %s.', self.journal_path)
+                        break
+                    if record['seq'] > self.seq:
+                        records.append(record)
+        saved = max([state.get('saved') or 0] + [record['upto'] for record in records if record['op'] == 'saved'])
+        # Unless the snapshot is newer than the storage, or how they compare is unknown.
+        from_storage = stored_queue is not None and saved and state['seq'] <= saved
+        if from_storage:
+            start = saved
+            queue, pulled_prs = list(stored_queue), list(stored_pulled_prs or [])
+        else:
+            start = state['seq']
+            queue = [PR.from_state(pr_state) for pr_state in state['queue']]
+            pulled_prs = list(state['pulled_prs'])
+        self.saved_seq = saved or None
+        replayed = 0
+        for record in records:
+            self.seq = record['seq']
+            if record['op'] == 'transition' and any(name == 'MERGING' for name, _ in record['states']):
+                self.merging.add(record['nb'])  # checked again even if the storage has it
+            elif record['op'] == 'remove':
+                self.merging.discard(record['nb'])
+            if record['seq'] > start and record['op'] != 'saved':
+                queue, pulled_prs = self.apply(record, queue, pulled_prs)
+                replayed += 1
+        self.since_compaction = len(records)
+        if from_storage and not replayed:
+            return None
+        log.info('Rebuilt %s from its %s and %d journaled changes.', self.journal_path,
+                 'storage' if from_storage else 'snapshot', replayed)
+        return queue, pulled_prs
+
+    @staticmethod
+    def apply(record: Mapping, queue: List[PR], pulled_prs: List[int]) -> Tuple[List[PR], List[int]]:
+        op = record['op']
+        if op == 'put':
+            pr = PR.from_state(record['pr'])
+            if pr.nb in queue:
+                queue[queue.index(pr.nb)] = pr
+            else:
+                queue.append(pr)
+        elif op == 'remove':
+            queue = [pr for pr in queue if pr.nb != record['nb']]
+        elif op == 'order':
+            by_nb = {pr.nb: pr for pr in queue}
+            queue = [by_nb[nb] for nb in record['nbs'] if nb in by_nb]
+        elif op == 'pulled':
+            pulled_prs = list(record['nbs'])
+        # 'transition' records tell what happened, replay() picks the merges
+        # in flight from them. 'saved' ones tell what the storage has.
+        return queue, pulled_prs
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def delete(self):
+        """
+        Close the journal and remove its files, for a queue that is dropped.
+        """
+        with self.lock:
+            self.close()
+            self.deleted = True
+            for path in (self.journal_path, self.snapshot_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def transition_record(new_states: List[PRTransitionParams]) -> List:
+    return [[state.name, params] for state, params in new_states]
@@ -0,0 +1,198 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Room ownership for running several bot instances side by side.
+
+The instances heartbeat in a shared SQLite file and split the rooms with
+rendezvous hashing over the live ones: when an instance joins or leaves
+only the rooms it wins or held move. A room is only checked by the holder of
+its lease, and the lease is checked again right before merging (fencing) so
+that an instance which stalled past its lease cannot merge behind the back
+of the new owner.
+"""
+from contextlib import contextmanager
+from hashlib import sha1
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Set
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds an instance or a lease stays valid without being renewed. The
+# instances renew them every check cycle so it needs to be well above it.
+LEASE_TTL = 360
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (instance TEXT PRIMARY KEY, heartbeat REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (room TEXT PRIMARY KEY, owner TEXT, expires REAL NOT NULL,
+                                   token INTEGER NOT NULL);
+"""
+
+
+def default_instance_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class LeaseStore:
+    """
+    Members and leases kept in a SQLite file shared by the instances.
+    """
+
+    def __init__(self, path: str):
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction, taken before reading so two instances cannot both
+        grab the same lease.
+        """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def heartbeat(self, instance: str, now: float):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO members (instance, heartbeat) VALUES (?, ?)', (instance, now))
+
+    def leave(self, instance: str):
+        with self.transaction() as db:
+            db.execute('DELETE FROM members WHERE instance = ?', (instance,))
+            db.execute('UPDATE leases SET owner = NULL, expires = 0 WHERE owner = ?', (instance,))
+
+    def live_members(self, now: float, ttl: float) -> List[str]:
+        with self.lock:
+            rows = self.db.execute('SELECT instance FROM members WHERE heartbeat > ? ORDER BY instance',
+                                   (now - ttl,)).fetchall()
+        return [instance for instance, in rows]
+
+    def acquire(self, room: str, instance: str, now: float, ttl: float) -> Optional[int]:
+        """
+        Take or renew the lease of a room if it is free, expired or already
+        ours.
+        :return: the fencing token of the lease, None if someone else holds it.
+        """
+        with self.transaction() as db:
+            row = db.execute('SELECT owner, expires, token FROM leases WHERE room = ?', (room,)).fetchone()
+            if row is None:
+                db.execute('INSERT INTO leases (room, owner, expires, token) VALUES (?, ?, ?, 1)',
+                           (room, instance, now + ttl))
+                return 1
+            owner, expires, token = row
+            if owner == instance:
+                db.execute('UPDATE leases SET expires = ? WHERE room = ?', (now + ttl, room))
+                return token
+            if owner is not None and expires > now:
+                return None
+            db.execute('UPDATE leases SET owner = ?, expires = ?, token = ? WHERE room = ?',
+                       (instance, now + ttl, token + 1, room))
+            return token + 1
+
+    def release(self, room: str, instance: str):
+        with self.transaction() as db:
+            db.execute('UPDATE leases SET owner = NULL, expires = 0 WHERE room = ? AND owner = ?', (room, instance))
+
+    def holds(self, room: str, instance: str, token: int, now: float) -> bool:
+        with self.lock:
+            row = self.db.execute('SELECT owner, expires, token FROM leases WHERE room = ?', (room,)).fetchone()
+        return row is not None and row[0] == instance and row[2] == token and row[1] > now
+
+    def owners(self) -> Dict[str, Optional[str]]:
+        with self.lock:
+            return dict(self.db.execute('SELECT room, owner FROM leases').fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+class Sharder:
+    """
+    Decides which rooms this instance checks.
+    """
+
+    def __init__(self, store: LeaseStore, instance: str = None, ttl: float = LEASE_TTL,
+                 clock: Callable[[], float] = time.time):
+        self.store = store
+        self.instance = instance or default_instance_id()
+        self.ttl = ttl
+        self.clock = clock
+        self.tokens: Dict[str, int] = {}  # room -> fencing token of the leases we hold
+
+    @staticmethod
+    def owner_of(room: str, members: Iterable[str]) -> Optional[str]:
+        """
+        Rendezvous hashing: the member with the highest score for the room.
+        """
+        return max(members, key=lambda member: sha1(f'{member}\n{room}'.encode()).digest(), default=None)
+
+    def rebalance(self, rooms: Iterable[str]) -> Set[str]:
+        """
+        Heartbeat, hand over the rooms another live instance should own and
+        take the ones we should own once they are free.
+        :return: the rooms this instance holds the lease of.
+        """
+        rooms = list(rooms)
+        now = self.clock()
+        self.store.heartbeat(self.instance, now)
+        members = self.store.live_members(now, self.ttl)
+        for room in set(self.tokens) - set(rooms):  # deconfigured
+            self.store.release(room, self.instance)
+            del self.tokens[room]
+        for room in rooms:
+            if self.owner_of(room, members) == self.instance:
+                token = self.store.acquire(room, self.instance, now, self.ttl)
+                if token is None:
+                    self.tokens.pop(room, None)
+                    log.info('Waiting for the lease of %s to be handed over.', room)
+                else:
+                    self.tokens[room] = token
+            elif room in self.tokens:
+                log.info('Handing %s over to another instance.', room)
+                self.store.release(room, self.instance)
+                del self.tokens[room]
+        return set(self.tokens)
+
+    def owns(self, room: str) -> bool:
+        """
+        Fencing check, to call right before a write GitHub cannot undo.
+        """
+        token = self.tokens.get(room)
+        return token is not None and self.store.holds(room, self.instance, token, self.clock())
+
+    def elected(self, room: str) -> bool:
+        """
+        If this instance is the live one a room goes to, for the rooms no
+        lease was taken for yet.
+        """
+        return self.owner_of(room, self.store.live_members(self.clock(), self.ttl)) == self.instance
+
+    def stop(self):
+        """
+        Leave the group, the other instances take over the rooms at their next
+        rebalance.
+        """
+        self.store.leave(self.instance)
+        self.tokens.clear()
@@ -0,0 +1,246 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+End-to-end load test of the plugin against a local fake GitHub: the Summit
+plugin checks hundreds of rooms with `check_pr_states` through PyGithub, the
+github_wrapper transport and, with `--engine async`, the asyncio engine, as in
+production, only the chat is stubbed out.
+
+    python load_test.py --rooms 300 --prs 10 --cycles 5 --latency 0.02 --error-rate 0.01
+
+Every room queues its own repository. Most of its PRs are approved and
+behind their base so they get pulled, CI runs for one tick and they are
+merged; every fifth one gets its approval a few ticks later and every
+seventh one is chained on the previous one.
+"""
+from collections import Counter, OrderedDict
+from threading import Lock
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+import argparse
+import logging
+import random
+import statistics
+import tempfile
+import time
+
+from errbot.backends.base import Identifier
+from errbot.storage.base import StoragePluginBase
+from errbot.storage.memory import MemoryStorage
+
+from fake_github import FakeGitHub
+from github_wrapper import Github, transport_status
+from main import Repo, Summit
+
+TOKEN = 'load-test'
+OWNER = 'load-test'
+# Calls listed in the report.
+TOP = 15
+
+
+class LoadIdentifier(Identifier):
+    def __init__(self, name: str):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class LoadStoragePlugin(StoragePluginBase):
+    def open(self, namespace: str) -> MemoryStorage:
+        storage = MemoryStorage(namespace)
+        storage.root = {}  # nothing left from a previous run in this process
+        return storage
+
+
+class LoadBot:
+    """
+    The parts of the errbot bot the plugin talks to, messages are counted
+    instead of sent.
+    """
+
+    def __init__(self, data_dir: str):
+        self.bot_config = SimpleNamespace(BOT_DATA_DIR=data_dir, BOT_ADMINS=())
+        self.repo_manager = SimpleNamespace(plugin_dir=data_dir)
+        self.plugin_manager = SimpleNamespace(get_plugin_obj_by_name=lambda name: None)
+        self.storage_plugin = LoadStoragePlugin(self.bot_config)
+        self.lock = Lock()
+        self.sent = Counter()  # recipient -> messages
+
+    def inject_commands_from(self, plugin):
+        pass
+
+    inject_command_filters_from = remove_commands_from = remove_command_filters_from = inject_commands_from
+
+    def build_identifier(self, text: str) -> LoadIdentifier:
+        return LoadIdentifier(text)
+
+    def send(self, identifier, text, in_reply_to=None, groupchat_nick_reply=False):
+        with self.lock:
+            self.sent[str(identifier)] += 1
+
+
+class LoadSummit(Summit):
+    """
+    The plugin, polled by the load test instead of its timer.
+    :param pacing: keep the 0.25s PyGithub waits between two requests.
+    """
+    pacing = False
+
+    def start_poller(self, interval, method, times=None, args=None, kwargs=None):
+        pass
+
+    def activate(self):
+        super().activate()
+        if not self.pacing:
+            self.gh = Github(self.config['github-token'], base_url=self.config['github-url'],
+                             seconds_between_requests=None, seconds_between_writes=None)
+
+
+def populate(fake: FakeGitHub, rooms: int, prs: int) -> Dict[str, str]:
+    """
+    :return: repository by room.
+    """
+    repos = {}
+    for room_idx in range(rooms):
+        repo = f'load/repo{room_idx}'
+        fake.add_repo(repo)
+        for nb in range(1, prs + 1):
+            base = f'change-{nb - 1}' if nb % 7 == 0 else None
+            approved_by = () if nb % 5 == 0 else ('reviewer',)
+            fake.add_pull(repo, nb, base=base, approved_by=approved_by, behind=base is None)
+            if not approved_by:
+                fake.at(nb % 3 + 1, lambda fake, repo=repo, nb=nb: fake.review(repo, nb, 'reviewer'))
+        repos[f'#room{room_idx}'] = repo
+    return repos
+
+
+def configure_rooms(summit: Summit, repos: Dict[str, str], pr_nbs: List[int]):
+    """
+    What `!merge config` and `!merge add` do, for every room.
+    """
+    for room, repo in repos.items():
+        merge_queue = summit.new_merge_queue(room, repo, replay=False, gh_repo=summit.gh.get_repo(repo))
+        with summit.rooms_lock:
+            summit.store.put_room(room, Repo(name=repo, owner=OWNER, queue=[], saints=[OWNER]))
+            summit.queues[room] = OrderedDict([(repo, merge_queue)])
+        prs, _ = merge_queue.fetch_prs(pr_nbs)
+        merge_queue.add_prs(prs)
+        for pr in prs:
+            merge_queue.bless_pr(pr.nb)
+        summit.save_queue(room)
+
+
+def run(rooms: int = 100, prs: int = 10, cycles: int = 5, engine: str = 'sync', budget: Optional[int] = None,
+        pacing: bool = False, push_rate: float = 0.0, seed: int = 0, state_store: str = None, **fake_options) -> Dict:
+    """
+    Configure the rooms, then run check cycles, the fake GitHub ticking in
+    between.
+    :param push_rate: chance a repository gets a commit on its base branch between two cycles.
+    :param fake_options: FakeGitHub settings (latency, error_rate, ...).
+    :return: what happened, see format_results().
+    """
+    rng = random.Random(seed)
+    # Faults are injected once the rooms are set up, the set up is not what is measured.
+    faults = {name: fake_options.pop(name) for name in ('error_rate', 'secondary_rate_limit', 'conflict_rate')
+              if name in fake_options}
+    fake = FakeGitHub(seed=seed, **fake_options).start()
+    bot = LoadBot(tempfile.mkdtemp(prefix='merge-load-'))
+    summit = LoadSummit(bot, 'Summit')
+    summit.pacing = pacing
+    summit.configure({'github-token': TOKEN, 'github-url': fake.url, 'check-engine': engine,
+                      'state-store': state_store})
+    results = {'rooms': rooms, 'prs': rooms * prs, 'engine': engine, 'cycles': []}
+    try:
+        summit.activate()
+        repos = populate(fake, rooms, prs)
+        start, requests = time.perf_counter(), fake.request_count()
+        configure_rooms(summit, repos, list(range(1, prs + 1)))
+        results['setup'] = (time.perf_counter() - start, fake.request_count() - requests)
+        for name, value in faults.items():
+            setattr(fake, name, value)
+        for _ in range(cycles):
+            start, requests, merged = time.perf_counter(), fake.request_count(), fake.merged_count()
+            summit.check_pr_states(budget)
+            results['cycles'].append((time.perf_counter() - start, fake.request_count() - requests,
+                                      fake.merged_count() - merged))
+            fake.tick()
+            for repo in repos.values():
+                if rng.random() < push_rate:
+                    fake.push(repo, 'master')
+    finally:
+        summit.deactivate()
+        fake.stop()
+    results['queued'] = sum(len(merge_queue.get_queue()) for queues in summit.queues.values()
+                            for merge_queue in queues.values())
+    results['calls'] = fake.calls
+    results['injected'] = fake.injected
+    results['messages'] = sum(bot.sent.values())
+    return results
+
+
+def format_results(results: Dict) -> str:
+    setup_seconds, setup_requests = results['setup']
+    lines = [f'{results["rooms"]} rooms, {results["prs"]} PRs, {results["engine"]} engine: set up in '
+             f'{setup_seconds:.2f}s with {setup_requests} requests.', '',
+             'cycle  seconds  requests  merged']
+    lines.extend(f'{idx:5d} {seconds:8.2f} {requests:9d} {merged:7d}'
+                 for idx, (seconds, requests, merged) in enumerate(results['cycles'], 1))
+    seconds = [seconds for seconds, _, _ in results['cycles']]
+    if seconds:
+        lines.append(f'median cycle {statistics.median(seconds):.2f}s, slowest {max(seconds):.2f}s.')
+    lines.extend(['', 'requests  endpoint'])
+    lines.extend(f'{calls:8d}  {endpoint}' for endpoint, calls in results['calls'].most_common(TOP))
+    injected = ', '.join(f'{failure}: {nb}' for failure, nb in sorted(results['injected'].items()))
+    lines.extend(['', f'Injected - {injected or "nothing"}.', transport_status(),
+                  f'{results["messages"]} messages sent, {results["queued"]} PRs still queued.'])
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Check many rooms against a local fake GitHub.')
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--prs', type=int, default=10, help='PRs queued per room')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--engine', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--budget', type=int, help='PRs refreshed per repository and cycle, from the rate limit '
+                                                   'by default')
+    parser.add_argument('--pacing', action='store_true', help='Keep the 0.25s PyGithub waits between requests')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every request takes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of the requests failing with a 502')
+    parser.add_argument('--secondary-rate-limit', type=float, default=0.0,
+                        help='Share of the requests hitting a secondary rate limit')
+    parser.add_argument('--retry-after', type=float, default=0.0, help='Seconds asked on secondary rate limits')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='Requests allowed per hour')
+    parser.add_argument('--ci-failure-rate', type=float, default=0.0)
+    parser.add_argument('--conflict-rate', type=float, default=0.0)
+    parser.add_argument('--push-rate', type=float, default=0.0,
+                        help='Chance a repository gets a commit on master between two cycles')
+    parser.add_argument('--state-store', help='SQLite file to keep the rooms in, the plugin storage by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='Log the failures of the plugin')
+    args = parser.parse_args(argv)
+    # Under injected faults the plugin logs a traceback per PR it could not refresh.
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.CRITICAL)
+    results = run(args.rooms, args.prs, args.cycles, engine=args.engine, budget=args.budget, pacing=args.pacing,
+                  push_rate=args.push_rate, seed=args.seed, state_store=args.state_store, latency=args.latency,
+                  error_rate=args.error_rate, secondary_rate_limit=args.secondary_rate_limit,
+                  retry_after=args.retry_after, rate_limit=args.rate_limit,
+                  ci_failure_rate=args.ci_failure_rate, conflict_rate=args.conflict_rate)
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
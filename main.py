@@ -12,15 +12,34 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-from threading import RLock
-
+from collections import OrderedDict
+from threading import Lock, RLock, Timer
+import os
+import re
+import time
+from typing import Callable, Dict, Hashable, List, Mapping, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+from functools import partial
 from importlib import import_module
 from types import SimpleNamespace
 
 from errbot import botcmd, BotPlugin, arg_botcmd
 from errbot.backends.base import Identifier
-from github_wrapper import Github
-from mergequeue import PRTransition, MergeQueue
+from async_engine import AsyncCheckEngine
+from dispatcher import MessageDispatcher
+from github_wrapper import Github, install_transport, recording, transport_status
+from autodepth import DepthTuner
+from journal import Journal
+from leases import LeaseStore, Sharder
+from mergequeue import PRTransition, MergeQueue, LANES
+from pr import DEFAULT_LANE
+from profiling import profile_check
+import tracing
+from tracing import span
+import report
+from snapshot import SnapshotService
+from state_store import BotStorageStateStore, SQLiteStateStore, new_room, room_repos
 
 
 class Repo:
@@ -28,16 +47,66 @@ class Repo:
     Hook to ensure backward compatibility.
     """
     def __new__(cls, name, owner, queue=None, saints=None, pulled_prs=None):
-        obj = SimpleNamespace()
-        obj.name = name
-        obj.owner = owner
-        obj.queue = queue if queue else []
-        obj.saints = saints if saints else []
-        obj.pulled_prs = pulled_prs if pulled_prs else []
-        return obj
+        return new_room(name, owner, queue, saints, pulled_prs)
+
+
+def parse_pr_ref(pr_ref: str) -> Tuple[Optional[str], int]:
+    """
+    Parse 123, #123, repo#123 or owner/repo#123.
+    :return: the repository hint, if any, and the PR number.
+    """
+    match = re.fullmatch(r'(?:([\w.-]+(?:/[\w.-]+)?)#|#)?(\d+)', pr_ref.strip())
+    if not match:
+        raise ValueError(f'Cannot convert {pr_ref} to a PR number')
+    return match.group(1), int(match.group(2))
+
+
+CONFIG_TEMPLATE = {
+    'github-token': '4efefefe4effe4efeeeef4e',
+    # Root of the GitHub API, 'https://github.example.com/api/v3' for GitHub
+    # Enterprise (or the url of a fake_github.FakeGitHub for load tests).
+    'github-url': 'https://api.github.com',
+    # 'sync' checks the rooms one after the other with PyGithub, 'async'
+    # prefetches all of them concurrently (requires aiohttp).
+    'check-engine': 'sync',
+    # Maximum number of kept alive connections to GitHub.
+    'github-pool-size': 32,
+    # SQLite file shared by several instances of the bot to split the rooms
+    # between them, None to check all the rooms from this instance.
+    'shard-store': None,
+    # Name of this instance among the ones sharing the shard store, defaults to host:pid.
+    'instance-id': None,
+    # SQLite file to keep the rooms in instead of the errbot storage, the
+    # rooms are copied there the first time.
+    'state-store': None,
+    # Directory of the journals of the queues, to get their exact state back
+    # after a crash. None to not journal them.
+    'journal-dir': None,
+    # Only refresh the PRs updated since the previous check (and the blessed
+    # and pulled ones), the others keep their last known state.
+    'incremental-check': False,
+    # Where to export the spans of the checks: 'jsonl:/path/to/spans.jsonl',
+    # 'otlp:/path/to/traces.json' or 'otlp:http://collector:4318/v1/traces'.
+    # None to not trace.
+    'trace-exporter': None,
+}
+
+# Seconds to wait before asking again about PRs GitHub is computing the mergeability of.
+RECHECK_DELAYS = (5, 10, 20, 40)
 
+# Number of PRs per message when listing a queue.
+PAGE_SIZE = 20
+# Rendered PRs kept per queue before the cache is flushed.
+MAX_RENDER_CACHE = 1024
+# Times a command is retried when the PR changes while it is being fetched.
+COMMAND_ATTEMPTS = 3
 
-ROOMS = 'rooms'
+# Seconds between two checks of all the rooms.
+POLL_INTERVAL = 120
+# Rough number of GitHub calls needed to refresh one PR.
+CALLS_PER_PR = 3
+# Minimum number of PRs refreshed per repository and cycle, whatever the rate limit.
+MIN_PRS_PER_CYCLE = 3
 
 # Feedback to send to chat when a PR changed state.
 PR_MSG = {
@@ -90,6 +159,12 @@ PUBLIC_STATE_FEEDBACK = (
 )
 
 
+class NotOwner(Exception):
+    """
+    The room is handled by another instance of the bot, which answers instead.
+    """
+
+
 class Summit(BotPlugin):
     """
     This is a merge queue for Github.
@@ -97,7 +172,16 @@ class Summit(BotPlugin):
     def get_configuration_template(self):
         """
         Get configuration template for this plugin."""
-        return {'github-token': '4efefefe4effe4efeeeef4e', }
+        return dict(CONFIG_TEMPLATE)
+
+    def check_configuration(self, configuration):
+        # Configurations from older versions only have some of the keys.
+        super(Summit, self).check_configuration(dict(CONFIG_TEMPLATE, **configuration))
+
+    def configure(self, configuration):
+        if configuration:
+            configuration = dict(CONFIG_TEMPLATE, **configuration)
+        super(Summit, self).configure(configuration)
 
     def activate(self):
         super(Summit, self).activate()
@@ -105,11 +189,31 @@ class Summit(BotPlugin):
             # ie. if the plugin is not configured, it cannot activate.
             return
 
-        if ROOMS not in self:
-            self[ROOMS] = {}
-        self.gh = Github(self.config['github-token'], api_preview=True)
-        self.queues = {}  # Those are MergeQueues
-        self.rooms_lock = RLock()
+        self.store = BotStorageStateStore(self)
+        if self.config['state-store']:
+            store = SQLiteStateStore(self.config['state-store'])
+            store.migrate_from(self.store)
+            self.store = store
+        install_transport(self.config['github-pool-size'])
+        tracing.configure(tracing.exporter_from_config(self.config['trace-exporter']))
+        self.gh = Github(self.config['github-token'], base_url=self.config['github-url'])
+        self.queues = {}  # room -> OrderedDict of repository name -> MergeQueue
+        self.cycle = 0  # number of check cycles, rotates which repository goes first
+        self.rooms_lock = RLock()  # configuration of the rooms, never held while talking to GitHub
+        self.check_lock = Lock()  # one check cycle or recheck at a time
+        self.render_cache = WeakKeyDictionary()  # MergeQueue -> rendered PRs
+        self.depth_tuners = WeakKeyDictionary()  # MergeQueue -> DepthTuner of the queues with an automatic depth
+        self.rechecks = {}  # room -> Timer of the pending recheck
+        self.snapshots = SnapshotService()  # reads shared by the rooms queuing the same repo
+        self.dispatcher = MessageDispatcher(self.send)
+        self.dispatcher.start()
+        self.sharder = None
+        if self.config['shard-store']:
+            self.sharder = Sharder(LeaseStore(self.config['shard-store']), self.config['instance-id'])
+        self.engine = None
+        if self.config['check-engine'] == 'async':
+            self.engine = AsyncCheckEngine(self.config['github-token'], base_url=self.config['github-url'])
+            self.engine.start()
         try:
             self.gh_status = self.get_plugin('GHStatus')
         except:
@@ -117,23 +221,100 @@ class Summit(BotPlugin):
             self.gh_status = None
 
         # Reload the state from the storage.
-        with self.mutable(ROOMS) as rooms:
-            for room_name, repo in rooms.items():
-                for room in self[ROOMS]:
-                    self.queues[room] = MergeQueue(self.gh.get_repo(repo.name), initial_queue=repo.queue)
-
-        self.start_poller(120, method=self.check_pr_states)
+        for room_name in self.store.rooms():
+            self.load_room(room_name)
+        with self.rooms_lock:
+            # Answer the commands of our rooms before the first check.
+            owned = self.owned_rooms(reload=False)
+        if self.config['journal-dir']:
+            for room_name in owned:
+                self.save_queue(room_name)  # what the journals had on top of the storage
+        self.start_poller(POLL_INTERVAL, method=self.check_pr_states)
+
+    def deactivate(self):
+        dispatcher = getattr(self, 'dispatcher', None)
+        if dispatcher:
+            dispatcher.stop()
+        engine = getattr(self, 'engine', None)
+        if engine:
+            engine.stop()
+        sharder = getattr(self, 'sharder', None)
+        if sharder:
+            sharder.stop()
+        for queues in getattr(self, 'queues', {}).values():
+            for merge_queue in queues.values():
+                if isinstance(merge_queue.journal, Journal):
+                    merge_queue.journal.close()
+        store = getattr(self, 'store', None)
+        if store:
+            store.close()
+        for timer in getattr(self, 'rechecks', {}).values():
+            timer.cancel()
+        tracing.configure(None)
+        super(Summit, self).deactivate()
+
+    def new_merge_queue(self, room_name: str, repo_name: str, queue=None, pulled_prs=None, replay: bool = True,
+                        gh_repo=None) -> MergeQueue:
+        """
+        Build the MergeQueue of a repo of a room, with its journal if they are
+        enabled.
+        :param replay: start from what the journal has over the given state.
+        """
+        journal = None
+        if self.config['journal-dir']:
+            os.makedirs(self.config['journal-dir'], exist_ok=True)
+            name = re.sub(r'[^\w.-]', '_', f'{room_name}@{repo_name}')
+            journal = Journal(os.path.join(self.config['journal-dir'], name))
+            replayed = journal.replay(queue or [], pulled_prs or []) if replay else None
+            if replayed:
+                queue, pulled_prs = replayed
+            journal.compact(queue or [], pulled_prs or [])
+            if not replayed:
+                journal.saved(journal.seq)  # the storage has the snapshot
+        merge_queue = MergeQueue(gh_repo or self.gh.get_repo(repo_name), initial_queue=queue,
+                                 initial_pulled_prs=pulled_prs, journal=journal)
+        merge_queue.incremental = bool(self.config['incremental-check'])
+        return merge_queue
+
+    def load_room(self, room_name: str, replay: bool = True):
+        """
+        (Re)build the MergeQueues of a room from the storage.
+        :param replay: start from what the journals have over the storage.
+        """
+        previous = self.queues.get(room_name, {})
+        for merge_queue in previous.values():
+            if isinstance(merge_queue.journal, Journal):
+                merge_queue.journal.close()
+        self.queues[room_name] = OrderedDict(
+            (repo_name, self.new_merge_queue(room_name, repo_name, entry.queue, entry.pulled_prs, replay=replay,
+                                             gh_repo=previous[repo_name].gh_repo if repo_name in previous else None))
+            for repo_name, entry in room_repos(self.store.get_room(room_name)).items())
+        for repo_name, label in self.store.auto_labels(room_name).items():
+            if repo_name in self.queues[room_name]:
+                self.queues[room_name][repo_name].auto_label = label
 
     def save_queue(self, room_name: str):
         """
         Saves the state from the MergeQueues in the plugin storage.
         """
         with self.rooms_lock:
-            with self.mutable(ROOMS) as rooms:
-                repo = rooms[room_name]
-                merge_queue = self.queues[room_name]
-                repo.queue[:] = merge_queue.get_queue()
-                repo.pulled_prs[:] = merge_queue.get_pulled_prs()
+            queues = self.queues.get(room_name)
+            if queues is None:  # deconfigured in the meantime
+                return
+            if self.sharder and room_name not in self.sharder.tokens:
+                return  # the owner saves it, ours may be stale
+            states, seqs = {}, {}
+            for repo_name, merge_queue in queues.items():
+                with merge_queue.lock:
+                    states[repo_name] = (list(merge_queue.get_queue()), list(merge_queue.get_pulled_prs()))
+                    seqs[repo_name] = merge_queue.journal.seq
+                merge_queue.journal.sync()
+            self.store.save_queues(room_name, states)
+            for repo_name, merge_queue in queues.items():
+                merge_queue.journal.saved(seqs[repo_name])
+                if isinstance(merge_queue.journal, Journal) and merge_queue.journal.needs_compaction():
+                    with merge_queue.lock:
+                        merge_queue.journal.compact(merge_queue.get_queue(), merge_queue.get_pulled_prs())
 
     @staticmethod
     def get_pr_nb(pr_nb: str) -> int:
@@ -143,82 +324,399 @@ class Summit(BotPlugin):
         """
         return int(pr_nb.replace("#", ""))
 
-    def check_pr_states(self):
+    def owned_rooms(self, reload: bool = True):
+        """
+        Rooms this instance checks, taking over or handing over the leases of
+        rooms when instances joined or left. The rooms are the ones of the
+        storage, other instances configure and deconfigure rooms too.
+        :param reload: reload the rooms taken over from the storage, the
+                       previous owner changed them since they were loaded.
+        """
+        if not self.sharder:
+            return list(self.queues)
+        rooms = self.store.rooms()
+        for room_name in set(self.queues) - set(rooms):  # deconfigured by another instance
+            self.drop_journals(self.queues.pop(room_name).values())
+        tokens = dict(self.sharder.tokens)
+        owned = self.sharder.rebalance(rooms)
+        for room_name in owned:
+            if room_name not in self.queues or reload and self.sharder.tokens[room_name] != tokens.get(room_name):
+                self.load_room(room_name, replay=False)
+        for room_name, queues in self.queues.items():
+            for merge_queue in queues.values():
+                merge_queue.guard = partial(self.sharder.owns, room_name)
+        return [room_name for room_name in self.queues if room_name in owned]
+
+    def check_order(self):
+        """
+        (room, repository name) of every queue in the order of the next check,
+        rotated every cycle so that no repository is always checked last.
+        """
+        keys = [(room_name, repo_name) for room_name in self.owned_rooms() for repo_name in self.queues[room_name]]
+        if not keys:
+            return keys
+        shift = self.cycle % len(keys)
+        return keys[shift:] + keys[:shift]
+
+    def check_budget(self) -> Optional[int]:
+        """
+        Number of PRs all the repositories can refresh during a cycle so that
+        the remaining rate limit lasts until it resets. It may ask GitHub, not
+        to call under the rooms lock.
+        :return: None if the rate limit is unknown.
+        """
+        try:
+            remaining, _ = self.gh.rate_limiting
+            reset = self.gh.rate_limiting_resettime
+        except Exception as e:
+            self.log.warning('Cannot get the GitHub rate limit: %s', e)
+            return None
+        if remaining < 0:
+            return None
+        cycles = max(1.0, (reset - time.time()) / POLL_INTERVAL)
+        return int(remaining / cycles / CALLS_PER_PR)
+
+    @staticmethod
+    def share_budget(budget: Optional[int], wanted: Mapping[Hashable, int]) -> Dict[Hashable, Optional[int]]:
+        """
+        Split the PRs refreshed during a cycle between the repositories: the
+        ones needing less than an equal share leave the rest to the others.
+        :param wanted: number of PRs every repository would refresh without a budget.
+        :return: maximum number of PRs refreshed per repository.
+        """
+        if budget is None:
+            return dict.fromkeys(wanted)
+        shares = {}
+        for done, (key, count) in enumerate(sorted(wanted.items(), key=lambda item: item[1])):
+            shares[key] = max(MIN_PRS_PER_CYCLE, budget // (len(wanted) - done))
+            budget = max(0, budget - min(count, shares[key]))
+        return shares
+
+    def check_pr_states(self, budget: Optional[int] = None) -> Dict[Tuple[str, str], Optional[int]]:
         """
         Check the state of all PRs in all configured rooms.
+        :param budget: maximum number of PRs refreshed per repository, shared
+                       from the rate limit by default.
+        :return: the maximum number of PRs every (room, repository) refreshed.
+        """
+        usr_rev_map = self.users_reverse_map()
+        with self.check_lock, span('poll', cycle=self.cycle + 1) as poll_span:
+            total = self.check_budget() if budget is None else None
+            with self.rooms_lock:
+                order = self.check_order()
+                queues = OrderedDict((key, self.queues[key[0]][key[1]]) for key in order)
+                self.cycle += 1
+            for (room_name, _), merge_queue in queues.items():
+                self.follow_auto_label(room_name, merge_queue)
+                merge_queue.list_changes()
+            if budget is None:
+                budgets = self.share_budget(total, {key: len(merge_queue.to_refresh())
+                                                    for key, merge_queue in queues.items()})
+            else:
+                budgets = dict.fromkeys(order, budget)
+            poll_span.set(queues=len(order), budget=-1 if None in budgets.values() else sum(budgets.values()))
+            # Commands keep being served during the check, the queues merge
+            # their changes back at the end.
+            if self.engine:
+                checked = self.engine.check_all(queues, budgets=budgets)
+            else:
+                checked = OrderedDict()
+                with self.snapshots.sweep():
+                    for key, merge_queue in queues.items():
+                        with span('check', room=key[0], repo=key[1]):
+                            checked[key] = list(merge_queue.check(budgets[key],
+                                                                  self.snapshots.repo(merge_queue.gh_repo)))
+            with span('notify'):
+                for room_name, repo_name in order:
+                    if (room_name, repo_name) not in checked:  # the engine already logged why
+                        continue
+                    self.notify(room_name, checked[(room_name, repo_name)], usr_rev_map)
+                    self.tune_depth(queues[(room_name, repo_name)], checked[(room_name, repo_name)])
+            for room_name in OrderedDict.fromkeys(room_name for room_name, _ in order):
+                self.save_queue(room_name)
+                if any(merge_queue.unknown_prs for merge_queue in self.queues.get(room_name, {}).values()):
+                    self.schedule_recheck(room_name)
+        return budgets
+
+    def tune_depth(self, merge_queue: MergeQueue, transitions):
+        tuner = self.depth_tuners.get(merge_queue)
+        if tuner is not None:
+            tuner.observe(merge_queue.get_queue(), transitions)
+            merge_queue.max_pulled_prs = tuner.decide(merge_queue.max_pulled_prs)
+
+    def follow_auto_label(self, room_name: str, merge_queue: MergeQueue):
+        """
+        Add the PRs that got the auto label of the queue and remove the ones
+        that lost it, telling the room.
+        """
+        try:
+            added, removed = merge_queue.sync_auto_label()
+        except Exception:
+            self.log.exception('Could not follow the label %s of %s.', merge_queue.auto_label,
+                               merge_queue.gh_repo.full_name)
+            return
+        room = self.build_identifier(room_name)
+        for pr in added:
+            self.dispatcher.enqueue(room, f'[#{pr.nb}]({pr.url}) joined the queue, it is labelled '
+                                          f'{merge_queue.auto_label}.')
+        for pr in removed:
+            self.dispatcher.enqueue(room, f'[#{pr.nb}]({pr.url}) left the queue, it is no longer labelled '
+                                          f'{merge_queue.auto_label}.')
+
+    def users_reverse_map(self):
+        return {v: k for k, v in self.gh_status[self.gh_status.USERS].items()} if self.gh_status else {}
+
+    @staticmethod
+    def format_states(states):
+        return ', '.join(PR_MSG[state].format(*params) if isinstance(params, tuple) else PR_MSG[state].format(params)
+                         for state, params in states)
+
+    def notify(self, room_name: str, transitions, usr_rev_map):
+        """
+        Tell the room, and the authors, how their PRs changed.
+        """
+        room = self.build_identifier(room_name)
+        for pr, new_states in transitions:
+            public_states = [(state, params) for state, params in new_states if state in PUBLIC_STATE_FEEDBACK]
+            if not public_states:
+                continue
+            self.dispatcher.enqueue(room, f'[#{pr.nb}]({pr.url}) {self.format_states(public_states)}.')
+            if pr.user in usr_rev_map:
+                filtered_states = [(state, params) for state, params in new_states if state in USR_STATE_FEEDBACK]
+                if filtered_states:
+                    private_msg = f'[#{pr.nb}]({pr.url}) {self.format_states(filtered_states)}.'
+                    self.dispatcher.enqueue(self.build_identifier(usr_rev_map[pr.user]), private_msg)
+
+    def schedule_recheck(self, room_name: str, attempt: int = 0):
+        """
+        Ask GitHub again soon about the PRs it could not tell the mergeability
+        of, instead of waiting for the next full check.
         """
-        usr_rev_map = {v: k for k, v in self.gh_status[self.gh_status.USERS].items()} if self.gh_status else {}
         with self.rooms_lock:
-            with self.mutable(ROOMS) as rooms:
-                for room_name, repo in rooms.items():
-                    room = self.build_identifier(room_name)
-                    merge_queue = self.queues[room_name]
-                    for pr, new_states in merge_queue.check():
-                        public_info = [PR_MSG[state].format(params) for state, params in new_states if state in PUBLIC_STATE_FEEDBACK]
-                        if not public_info:
-                            continue
-                        public_msg = f'[#{pr.nb}]({pr.url}) {", ".join(public_info)}.'
-                        self.send(room, public_msg)
-                        if pr.user in usr_rev_map:
-                            filtered_states = list((state, params) for state, params in new_states if state in USR_STATE_FEEDBACK)
-                            if filtered_states:
-                                private_info = (PR_MSG[state].format(params) for state, params in filtered_states)
-                                private_msg = f'[#{pr.nb}]({pr.url}) {", ".join(private_info)}.'
-                                self.send(self.build_identifier(usr_rev_map[pr.user]), private_msg)
-                    self.save_queue(room_name)
-
-    def short_pr_list(self, merge_queue: MergeQueue):
+            if attempt >= len(RECHECK_DELAYS) or room_name in self.rechecks:
+                return
+            timer = Timer(RECHECK_DELAYS[attempt], self.recheck_unknown, args=(room_name, attempt))
+            timer.daemon = True
+            self.rechecks[room_name] = timer
+            timer.start()
+
+    def recheck_unknown(self, room_name: str, attempt: int):
+        with self.check_lock:
+            with self.rooms_lock:
+                self.rechecks.pop(room_name, None)
+                merge_queues = [merge_queue for merge_queue in self.queues.get(room_name, {}).values()
+                                if merge_queue.unknown_prs]
+            if not merge_queues:
+                return
+            usr_rev_map = self.users_reverse_map()
+            for merge_queue in merge_queues:
+                self.log.debug('Rechecking %s of %s in %s.', merge_queue.unknown_prs,
+                               merge_queue.gh_repo.full_name, room_name)
+                transitions = list(merge_queue.recheck(merge_queue.unknown_prs))
+                self.notify(room_name, transitions, usr_rev_map)
+                self.tune_depth(merge_queue, transitions)
+            self.save_queue(room_name)
+            if any(merge_queue.unknown_prs for merge_queue in merge_queues):
+                self.schedule_recheck(room_name, attempt + 1)
+
+    def cached_render(self, merge_queue: MergeQueue, key: Tuple, version: Optional[int], render: Callable[[], str]):
         """
-        Build the short form list of PRs in a queue.
+        Return the rendering of a PR, reusing the last one if the PR version
+        did not change since.
         """
-        result = ''
-        for i, pr in enumerate(merge_queue.get_queue()):
-            mergeable = ':thumbsup:' if pr.mergeable and pr.mergeable_state == 'clean' else ':no_entry:'
-            blessed = ':angel:' if pr.blessed else ''
-            next_up = ':up:' if pr.nb in merge_queue.pulled_prs else ''
-            result += f'{i}. [#{pr.nb}]({pr.url}) {blessed} {next_up} {pr.user} merge: {mergeable} {pr.mergeable_state}'
+        if version is None:  # not tracked by the queue, cannot be cached
+            return render()
+        cache = self.render_cache.setdefault(merge_queue, {})
+        cached = cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        if len(cache) > MAX_RENDER_CACHE:
+            cache.clear()
+        rendered = render()
+        cache[key] = (version, rendered)
+        return rendered
 
-            dependent_prs = merge_queue.count_dependent_prs(pr)
-            if dependent_prs > 0:
-                result += f'{dependent_prs} Chained PRs.'
-            result += '\n'
+    @staticmethod
+    def render_lane(pr):
+        lane = getattr(pr, 'lane', DEFAULT_LANE)
+        return f'[{lane}] ' if lane != DEFAULT_LANE else ''
+
+    @staticmethod
+    def render_short_pr(pr, next_up: str):
+        mergeable = ':thumbsup:' if pr.mergeable and pr.mergeable_state == 'clean' else ':no_entry:'
+        blessed = ':angel:' if pr.blessed else ''
+        lane = Summit.render_lane(pr)
+        result = f'[#{pr.nb}]({pr.url}) {lane}{blessed} {next_up} {pr.user} merge: {mergeable} {pr.mergeable_state}'
+        if pr.dependents_count > 0:
+            result += f'{pr.dependents_count} Chained PRs.'
         return result
 
-    def long_pr_list(self, merge_queue: MergeQueue, pr_list=None, level: int=0, with_desc: bool=False):
+    @staticmethod
+    def render_long_pr(pr, next_up: str, indentation: str, with_desc: bool):
+        mergeable = ':thumbsup:' if pr.mergeable and pr.mergeable_state == 'clean' else ':no_entry:'
+        blessed = ':angel:' if pr.blessed else ''
+        description = ['\n\n']
+        if with_desc:
+            for line in (pr.description or '').splitlines()[:5]:
+                description.append(f'    {indentation}| {line}\n\n')
+        return f'[#{pr.nb}]({pr.url}) {Summit.render_lane(pr)}{blessed} {next_up} {pr.user} reviews: ' \
+               f'+:{pr.positive} -:{pr.negative} ~:{pr.pending} ' \
+               f'merge: {mergeable} {pr.mergeable_state} - {pr.title}.{"".join(description)}'
+
+    def short_pr_list(self, merge_queue: MergeQueue, start: int = 0, stop: int = None):
+        """
+        Build the short form list of PRs in a queue.
+        """
+        result = []
+        for i, pr in enumerate(merge_queue.get_queue()[start:stop], start):
+            next_up = ':up:' if pr.nb in merge_queue.pulled_prs else ''
+            line = self.cached_render(merge_queue, ('short', pr.nb, next_up), getattr(pr, 'version', None),
+                                      lambda: self.render_short_pr(pr, next_up))
+            result.append(f'{i}. {line}\n')
+        return ''.join(result)
+
+    def long_pr_list(self, merge_queue: MergeQueue, pr_list=None, level: int=0, with_desc: bool=False,
+                     start: int = 0, stop: int = None):
         """
         Build the long form list of PRs.
         """
-        result = ''
+        result = []
         tab_size = 4
         indentation = ' ' * (tab_size * level)
         if pr_list is None:
             pr_list = merge_queue.get_queue()
-        for i, pr in enumerate(pr_list):
-            mergeable = ':thumbsup:' if pr.mergeable and pr.mergeable_state == 'clean' else ':no_entry:'
-            blessed = ':angel:' if pr.blessed else ''
+        for i, pr in enumerate(pr_list[start:stop], start):
             next_up = ':up:' if pr.nb in merge_queue.pulled_prs else ''
-            title = pr.title
-            description = '\n\n'
-            if with_desc:
-                for line in pr.description.splitlines()[:5]:
-                    description += f'    {indentation}| {line}\n\n'
-            result += f'{indentation}{i+1}. [#{pr.nb}]({pr.url}) {blessed} {next_up} {pr.user} reviews: ' \
-                      f'+:{pr.positive} -:{pr.negative} ~:{pr.pending} ' \
-                      f'merge: {mergeable} {pr.mergeable_state} - {title}.{description}'
+            line = self.cached_render(merge_queue, ('long', pr.nb, next_up, level, with_desc),
+                                      getattr(pr, 'version', None),
+                                      lambda: self.render_long_pr(pr, next_up, indentation, with_desc))
+            result.append(f'{indentation}{i+1}. {line}')
 
             if len(pr.dependents) > 0:
-                result += f'{indentation}{merge_queue.count_dependent_prs(pr)} chained PRs for [#{pr.nb}]({pr.url})' \
-                          f'\n\n{self.long_pr_list(merge_queue, pr.dependents, level=level + 1, with_desc=False)}'
-        return result
+                result.append(f'{indentation}{merge_queue.count_dependent_prs(pr)} chained PRs for '
+                              f'[#{pr.nb}]({pr.url})\n\n')
+                result.append(self.long_pr_list(merge_queue, merge_queue.dependents_of(pr), level=level + 1,
+                                                with_desc=False))
+        return ''.join(result)
+
+    @staticmethod
+    def paginate(merge_queue: MergeQueue, render: Callable[..., str], page: Optional[int], limit: int,
+                 header: str = ''):
+        """
+        Stream a rendered queue by pages of `limit` PRs, or only the requested
+        page. The header is prepended to the first message.
+        """
+        if limit < 1:
+            yield 'The limit needs to be at least 1.'
+            return
+        queue_len = len(merge_queue.get_queue())
+        if not queue_len:
+            yield f'{header}No outstanding Pull Requests in the queue.'
+            return
+        page_count = (queue_len + limit - 1) // limit
+        if page is None:
+            for start in range(0, queue_len, limit):
+                yield (header if not start else '') + render(merge_queue, start=start, stop=start + limit)
+            return
+        if not 1 <= page <= page_count:
+            yield f'{header}There is no page {page}, the queue has {page_count} page(s) of {limit} PRs.'
+            return
+        start = (page - 1) * limit
+        yield header + render(merge_queue, start=start, stop=start + limit) + f'\nPage {page}/{page_count}.'
+
+    def paginate_room(self, room: str, render: Callable[..., str], page: Optional[int], limit: int):
+        """
+        paginate every queue of a room, with a header per repository when
+        there are several.
+        """
+        queues = self.queues[room]
+        for repo_name, merge_queue in queues.items():
+            header = f'**{repo_name}**\n\n' if len(queues) > 1 else ''
+            yield from self.paginate(merge_queue, render, page, limit, header)
 
     @botcmd
     def merge_check(self, msg, _):
         """
         Force the PR status check now.
         """
+        if msg.is_group and self.config:
+            try:
+                self.check_owner(str(msg.frm.room))
+            except NotOwner:
+                return None
         self.check_pr_states()
         return 'Check done.'
 
+    @botcmd
+    def merge_outbox(self, msg, _):
+        """
+        Show the state of the outbound message queue.
+        """
+        if not self.config:
+            return 'This plugin is not configured.'
+        return self.dispatcher.stats()
+
+    @botcmd
+    def merge_transport(self, msg, _):
+        """
+        Show the outcome counters of the requests made to GitHub.
+        """
+        if not self.config:
+            return transport_status()
+        return f'{transport_status()}\n\n{self.snapshots.status()}'
+
+    @botcmd(admin_only=True)
+    def merge_record(self, msg, _):
+        """
+        Run a check of every room now, recording the GitHub traffic in a
+        cassette to replay it offline with bench_check.py.
+        """
+        if not self.config:
+            return 'This plugin is not configured.'
+        if self.engine:
+            return 'Recording only captures the sync check engine.'
+
+        path = os.path.join(self.bot_config.BOT_DATA_DIR, f'merge-cassette-{int(time.time())}.jsonl')
+        with self.rooms_lock:
+            order = self.check_order()
+            queues = OrderedDict()
+            for room_name, repo_name in order:
+                merge_queue = self.queues[room_name][repo_name]
+                queues[f'{room_name} {repo_name}'] = {
+                    'repo': repo_name,
+                    'max_pulled_prs': merge_queue.max_pulled_prs,
+                    'queue': [pr.to_state() for pr in merge_queue.get_queue()],
+                    'pulled_prs': merge_queue.get_pulled_prs()}
+        # Not under the rooms lock: the check takes the check lock first.
+        with recording(path, {'queues': queues}):
+            budgets = self.check_pr_states()
+            for (room_name, repo_name), budget in budgets.items():
+                if f'{room_name} {repo_name}' in queues:
+                    queues[f'{room_name} {repo_name}']['max_prs'] = budget
+        return f'Cassette saved in {path}.'
+
+    @arg_botcmd('repo', nargs='?', default=None, help='Repository of the room, the first one by default')
+    def merge_profile(self, msg, repo=None):
+        """
+        Profile a dry-run check of this room: the slowest functions and GitHub endpoints. Nothing gets merged.
+        """
+        try:
+            room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
+        except Exception as e:
+            return str(e)
+
+        try:
+            if not self.is_saint(room, msg.frm):
+                return f'{msg.frm} has not achieved sainthood'
+            merge_queue = self.select_queue(room, repo, 0)
+            name = re.sub(r'[^\w.-]', '_', f'{room}@{merge_queue.gh_repo.full_name}')
+            path = os.path.join(self.bot_config.BOT_DATA_DIR, f'merge-profile-{name}-{int(time.time())}.prof')
+            return profile_check(merge_queue, path)
+        except Exception as e:
+            return f'Error: {e}'
+
     @botcmd(split_args_with=None)
     def merge_config(self, msg, args):
         """
@@ -227,18 +725,79 @@ class Summit(BotPlugin):
         """
         try:
             repo, room = self.optional_room_precheck(msg, args)
+        except NotOwner:
+            return None
         except Exception as e:
             return f'Error {e}'
 
         gh_repo = self.gh.get_repo(repo)
         with self.rooms_lock:
-            with self.mutable(ROOMS) as rooms:
-                rooms[room] = Repo(name=repo, owner=msg.frm, queue=[],
-                                   saints=[msg.frm.aclattr])
-                self.queues[room] = MergeQueue(gh_repo)
+            self.drop_journals(self.queues.get(room, {}).values())
+            self.store.put_room(room, Repo(name=repo, owner=msg.frm, queue=[], saints=[msg.frm.aclattr]))
+            self.queues[room] = OrderedDict([(repo, self.new_merge_queue(room, repo, replay=False, gh_repo=gh_repo))])
+            if self.sharder:
+                self.owned_rooms(reload=False)  # take its lease to answer its commands
 
         return f'Configured {room} with this repo {gh_repo.name}'
 
+    @botcmd(split_args_with=None)
+    def merge_addrepo(self, msg, args):
+        """
+        Add another repo to the merge queues of a room (defaults to the current
+        room).
+        """
+        try:
+            repo, room = self.optional_room_precheck(msg, args)
+        except NotOwner:
+            return None
+        except Exception as e:
+            return f'Error {e}'
+        if room not in self.store:
+            return 'You need to link a repo to this channel with !merge config'
+        if not self.is_saint(room, msg.frm):
+            return f'{msg.frm} has not achieved sainthood'
+
+        gh_repo = self.gh.get_repo(repo)
+        with self.rooms_lock:
+            if repo in self.queues[room]:
+                return f'{repo} is already queued in {room}'
+            with self.store.mutable_room(room) as room_state:
+                room_repos(room_state)[repo] = SimpleNamespace(name=repo, queue=[], pulled_prs=[])
+                self.queues[room][repo] = self.new_merge_queue(room, repo, replay=False, gh_repo=gh_repo)
+        return f'{room} now queues {", ".join(self.queues[room])}'
+
+    @botcmd(split_args_with=None)
+    def merge_rmrepo(self, msg, args):
+        """
+        Remove a repo from the merge queues of a room (defaults to the current
+        room). Warning: this is killing its queue.
+        """
+        try:
+            repo, room = self.optional_room_precheck(msg, args)
+        except NotOwner:
+            return None
+        except Exception as e:
+            return f'Error {e}'
+        if room not in self.store:
+            return 'You need to link a repo to this channel with !merge config'
+        if not self.is_saint(room, msg.frm):
+            return f'{msg.frm} has not achieved sainthood'
+
+        with self.rooms_lock:
+            if repo not in self.queues[room]:
+                return f'{repo} is not queued in {room}'
+            if len(self.queues[room]) == 1:
+                return 'This is the last repo of the room, use !merge deconfig instead'
+            with self.store.mutable_room(room) as room_state:
+                repos = room_repos(room_state)
+                del repos[repo]
+                self.drop_journals([self.queues[room].pop(repo)])
+                # Keep the legacy attributes on the first repo.
+                first = next(iter(repos.values()))
+                room_state.name, room_state.queue, room_state.pulled_prs = first.name, first.queue, first.pulled_prs
+            self.store.set_auto_label(room, repo, None)
+        return f'{room} now queues {", ".join(self.queues[room])}'
+
     @botcmd
     def merge_deconfig(self, msg, _):
         """
@@ -251,17 +810,45 @@ class Summit(BotPlugin):
             return 'This must be done in a channel.'
 
         room = str(msg.frm.room)
+        try:
+            self.check_owner(room)
+        except NotOwner:
+            return None
         with self.rooms_lock:
-            with self.mutable(ROOMS) as rooms:
-                del rooms[room]
-                del self.queues[room]
+            self.store.delete_room(room)
+            self.drop_journals(self.queues.pop(room).values())
         return f'You no longer have a queue for this room {room}'
 
+    @staticmethod
+    def drop_journals(merge_queues):
+        """
+        Close and remove the journals of queues that are no more.
+        """
+        for merge_queue in merge_queues:
+            if isinstance(merge_queue.journal, Journal):
+                merge_queue.journal.delete()
+
     def get_repo(self, room):
         """
         Get the specified room.
         """
-        return self.gh.get_repo(self[ROOMS][room].name)
+        return self.gh.get_repo(self.store.get_room(room).name)
+
+    def select_queue(self, room: str, repo_hint: Optional[str], pr_nb: int) -> MergeQueue:
+        """
+        Find the queue of a room a PR reference is about: the hinted repo, else
+        the queue already holding this PR, else the first repo of the room.
+        """
+        queues = self.queues[room]
+        if repo_hint:
+            for repo_name, merge_queue in queues.items():
+                if repo_hint == repo_name or repo_name.endswith(f'/{repo_hint}'):
+                    return merge_queue
+            raise Exception(f'{repo_hint} is not queued in this room, it has {", ".join(queues)}')
+        for merge_queue in queues.values():
+            if pr_nb in merge_queue.queue:
+                return merge_queue
+        return next(iter(queues.values()))
 
     def cmd_precheck(self, msg):
         """
@@ -274,10 +861,21 @@ class Summit(BotPlugin):
             raise Exception('This must be done in a channel.')
 
         room = str(msg.frm.room)
-        if room not in self[ROOMS]:
+        if room not in self.store:
             raise Exception('You need to link a repo to this channel with !merge config')
+        self.check_owner(room)
         return room
 
+    def check_owner(self, room: str):
+        """
+        Raise NotOwner if another instance of the bot handles this room, for
+        a room not configured yet the one elected to take it answers.
+        """
+        if not self.sharder or room in self.sharder.tokens:
+            return
+        if room in self.store or room in self.queues or not self.sharder.elected(room):
+            raise NotOwner()
+
     @staticmethod
     def display_saints(room, saints):
         """
@@ -303,6 +901,7 @@ class Summit(BotPlugin):
             if not msg.is_group:
                 raise Exception('Missing room parameter')
             room = str(msg.frm.room)
+        self.check_owner(room)
 
         return param1, room
 
@@ -311,7 +910,7 @@ class Summit(BotPlugin):
         Checks if a given user is a sainthood for a particular room.
         """
         with self.rooms_lock:
-            return frm.aclattr in self[ROOMS][room].saints
+            return frm.aclattr in self.store.saints(room)
 
     @botcmd(split_args_with=None)
     def merge_canonize(self, msg, args):
@@ -321,17 +920,21 @@ class Summit(BotPlugin):
         try:
             saint, room = self.optional_room_precheck(msg, args)
             saint = self.build_identifier(saint).aclattr
+        except NotOwner:
+            return None
         except Exception as e:
             return f'Error {e}'
 
         if not self.is_saint(room, msg.frm):
             return f'{msg.frm} has not achieved sainthood'
 
-        with self.mutable(ROOMS) as rooms:
-            if saint not in rooms[room].saints:
-                rooms[room].saints.append(saint)
+        with self.rooms_lock:
+            saints = self.store.saints(room)
+            if saint not in saints:
+                saints.append(saint)
+                self.store.set_saints(room, saints)
 
-        return self.display_saints(room, rooms[room].saints)
+        return self.display_saints(room, saints)
 
     @botcmd(split_args_with=None)
     def merge_defrock(self, msg, args):
@@ -341,17 +944,21 @@ class Summit(BotPlugin):
         try:
             saint, room = self.optional_room_precheck(msg, args)
             saint = self.build_identifier(saint).aclattr
+        except NotOwner:
+            return None
         except Exception as e:
             return f'Error {e}'
 
         if not self.is_saint(room, msg.frm):
             return f'{msg.frm} has not achieved sainthood'
 
-        with self.mutable(ROOMS) as rooms:
-            if saint in rooms[room].saints:
-                rooms[room].saints.remove(saint)
+        with self.rooms_lock:
+            saints = self.store.saints(room)
+            if saint in saints:
+                saints.remove(saint)
+                self.store.set_saints(room, saints)
 
-        return self.display_saints(room, rooms[room].saints)
+        return self.display_saints(room, saints)
 
     @botcmd
     def merge_saints(self, msg, args):
@@ -360,11 +967,12 @@ class Summit(BotPlugin):
         """
         try:
             room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
         except Exception as e:
             return str(e)
 
-        with self.mutable(ROOMS) as rooms:
-            return self.display_saints(room, rooms[room].saints)
+        return self.display_saints(room, self.store.saints(room))
 
     @arg_botcmd('merge_base_cnt', type=int)
     def merge_depth(self, msg, merge_base_cnt):
@@ -374,6 +982,8 @@ class Summit(BotPlugin):
 
         try:
             room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
         except Exception as e:
             return str(e)
 
@@ -382,19 +992,89 @@ class Summit(BotPlugin):
                 if not self.is_saint(room, msg.frm):
                     return f'{msg.frm} has not achieved sainthood'
 
-                self.queues[room].max_pulled_prs = merge_base_cnt
-                return f'Blessed PRs pull base count set to {merge_base_cnt}'
+                tuned = False
+                for merge_queue in self.queues[room].values():
+                    merge_queue.max_pulled_prs = merge_base_cnt
+                    tuned = self.depth_tuners.pop(merge_queue, None) is not None or tuned
+                return f'Blessed PRs pull base count set to {merge_base_cnt}' + \
+                       (', it is no longer auto-tuned' if tuned else '')
 
         except Exception as e:
             return f'Error: {e}'
 
-    @staticmethod
-    def depth_status(merge_queue):
+    @arg_botcmd('label', help='Label enqueuing the PRs that get it, "off" to stop')
+    @arg_botcmd('--repo', default=None, help='Repository of the room, the first one by default')
+    def merge_autolabel(self, msg, label, repo=None):
+        """
+        PRs with this label join the queue by themselves, and leave it when the label is removed.
+        """
+        try:
+            room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
+        except Exception as e:
+            return str(e)
+
+        try:
+            if not self.is_saint(room, msg.frm):
+                return f'{msg.frm} has not achieved sainthood'
+            with self.rooms_lock:
+                merge_queue = self.select_queue(room, repo, 0)
+                repo_name = next(name for name, queue in self.queues[room].items() if queue is merge_queue)
+                label = None if label == 'off' else label
+                self.store.set_auto_label(room, repo_name, label)
+                merge_queue.auto_label = label
+                merge_queue.label_watermark = None
+            if label is None:
+                return f'PRs of {repo_name} are no longer enqueued by label'
+            return f'PRs of {repo_name} labelled {label} join the queue at the next check'
+        except Exception as e:
+            return f'Error: {e}'
+
+    @arg_botcmd('bounds', nargs='+', help='Lowest and highest depth, or "off" to keep the current depth')
+    def merge_autodepth(self, msg, bounds):
+        """
+        Tune the number of blessed PRs to pull base on from the CI duration, merge rate and pull failures.
+        """
+        try:
+            room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
+        except Exception as e:
+            return str(e)
+
+        try:
+            if not self.is_saint(room, msg.frm):
+                return f'{msg.frm} has not achieved sainthood'
+            if bounds == ['off']:
+                with self.rooms_lock:
+                    for merge_queue in self.queues[room].values():
+                        self.depth_tuners.pop(merge_queue, None)
+                return 'The depth is no longer auto-tuned'
+            if len(bounds) != 2:
+                return 'Usage: !merge autodepth <min> <max> or !merge autodepth off'
+            min_depth, max_depth = (int(bound) for bound in bounds)
+            if not 0 <= min_depth <= max_depth:
+                return 'The bounds need to be 0 <= min <= max'
+            with self.rooms_lock:
+                for merge_queue in self.queues[room].values():
+                    tuner = self.depth_tuners.get(merge_queue)
+                    if tuner is None:
+                        self.depth_tuners[merge_queue] = tuner = DepthTuner(min_depth, max_depth)
+                    tuner.min_depth, tuner.max_depth = min_depth, max_depth
+                    merge_queue.max_pulled_prs = tuner.decide(merge_queue.max_pulled_prs)
+            return f'The depth is now auto-tuned between {min_depth} and {max_depth}'
+        except Exception as e:
+            return f'Error: {e}'
+
+    def depth_status(self, merge_queue):
         try:
             pulled_prs = merge_queue.pulled_prs
             count_of_merged_prs = len(pulled_prs)
             all_prs = ', '.join((str(pr_nb) for pr_nb in pulled_prs))
+            tuner = self.depth_tuners.get(merge_queue)
             return f'Blessed PRs depth set to {merge_queue.max_pulled_prs}.\n\n' + \
+                   (f'{tuner.status()}\n\n' if tuner else '') + \
                    f'Current updated PR count is at {count_of_merged_prs}.\n\n' + \
                    (f'List of updated PRs: {all_prs}.' if all_prs else '')
 
@@ -402,19 +1082,26 @@ class Summit(BotPlugin):
             return f'Error: {e}'
 
     @arg_botcmd('--verbose', '-v', action='store_true')
-    def merge_status(self, msg, verbose: bool=False):
+    @arg_botcmd('--page', type=int, default=None, help='Only show this page of the queue')
+    @arg_botcmd('--limit', type=int, default=PAGE_SIZE, help='Number of PRs per page')
+    def merge_status(self, msg, verbose: bool=False, page: int=None, limit: int=PAGE_SIZE):
         """
         Return the current state of the merge queue.
         """
         try:
             room = self.cmd_precheck(msg)
+        except NotOwner:
+            return
         except Exception as e:
-            return str(e)
+            yield str(e)
+            return
 
-        merge_queue = self.queues[room]
-        yield self.long_pr_list(merge_queue, with_desc=verbose) or 'No outstanding Pull Requests in the queue.'
+        render = partial(self.long_pr_list, with_desc=verbose)
+        yield from self.paginate_room(room, render, page, limit)
         if verbose:
-            yield self.depth_status(merge_queue)
+            queues = self.queues[room]
+            for repo_name, merge_queue in queues.items():
+                yield (f'**{repo_name}** ' if len(queues) > 1 else '') + self.depth_status(merge_queue)
 
     @botcmd
     def merge_help(self, msg, _):
@@ -425,39 +1112,122 @@ class Summit(BotPlugin):
         redirect_msg.body = '!help {0}'.format(self.name)
         return self.get_plugin('Help').help(redirect_msg, self.name)
 
-    def act_on_pr(self, action, msg, pr_nb, requires_sainthood=False):
+    def act_on_pr(self, action, msg, pr_ref, requires_sainthood=False, prepare=None):
         """
         Common boilerplate on acting on a PR. Action needs to be an unbounded class method on MergeQueue.
-        """
-        try:
-            pr_nb = self.get_pr_nb(pr_nb)
-        except ValueError:
-            return f'Cannot convert {pr_nb} to an integer'
+        The PR can be referenced as 123, #123, repo#123 or owner/repo#123.
 
+        Whatever needs GitHub is done first by `prepare`, without any lock,
+        action then gets its result instead of the PR number and applies it
+        under the lock of the queue. If the PR changed in between, it starts
+        over.
+        """
         try:
             room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
         except Exception as e:
             return str(e)
 
         try:
-            with self.rooms_lock:
-                if requires_sainthood and not self.is_saint(room, msg.frm):
-                    return f'{msg.frm} has not achieved sainthood'
+            repo_hint, pr_nb = parse_pr_ref(pr_ref)
+        except ValueError as e:
+            return str(e)
+
+        try:
+            if requires_sainthood and not self.is_saint(room, msg.frm):
+                return f'{msg.frm} has not achieved sainthood'
+
+            for _ in range(COMMAND_ATTEMPTS):
+                merge_queue = self.select_queue(room, repo_hint, pr_nb)
+                version = merge_queue.pr_version(pr_nb)
+                prepared = prepare(merge_queue, pr_nb) if prepare else pr_nb
+                with merge_queue.lock:
+                    if merge_queue.pr_version(pr_nb) != version:
+                        continue
+                    action(merge_queue, prepared)
+                break
+            else:
+                return f'PR {pr_nb} kept changing while acting on it, please try again.'
+            self.save_queue(room)
+            return self.short_pr_list(merge_queue)
+
+        except Exception as e:
+            return f'Error: {e}'
 
-                merge_queue = self.queues[room]
-                action(merge_queue, pr_nb)
-                self.save_queue(room)
-                return self.short_pr_list(merge_queue)
+    @arg_botcmd('pr_refs', nargs='*', help='PRs to add to the queue: 123, or repo#123 when the room has several '
+                                           'repos')
+    @arg_botcmd('--label', help='Also add the open PRs with this label')
+    @arg_botcmd('--search', help='Also add the open PRs matching this GitHub search, e.g. "author:jdoe"')
+    @arg_botcmd('--lane', default=DEFAULT_LANE, help=f'Priority lane ({", ".join(LANES)}), only saints can '
+                                                     f'pick another lane than {DEFAULT_LANE}')
+    def merge_ask(self, msg, pr_refs, label=None, search=None, lane=DEFAULT_LANE):
+        """
+        Ask for PRs to be merged: one or several numbers, the PRs with a label or the ones matching a search.
+        """
+        if len(pr_refs) == 1 and not label and not search:
+            return self.act_on_pr(partial(MergeQueue.add_pr, lane=lane), msg, pr_refs[0],
+                                  requires_sainthood=lane != DEFAULT_LANE, prepare=MergeQueue.fetch_pr)
+        if not pr_refs and not label and not search:
+            return 'Give some PR numbers, a --label or a --search.'
+        return self.ask_many(msg, pr_refs, label, search, lane)
+
+    def ask_many(self, msg, pr_refs: List[str], label: Optional[str], search: Optional[str], lane: str):
+        """
+        Add a batch of PRs: they are fetched per repository with a few batched
+        requests, without any lock, then each queue takes them in one go and
+        the room is saved once.
+        """
+        try:
+            room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
+        except Exception as e:
+            return str(e)
+        try:
+            refs = [parse_pr_ref(pr_ref) for pr_ref in pr_refs]
+        except ValueError as e:
+            return str(e)
 
+        try:
+            if lane != DEFAULT_LANE and not self.is_saint(room, msg.frm):
+                return f'{msg.frm} has not achieved sainthood'
+            wanted = OrderedDict()  # MergeQueue -> PR numbers
+            for repo_hint, pr_nb in refs:
+                wanted.setdefault(self.select_queue(room, repo_hint, pr_nb), []).append(pr_nb)
+            terms = ' '.join(term for term in (f'label:"{label}"' if label else '', search or '') if term)
+            if terms:
+                for merge_queue in self.queues[room].values():
+                    wanted.setdefault(merge_queue, [])
+
+            results = []
+            for merge_queue, pr_nbs in wanted.items():
+                prs, refused = merge_queue.fetch_prs(pr_nbs, terms or None)
+                for pr_nb in merge_queue.add_prs(prs, lane):
+                    refused[pr_nb] = 'already in the queue'
+                results.append((merge_queue, len(prs) - sum(pr.nb in refused for pr in prs), refused))
+            self.save_queue(room)
         except Exception as e:
             return f'Error: {e}'
 
-    @arg_botcmd('pr_nb', help='PR Number to add to the queue')
-    def merge_ask(self, msg, pr_nb):
+        lines = []
+        for merge_queue, added, refused in results:
+            name = merge_queue.gh_repo.full_name if len(results) > 1 else 'the queue'
+            line = f'Added {added} PRs to {name}.'
+            if refused:
+                line += ' Skipped ' + ', '.join(f'#{pr_nb} ({reason})' for pr_nb, reason in refused.items()) + '.'
+            lines.append(line)
+        lines.extend(self.short_pr_list(merge_queue) for merge_queue, _, _ in results)
+        return '\n'.join(lines)
+
+    @arg_botcmd('lane', help=f'Priority lane to move the PR to ({", ".join(LANES)})')
+    @arg_botcmd('pr_nb', help='PR Number to move')
+    def merge_lane(self, msg, pr_nb, lane):
         """
-        Ask for a specific PR to be merged.
+        Move a PR to another priority lane, the lanes share the merge and pull
+        slots according to their weight.
         """
-        return self.act_on_pr(MergeQueue.ask_pr, msg, pr_nb)
+        return self.act_on_pr(partial(MergeQueue.move_pr, lane=lane), msg, pr_nb, requires_sainthood=True)
 
     @arg_botcmd('pr_nb', help='PR Number to remove from the queue')
     def merge_rm(self, msg, pr_nb):
@@ -495,38 +1265,80 @@ class Summit(BotPlugin):
         """
         return self.act_on_pr(MergeQueue.sink_pr, msg, pr_nb, requires_sainthood=True)
 
-    @botcmd
-    def merge_list(self, msg, _):
+    @arg_botcmd('--page', type=int, default=None, help='Only show this page of the queue')
+    @arg_botcmd('--limit', type=int, default=PAGE_SIZE, help='Number of PRs per page')
+    def merge_list(self, msg, page: int=None, limit: int=PAGE_SIZE):
         """
         Provides a short list of the PRs in the queue.
         """
         try:
             room = self.cmd_precheck(msg)
+        except NotOwner:
+            return
         except Exception as e:
-            return str(e)
+            yield str(e)
+            return
 
         with self.rooms_lock:
-            return self.short_pr_list(self.queues[room])
+            pages = list(self.paginate_room(room, self.short_pr_list, page, limit))
+        yield from pages
+
+    @arg_botcmd('--days', type=int, default=28, help='Number of days to report on')
+    def merge_report(self, msg, days: int = 28):
+        """
+        Report the throughput of the queues of this room, from the history kept
+        by the history stats plugin.
+        """
+        try:
+            room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
+        except Exception as e:
+            return str(e)
+        if report.np is None:
+            return 'The report requires numpy.'
+        if days < 1:
+            return 'The report needs to cover at least 1 day.'
+
+        paths = OrderedDict.fromkeys(getattr(merge_queue.stats, 'path', None)
+                                     for merge_queue in self.queues[room].values())
+        paths.pop(None, None)
+        if not paths:
+            return 'No history is kept for this room, configure it with !merge statsplugin history <file>'
+        return '\n\n'.join(report.format_report(report.report(report.load(path), days)) for path in paths)
 
     @arg_botcmd('api_key', help='The API key to configure the plugin ')
     @arg_botcmd('plugin', help='The plugin used to collect stats (e.g datadog)')
     def merge_statsplugin(self, msg, plugin, api_key):
         """
-        Provides a short list of the PRs in the queue.
+        Send the events of the queues of this room to a stats plugin, history
+        keeps them in a file of the data directory of the bot.
         """
         try:
             room = self.cmd_precheck(msg)
+        except NotOwner:
+            return None
         except Exception as e:
             return str(e)
+        if not self.is_saint(room, msg.frm):
+            return f'{msg.frm} has not achieved sainthood'
 
         with self.rooms_lock:
             try:
-                self.queues[room].stats = getattr(import_module(f'{plugin}_stats'), 'Stats')(api_key)
+                stats_class = getattr(import_module(f'{plugin}_stats'), 'Stats')
+                if plugin == 'history':
+                    stats = stats_class(api_key, data_dir=self.bot_config.BOT_DATA_DIR)
+                else:
+                    stats = stats_class(api_key)
+                for merge_queue in self.queues[room].values():
+                    merge_queue.stats = stats
                 return f'{plugin} plugin configured!'
             except ModuleNotFoundError:
                 return f'The {plugin} plugin does not exist'
             except AttributeError:
                 return f'The {plugin} does not have a Stats class implemented'
+            except ValueError as e:
+                return f'Error: {e}'
             except Exception as e:
                 return f'Unknown error {e}, while loading {plugin}'
 
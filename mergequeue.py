@@ -12,32 +12,120 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-from pr import PR, PRTransition, PRTransitionParams
-from typing import List, Tuple, Any, Generator, Union
+from collections import OrderedDict, deque
+from functools import wraps
+from itertools import count
+from threading import RLock
+from pr import PR, PRTransition, PRTransitionParams, DEFAULT_LANE
+from typing import List, Tuple, Any, Callable, Dict, Generator, Optional, Union, Set, Mapping
 from stats import BaseStat, NoStats
+from journal import NoJournal, transition_record
+from tracing import current, span, traced
+from gh_graphql import MAX_SEARCH_RESULTS, delete_branches, fetch_pulls, requester, retarget_pulls, search_pulls
 import logging
 
 log = logging.getLogger(__name__)
 
 MAX_PULLED_PR = 3
 
+# Priority lanes and their weight: the share of the merge and pull slots they get.
+LANES = OrderedDict([('hotfix', 4), (DEFAULT_LANE, 2), ('low', 1)])
+
 
 class MergeQueueException(Exception):
     pass
 
 
+def mutation(method):
+    """
+    Apply a change to the queue in its critical section and count it.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            result = method(self, *args, **kwargs)
+            self.revision += 1
+            return result
+    return wrapper
+
+
 class MergeQueue:
     def __init__(self,
                  gh_repo,
                  max_pulled_prs: int = MAX_PULLED_PR,
                  initial_queue: List[PR] = None,
                  stats: BaseStat=None,
-                 initial_pulled_prs: List[int] = None):
+                 initial_pulled_prs: List[int] = None,
+                 lanes: Mapping[str, int] = None,
+                 journal: NoJournal = None):
         self.max_pulled_prs = max_pulled_prs
+        self.lanes = OrderedDict(lanes if lanes else LANES)
         self.gh_repo = gh_repo
         self.queue = initial_queue if initial_queue else []
+        # Versions are never reused, even by a PR removed then added again, so renderings cached by version stay right.
+        self.versions = count(max((getattr(pr, 'version', None) or 0 for pr in self.queue), default=0) + 1)
         self.pulled_prs = initial_pulled_prs if initial_pulled_prs else []
         self.stats = stats or NoStats()
+        self.journal = journal or NoJournal()
+        # Merges the journal had in flight when the bot stopped: nothing is merged until the next check saw them.
+        self.unverified_merges: Set[int] = set(self.journal.merging)
+        # Blessed PRs near the front GitHub could not tell the mergeability of during the last check.
+        self.unknown_prs = []
+        # Asked right before merging or pulling, False if this instance no longer owns the queue.
+        self.guard: Callable[[], bool] = None
+        # Checks only read from GitHub, for profiling.
+        self.dry_run = False
+        # Held while changing the queue, never while talking to GitHub.
+        self.lock = RLock()
+        # Bumped by every change, to tell if the queue changed under a command.
+        self.revision = 0
+        # PRs with this label join the queue by themselves, and leave it when it is removed.
+        self.auto_label: Optional[str] = None
+        # Last update time of the PRs seen by the label sweeps, only the PRs updated since are searched.
+        self.label_watermark: Optional[str] = None
+        # Incremental checks only refresh the PRs that changed since the previous check.
+        self.incremental = False
+        self.update_watermark = None  # last updated_at listed
+        self.base_shas: Dict[str, str] = {}  # head of the base branches when last listed
+        self.stale_prs: Optional[Set[int]] = None  # changed and not refreshed yet, None for all of them
+        # Where the window of the PRs refreshed under a budget starts, it moves every check.
+        self.refresh_offset = 0
+        # PRs chained on the queued ones without being queued, the PRs only know their dependents by number.
+        self.chained: Dict[int, PR] = {}
+        # PRs merged by the current check, with their branch and dependents, cleaned up at its end.
+        self.cleanups: List[Tuple[PR, str, List[PR]]] = []
+
+    def may_write(self) -> bool:
+        if self.dry_run:
+            return False
+        if self.guard is None or self.guard():
+            return True
+        log.warning('Lost the ownership of the queue of %s, not writing to it.', self.gh_repo.full_name)
+        return False
+
+    def dry_run_copy(self) -> 'MergeQueue':
+        """
+        Copy of the queue to check without side effects: nothing is written
+        to GitHub, the journal or the stats, and this queue is left alone.
+        """
+        with self.lock:
+            copy = MergeQueue(self.gh_repo, self.max_pulled_prs, list(self.queue),
+                              initial_pulled_prs=list(self.pulled_prs), lanes=self.lanes)
+            copy.chained = dict(self.chained)
+        copy.dry_run = True
+        return copy
+
+    def next_version(self) -> int:
+        return next(self.versions)
+
+    def journal_pr(self, pr: PR):
+        self.journal.record('put', pr=pr.to_state())
+
+    def journal_order(self):
+        self.journal.record('order', nbs=[pr.nb for pr in self.queue])
+
+    def journal_pulled(self):
+        self.journal.record('pulled', nbs=list(self.pulled_prs))
 
     def get_queue(self) -> List[PR]:
         """
@@ -53,37 +141,172 @@ class MergeQueue:
         """
         return self.pulled_prs
 
-    def get_pr(self, pr_nb: int) -> Tuple[Union[PR], Union[Any]]:
+    @traced()
+    def get_pr(self, pr_nb: int, gh_repo=None) -> Tuple[Union[PR], Union[Any]]:
         """
         Get PR from the repo.
+        :param gh_repo: repo to ask instead of the one of the queue.
         """
         try:
-            gh_pr = self.gh_repo.get_pull(pr_nb)
+            gh_pr = (gh_repo or self.gh_repo).get_pull(pr_nb)
             return PR(gh_pr), gh_pr
         except Exception:
             raise MergeQueueException('Could not find this PR.')
 
-    def ask_pr(self, pr_nb: int):
+    def pr_version(self, pr_nb: int) -> Optional[int]:
+        """
+        :return: the version of a PR of the queue, None if it is not in it.
+        """
+        if pr_nb not in self.queue:
+            return None
+        return getattr(self.queue[self.queue.index(pr_nb)], 'version', None) or 0
+
+    def fetch_pr(self, pr_nb: int) -> PR:
+        """
+        The network half of asking for a PR, done without holding the lock.
+        """
         if pr_nb in self.queue:
             raise MergeQueueException('This PR is already in the queue.')
-
         pr, _ = self.get_pr(pr_nb)
         if pr.state == 'closed':
             raise MergeQueueException('This PR is already closed.')
+        return pr
 
+    def fetch_prs(self, pr_nbs: List[int] = (), search: str = None) -> Tuple[List[PR], Dict[int, str]]:
+        """
+        The network half of asking for many PRs: the ones given by number and
+        the open ones matching a GitHub search, fetched in batches.
+        :return: the PRs that can be added, and why the others cannot.
+        """
+        refused = {}
+        wanted = []
+        for pr_nb in dict.fromkeys(pr_nbs):
+            if pr_nb in self.queue:
+                refused[pr_nb] = 'already in the queue'
+            else:
+                wanted.append(pr_nb)
+
+        if requester(self.gh_repo) is not None:
+            pulls = list(fetch_pulls(self.gh_repo, wanted).values()) if wanted else []
+            if search:
+                pulls.extend(search_pulls(self.gh_repo, search))
+        else:  # no GraphQL behind this repo, one PR at a time
+            if search:
+                raise MergeQueueException('Searching is not available for this repository.')
+            pulls = []
+            for pr_nb in wanted:
+                try:
+                    pulls.append(self.gh_repo.get_pull(pr_nb))
+                except Exception:
+                    log.debug('Could not fetch PR %s.', pr_nb, exc_info=True)
+
+        prs = []
+        for pull in pulls:
+            if pull.number in self.queue:
+                refused[pull.number] = 'already in the queue'
+            elif pull.state == 'closed':
+                refused[pull.number] = 'closed'
+            elif pull.number not in prs:
+                prs.append(PR(pull))
+        for pr_nb in wanted:
+            if pr_nb not in prs and pr_nb not in refused:
+                refused[pr_nb] = 'not found'
+        return prs, refused
+
+    def sync_auto_label(self) -> Tuple[List[PR], List[PR]]:
+        """
+        Follow the auto label with one search: add the open PRs that have it,
+        remove the PRs it added that lost it. After the first sweep only the
+        PRs updated since the last one are searched, labelling a PR updates it.
+        :return: the PRs added and the PRs removed.
+        """
+        if not self.auto_label:
+            return [], []
+        full_sweep = self.label_watermark is None
+        if full_sweep:
+            pulls = search_pulls(self.gh_repo, f'label:"{self.auto_label}"')
+        else:
+            pulls = search_pulls(self.gh_repo, f'updated:>={self.label_watermark}', sort='updated-asc')
+        if pulls:
+            self.label_watermark = max([self.label_watermark or ''] + [pull.updated_at for pull in pulls])
+
+        labelled = {pull.number for pull in pulls if any(label.name == self.auto_label for label in pull.labels)}
+        new_prs = [PR(pull) for pull in pulls if pull.number in labelled and pull.number not in self.queue]
+        if full_sweep and len(pulls) < MAX_SEARCH_RESULTS:
+            # All the open labelled PRs are known: the other open ones lost it, maybe while the bot was
+            # down. The ones merged or closed in the meantime are left to the check, which cleans up after them.
+            missing = [pr.nb for pr in self.queue if pr.nb not in labelled and getattr(pr, 'auto', False)]
+            unlabelled = [pull.number for pull in (fetch_pulls(self.gh_repo, missing).values() if missing else ())
+                          if pull.state == 'open' and not any(label.name == self.auto_label for label in pull.labels)]
+        else:
+            unlabelled = [pull.number for pull in pulls if pull.number not in labelled]
+        added, removed = [], []
+        with self.lock:
+            for pr in new_prs:
+                if pr.nb not in self.queue:
+                    pr.auto = True
+                    self.append_pr(pr, DEFAULT_LANE)
+                    added.append(pr)
+            for pr_nb in unlabelled:
+                if pr_nb not in self.queue:
+                    continue
+                pr = self.queue[self.queue.index(pr_nb)]
+                if getattr(pr, 'auto', False):
+                    self.rm_pr(pr_nb)
+                    removed.append(pr)
+            self.revision += 1
+        return added, removed
+
+    def ask_pr(self, pr_nb: int, lane: str = DEFAULT_LANE):
+        self.check_lane(lane)
+        self.add_pr(self.fetch_pr(pr_nb), lane)
+
+    def append_pr(self, pr: PR, lane: str):
+        pr.version = self.next_version()
+        pr.lane = lane
         self.queue.append(pr)
+        self.journal_pr(pr)
         self.stats.send_event('added', pr)
 
+    @mutation
+    def add_pr(self, pr: PR, lane: str = DEFAULT_LANE):
+        """
+        Append a PR fetched by fetch_pr.
+        """
+        if pr.nb in self.queue:
+            raise MergeQueueException('This PR is already in the queue.')
+        self.check_lane(lane)
+        self.append_pr(pr, lane)
+
+    @mutation
+    def add_prs(self, prs: List[PR], lane: str = DEFAULT_LANE) -> List[int]:
+        """
+        Append the PRs fetched by fetch_prs in one go.
+        :return: the ones skipped because they got queued in the meantime.
+        """
+        self.check_lane(lane)
+        skipped = []
+        for pr in prs:
+            if pr.nb in self.queue:
+                skipped.append(pr.nb)
+            else:
+                self.append_pr(pr, lane)
+        return skipped
+
+    @mutation
     def rm_pr(self, pr_nb: Union[int, PR]):
         if pr_nb not in self.queue:
             raise MergeQueueException('This PR is not on this queue.')
 
-        pr = self.queue.remove(pr_nb)
+        pr = self.queue.pop(self.queue.index(pr_nb))
+        self.journal.record('remove', nb=int(pr_nb))
         if pr_nb in self.pulled_prs:
             self.pulled_prs.remove(pr_nb)
+            self.journal_pulled()
 
         self.stats.send_event('removed', pr)
 
+    @mutation
     def bless_pr(self, pr_nb: Union[int, PR]):
         if pr_nb not in self.queue:
             raise MergeQueueException('This PR is not on this queue.')
@@ -91,9 +314,12 @@ class MergeQueue:
         index = self.queue.index(pr_nb)
         pr = self.queue[index]
         pr.blessed = True
+        pr.version = self.next_version()
+        self.journal_pr(pr)
         self.stats.send_event('blessed', pr)
         self.stats.send_metric('queue_time_to_bless', pr.get_queue_time(), pr)
 
+    @mutation
     def bump_pr(self, pr_nb: Union[int, PR]):
         if pr_nb not in self.queue:
             raise MergeQueueException('This PR is not on this queue.')
@@ -103,6 +329,7 @@ class MergeQueue:
             raise MergeQueueException('Only a blessed :angel: PR can ascend to the front of the queue')
 
         self.queue.insert(0, self.queue.pop(index))
+        self.journal_order()
 
         if pr_nb in self.pulled_prs:
             self.pulled_prs.insert(0, self.pulled_prs.pop(self.pulled_prs.index(pr_nb)))
@@ -110,13 +337,56 @@ class MergeQueue:
             if len(self.pulled_prs) >= self.max_pulled_prs:
                 self.remove_pulled_pr(self.pulled_prs[-1])
             self.pulled_prs.insert(0, pr_nb)
+        self.journal_pulled()
 
+    @mutation
     def sink_pr(self, pr_nb: Union[int, PR]):
         if pr_nb not in self.queue:
             raise MergeQueueException('This PR is not on this queue.')
 
         self.queue.append(self.queue.pop(self.queue.index(pr_nb)))
+        self.journal_order()
+
+    def check_lane(self, lane: str):
+        if lane not in self.lanes:
+            raise MergeQueueException(f'Unknown lane {lane}, pick one of {", ".join(self.lanes)}.')
 
+    @mutation
+    def move_pr(self, pr_nb: Union[int, PR], lane: str):
+        """
+        Move a PR to another priority lane.
+        """
+        if pr_nb not in self.queue:
+            raise MergeQueueException('This PR is not on this queue.')
+        self.check_lane(lane)
+
+        pr = self.queue[self.queue.index(pr_nb)]
+        pr.lane = lane
+        pr.version = self.next_version()
+        self.journal_pr(pr)
+        self.stats.send_event('lane_changed', pr)
+
+    def scheduled_queue(self) -> List[PR]:
+        """
+        Order in which the PRs get the merge and pull slots: lanes are
+        interleaved by smooth weighted round robin, first come first served
+        within a lane.
+        """
+        lanes = OrderedDict((lane, deque()) for lane in self.lanes)
+        for pr in self.queue:
+            lanes.setdefault(getattr(pr, 'lane', DEFAULT_LANE), deque()).append(pr)
+        credits = {lane: 0 for lane in lanes}
+        scheduled = []
+        while len(scheduled) < len(self.queue):
+            active = [lane for lane, prs in lanes.items() if prs]
+            for lane in active:
+                credits[lane] += self.lanes.get(lane, 1)
+            elected = max(active, key=lambda lane: credits[lane])
+            credits[elected] -= sum(self.lanes.get(lane, 1) for lane in active)
+            scheduled.append(lanes[elected].popleft())
+        return scheduled
+
+    @mutation
     def excommunicate_pr(self, pr_nb: Union[int, PR]):
         if pr_nb not in self.queue:
             raise MergeQueueException('This PR is not on this queue.')
@@ -124,9 +394,12 @@ class MergeQueue:
         index = self.queue.index(pr_nb)
         pr = self.queue[index]
         pr.blessed = False
+        pr.version = self.next_version()
+        self.journal_pr(pr)
         self.stats.send_event('excommunicated', pr)
         if pr_nb in self.pulled_prs:
             self.pulled_prs.remove(pr_nb)
+            self.journal_pulled()
 
     def get_pending_statuses(self, pr: PR) -> List:
         """
@@ -139,130 +412,424 @@ class MergeQueue:
                 requirements.remove(status.context)
         return requirements
 
-    def check_required_statuses(self, pr: PR) -> bool:
+    @traced()
+    def check_required_statuses(self, pr: PR, gh_repo=None) -> bool:
         """
         Return if a PR has met all the required status checks for its base
         branch.
         """
-        requirements = list(self.gh_repo.get_branch(pr.base).contexts)
-        for status in self.gh_repo.get_commit(pr.head).get_statuses():
+        gh_repo = gh_repo or self.gh_repo
+        requirements = list(gh_repo.get_branch(pr.base).contexts)
+        for status in gh_repo.get_commit(pr.head).get_statuses():
             if status.context in requirements and status.state == 'success':
                 requirements.remove(status.context)
 
         return len(requirements) < 1
 
-    def get_dependents_prs(self, pr: PR) -> List[PR]:
+    @traced()
+    def get_dependents_prs(self, pr: PR, seen: Set[int] = None, gh_repo=None) -> List[PR]:
         """
-        Return a list of dependent PRs.
+        Return a list of dependent PRs, the ones outside the queue are kept in
+        `chained`.
+        :param seen: PR numbers already in the tree, used to break cycles.
+        :param gh_repo: repo to ask instead of the one of the queue.
         """
+        if seen is None:
+            seen = {pr.nb}
         dependents = []
-        for dependent_pr in self.gh_repo.get_pulls(base=pr.head):
+        for dependent_pr in (gh_repo or self.gh_repo).get_pulls(base=pr.head):
+            if dependent_pr.number in seen:
+                log.warning('PR %s is chained in a cycle with %s, ignoring it.', dependent_pr.number, pr.nb)
+                continue
+            seen.add(dependent_pr.number)
             element = [existing_pr for existing_pr in self.queue if
                        existing_pr.nb == dependent_pr.number]
             if len(element) > 0:
                 dependents.append(element[0])
             else:
                 new_pr = PR(dependent_pr)
-                new_pr.dependents = self.get_dependents_prs(new_pr)
+                new_pr.chain(self.get_dependents_prs(new_pr, seen, gh_repo))
+                self.chained[new_pr.nb] = new_pr
                 dependents.append(new_pr)
         return dependents
 
+    def dependents_of(self, pr: PR) -> List[PR]:
+        """
+        The PRs chained directly on a PR, as far as the last check knows them.
+        The chained PRs are not stored: after a restart, the ones no check
+        saw yet are left out and their PR is marked stale, the next check
+        fetches them with their own tree (not done here, on the render path).
+        """
+        with self.lock:
+            queued = {queued_pr.nb: queued_pr for queued_pr in self.queue}
+            dependents = [queued.get(nb) or self.chained.get(nb) for nb in pr.dependents]
+            if None in dependents and pr.nb in queued and self.stale_prs is not None:
+                self.stale_prs.add(pr.nb)
+        return [dependent for dependent in dependents if dependent is not None]
+
+    def prune_chained(self):
+        """
+        Forget the chained PRs no queued PR leads to anymore.
+        """
+        chained, todo = {}, [nb for pr in self.queue for nb in pr.dependents]
+        while todo:
+            nb = todo.pop()
+            if nb in chained or nb not in self.chained:
+                continue
+            chained[nb] = self.chained[nb]
+            todo.extend(chained[nb].dependents)
+        self.chained = chained
+
     def count_dependent_prs(self, pr: PR) -> int:
         """
-        Recursively count the number of dependent PRs.
+        Count the number of dependent PRs (precomputed when the tree is built).
         """
-        count = 0
-        for dependents in pr.dependents:
-            count += 1 + self.count_dependent_prs(dependents)
-        return count
+        return pr.dependents_count
 
+    @mutation
     def remove_pulled_pr(self, pr_nb: int) -> bool:
         if pr_nb not in self.pulled_prs:
             return False
         self.pulled_prs.remove(pr_nb)
+        self.journal_pulled()
         return True
 
-    def check(self) -> Generator[Tuple[PR, List[PRTransitionParams]], None, None]:
-        new_queue = []
-        already_merging_a_pr = False
+    def list_changes(self):
+        """
+        For incremental checks, find out which PRs changed since the previous
+        listing: the pulls of the repo sorted by last update, read until the
+        watermark, and the head of the base branches of the queue (a base
+        that moved changes the mergeability of its PRs without updating them).
+        To call on the real repository, before the check.
+        """
+        if not self.incremental:
+            return
+        try:
+            listed, newest = set(), self.update_watermark
+            for pull in self.gh_repo.get_pulls(state='all', sort='updated', direction='desc'):
+                if self.update_watermark is not None and pull.updated_at < self.update_watermark:
+                    break
+                listed.add(pull.number)
+                newest = max(newest, pull.updated_at) if newest else pull.updated_at
+                if self.update_watermark is None:
+                    break  # first listing, everything is refreshed anyway
+            base_shas = {base: self.gh_repo.get_branch(base).commit.sha for base in {pr.base for pr in self.queue}}
+        except Exception:
+            log.exception('Could not list the changes of %s, refreshing all its PRs.', self.gh_repo.full_name)
+            self.stale_prs = None
+            return
+        with self.lock:
+            if self.update_watermark is not None and self.stale_prs is not None:
+                moved = {base for base, sha in base_shas.items() if self.base_shas.get(base) != sha}
+                self.stale_prs |= listed | {pr.nb for pr in self.queue if pr.base in moved}
+            else:
+                self.stale_prs = None
+            self.update_watermark = newest
+            self.base_shas = base_shas
 
-        for idx, old_pr in enumerate(self.queue):
-            log.debug('Checking pr %s...', old_pr.nb)
-            new_pr, gh_pr = self.get_pr(old_pr.nb)
-            if not new_pr:  # it errored
-                continue
-            new_states = []
-            new_pr.dependents = self.get_dependents_prs(new_pr)
-            if gh_pr.merged:
-                new_states.append((PRTransition.MERGED, None))
-                if self.remove_pulled_pr(old_pr.nb):
-                    new_states.append((PRTransition.RELEASED, None))
-
-                for dependent in new_pr.dependents:
-                    _, dependent_gh_pr = self.get_pr(dependent.nb)
-                    if not _:  # it errored
-                        continue
+    def always_refreshed(self, pr: PR) -> bool:
+        """
+        Blessed, pulled and unknown PRs: their statuses and mergeability
+        change without updating them.
+        """
+        return pr.blessed or pr.nb in self.pulled_prs or pr.mergeable_state == 'unknown'
 
-                    try:
-                        dependent_gh_pr.edit(base=new_pr.base)
-                        new_states.append((PRTransition.NEW_BASE, (dependent.nb, dependent.url, new_pr.base)))
-                    except Exception:
-                        new_states.append((PRTransition.NEW_BASE_ERROR, (dependent.nb, dependent.url, new_pr.base)))
+    def to_refresh(self, max_prs: int = None) -> List[Tuple[int, PR]]:
+        """
+        PRs the next check refreshes, with their position in scheduling
+        order, minus the ones an incremental check can keep as they are.
+        With max_prs, the PRs always refreshed go first and the others share
+        what is left in turns: the window starts where the previous check
+        stopped.
+        """
+        with self.lock:
+            stale = self.stale_prs if self.incremental else None
+            first, others = [], []
+            for idx, pr in enumerate(self.scheduled_queue()):
+                if self.always_refreshed(pr):
+                    first.append((idx, pr))
+                elif stale is None or pr.nb in stale:
+                    others.append((idx, pr))
+            if max_prs is not None and len(first) + len(others) > max_prs:
+                start = self.refresh_offset % len(others) if others else 0
+                others = (others[start:] + others[:start])[:max(0, max_prs - len(first))]
+                first = first[:max_prs]
+        return sorted(first + others, key=lambda item: item[0])
+
+    def check(self, max_prs: int = None, gh_repo=None) -> Generator[Tuple[PR, List[PRTransitionParams]], None, None]:
+        """
+        Refresh the PRs of the queue and act on them.
+        :param max_prs: only refresh the first PRs in scheduling order, the
+                        others keep their last known state until next time.
+        :param gh_repo: repo the check talks to instead of the one of the
+                        queue (for example one answering from prefetched
+                        data), the commands keep using the latter.
+        """
+        staying = {}
+        already_merging_a_pr = bool(self.unverified_merges)
+        self.unknown_prs = []
+
+        checked = {}
+        refreshed = set()
+        window = self.to_refresh(max_prs)
+        self.refresh_offset += sum(not self.always_refreshed(pr) for _, pr in window)
+        for idx, old_pr in window:
+            checked[old_pr.nb] = getattr(old_pr, 'version', None) or 0
+            new_pr, new_states, stays, merging = self.check_pr(idx, old_pr, not already_merging_a_pr, gh_repo)
+            already_merging_a_pr = already_merging_a_pr or merging
+            if new_pr is not old_pr:
+                refreshed.add(old_pr.nb)
+            if stays:
+                staying[old_pr.nb] = new_pr
+            if new_states:
+                yield new_pr, new_states
+        yield from self.clean_up(gh_repo)
+        with self.lock:
+            queue = []
+            for live_pr in self.queue:
+                if live_pr.nb not in checked:
+                    queue.append(live_pr)  # not refreshed, or asked for during the check
+                elif live_pr.nb in staying:
+                    queue.append(self.reconcile(live_pr, staying[live_pr.nb], checked[live_pr.nb]))
+            self.queue = queue
+            self.revision += 1
+            self.prune_chained()
+            self.unverified_merges.intersection_update(pr.nb for pr in queue)
+            if self.incremental:
+                stale = self.stale_prs if self.stale_prs is not None else {pr.nb for pr in queue}
+                self.stale_prs = {pr.nb for pr in queue if pr.nb in stale and pr.nb not in refreshed}
+        self.journal.sync()
+
+    def reconcile(self, live_pr: PR, new_pr: PR, checked_version: int) -> PR:
+        """
+        The refreshed version of a PR, keeping what commands changed on it
+        while it was being refreshed (blessing, lane).
+        """
+        live_version = getattr(live_pr, 'version', None) or 0
+        if new_pr is live_pr or live_version == checked_version:
+            return new_pr
+        new_pr.blessed = live_pr.blessed
+        new_pr.lane = getattr(live_pr, 'lane', DEFAULT_LANE)
+        new_pr.version = self.next_version()
+        self.journal_pr(new_pr)
+        return new_pr
+
+    def recheck(self, pr_nbs: List[int], gh_repo=None) -> Generator[Tuple[PR, List[PRTransitionParams]], None, None]:
+        """
+        Refresh and act on only some PRs of the queue, for example the ones
+        GitHub was still computing the mergeability of during the last check.
+        :param gh_repo: see check().
+        """
+        already_merging_a_pr = bool(self.unverified_merges)
+        self.unknown_prs = []
+
+        with self.lock:
+            scheduled = self.scheduled_queue()
+        for idx, old_pr in enumerate(scheduled):
+            if old_pr.nb not in pr_nbs:
+                continue
+            checked_version = getattr(old_pr, 'version', None) or 0
+            new_pr, new_states, stays, merging = self.check_pr(idx, old_pr, not already_merging_a_pr, gh_repo)
+            already_merging_a_pr = already_merging_a_pr or merging
+            with self.lock:
+                if old_pr.nb in self.queue:  # not removed meanwhile
+                    position = self.queue.index(old_pr.nb)
+                    if stays:
+                        self.queue[position] = self.reconcile(self.queue[position], new_pr, checked_version)
+                    else:
+                        del self.queue[position]
+                    self.revision += 1
+            if new_states:
+                yield new_pr, new_states
+        yield from self.clean_up(gh_repo)
+        self.journal.sync()
 
-                #  Automatically delete the branch that has been merged and after the children have been updated.
+    @traced()
+    def clean_up(self, gh_repo=None) -> Generator[Tuple[PR, List[PRTransitionParams]], None, None]:
+        """
+        Move the dependents of the PRs merged by the check onto their base and
+        delete the merged branches, with a few GraphQL requests when possible.
+        A branch is kept when some of its dependents could not be moved,
+        deleting it would close them.
+        :param gh_repo: see check().
+        """
+        cleanups, self.cleanups = self.cleanups, []
+        if not cleanups:
+            return
+        gh_repo = gh_repo or self.gh_repo
+        bases = {dependent.nb: merged_pr.base for merged_pr, _, dependents in cleanups for dependent in dependents}
+        if bases and requester(gh_repo):
+            try:
+                failed = retarget_pulls(gh_repo, bases)
+            except Exception:
+                log.exception('Could not change the base of %s.', sorted(bases))
+                failed = set(bases)
+        else:
+            failed = set()
+            for pr_nb, base in bases.items():
+                try:
+                    gh_repo.get_pull(pr_nb).edit(base=base)
+                except Exception:
+                    log.exception('Could not change the base of %s.', pr_nb)
+                    failed.add(pr_nb)
+        invalidate = getattr(gh_repo, 'invalidate', None)  # snapshots
+        for pr_nb in bases if invalidate else ():
+            invalidate(pr_nb)
+
+        branches = [branch for _, branch, dependents in cleanups
+                    if not any(dependent.nb in failed for dependent in dependents)]
+        if branches and requester(gh_repo):
+            try:
+                kept = delete_branches(gh_repo, branches)
+            except Exception:
+                kept = set(branches)
+            if kept:
+                log.error('Could not delete the merged branches %s.', sorted(kept))
+        else:
+            for branch in branches:
                 try:
-                    self.gh_repo.get_git_ref(f'heads/{gh_pr.head.ref}').delete()
-                except:
-                    log.exception('Could not remote a dangling PR branch.')
-            elif new_pr.state != 'open':
-                new_states.append((PRTransition.CLOSED, None))
-                if self.remove_pulled_pr(new_pr.nb):
-                    new_states.append((PRTransition.RELEASED, None))
+                    gh_repo.get_git_ref(f'heads/{branch}').delete()
+                except Exception:
+                    log.exception('Could not delete the merged branch %s.', branch)
 
-            else:
-                # forward the state
-                new_pr.blessed = old_pr.blessed
-                new_pr.start_time = old_pr.start_time if hasattr(old_pr, 'start_time') else PR.generate_start_time()
-                if new_pr.mergeable_state == 'unknown':
-                    # Keep the last known state: if it comes back
-                    # to the same state we don't spam the chat.
-                    new_pr.mergeable_state = old_pr.mergeable_state
-                elif new_pr.mergeable_state == 'unstable':
-                    # The GH will mark  a PR as unstable if a
-                    # non-required status check has not passed
-                    new_pr.mergeable_state = 'clean' if self.check_required_statuses(new_pr) else new_pr.mergeable_state
-                elif new_pr.mergeable_state == 'dirty':
-                    #Dirty PR signify merge conflicts and will back up the pull queue
-                    self.remove_pulled_pr(new_pr.nb)
-
-                new_queue.append(new_pr)
-                if old_pr.positive != new_pr.positive:
-                    new_states.append((PRTransition.GOT_POSITIVE, new_pr.positive))
-                if old_pr.negative != new_pr.negative:
-                    new_states.append((PRTransition.GOT_NEGATIVE, new_pr.negative))
-                if old_pr.mergeable and not new_pr.mergeable:
-                    new_states.append((PRTransition.NO_LONGER_MERGEABLE, None))
-                if not old_pr.mergeable and new_pr.mergeable:
-                    new_states.append((PRTransition.NOW_MERGEABLE, None))
-                if self.count_dependent_prs(old_pr) != self.count_dependent_prs(new_pr):
-                    new_states.append((PRTransition.NEW_CHAINED_PR, self.count_dependent_prs(new_pr)))
-
-                if not already_merging_a_pr and new_pr.mergeable_state == 'clean' and new_pr.is_ready_to_merge():
-                    new_states.append((PRTransition.MERGING, None))
-                    gh_pr.merge(commit_title='Merged automatically by argobot.')
-                    self.stats.send_event('merged', new_pr)
-                    self.stats.send_metric('queue_time_to_merge', new_pr.get_queue_time(), new_pr)
-                    already_merging_a_pr = True
-                elif new_pr.blessed and new_pr.mergeable_state == 'behind':
-                    if new_pr.nb not in self.pulled_prs and len(self.pulled_prs) < self.max_pulled_prs:
-                        self.pulled_prs.append(new_pr.nb)
-                        new_states.append((PRTransition.PULLED, None))
-                    # pull the base of the PR into the PR.
-                    if new_pr.nb in self.pulled_prs:
-                        if self.gh_repo.merge(base=gh_pr.head.ref, head=gh_pr.base.ref):
-                            new_states.append((PRTransition.PULLED_SUCCESS, None))
-                        else:
-                            new_states.append((PRTransition.PULLED_FAILURE, None))
+        for merged_pr, _, dependents in cleanups:
+            new_states = [(PRTransition.NEW_BASE_ERROR if dependent.nb in failed else PRTransition.NEW_BASE,
+                           (dependent.nb, dependent.url, merged_pr.base)) for dependent in dependents]
             if new_states:
-                yield new_pr, new_states
-        self.queue = new_queue
+                self.journal.record('transition', nb=merged_pr.nb, states=transition_record(new_states))
+                yield merged_pr, new_states
+
+    @traced()
+    def check_pr(self, idx: int, old_pr: PR, can_merge: bool,
+                 gh_repo=None) -> Tuple[PR, List[PRTransitionParams], bool, bool]:
+        """
+        Refresh a PR of the queue and act on it.
+        :param idx: position of the PR in the queue.
+        :param can_merge: False if another PR is already being merged.
+        :param gh_repo: see check().
+        :return: the refreshed PR, its transitions, if it stays in the queue
+                 and if it is now being merged.
+        """
+        log.debug('Checking pr %s...', old_pr.nb)
+        current().set(pr=old_pr.nb)
+        try:
+            new_pr, gh_pr = self.get_pr(old_pr.nb, gh_repo)
+            dependents = self.get_dependents_prs(new_pr, gh_repo=gh_repo)
+            new_pr.chain(dependents)
+        except Exception:
+            # Don't let one PR abort the whole room, it will be retried next cycle.
+            log.exception('Could not refresh PR %s, keeping its last known state.', old_pr.nb)
+            return old_pr, [], True, False
+        if old_pr.nb in self.unverified_merges:
+            self.unverified_merges.discard(old_pr.nb)
+            if not gh_pr.merged:
+                log.warning('The merge of PR %s did not go through before the restart.', old_pr.nb)
+        new_states = []
+        journaled = 0  # the transitions already written ahead
+        stays = False
+        merging = False
+        if gh_pr.merged:
+            new_states.append((PRTransition.MERGED, None))
+            if self.remove_pulled_pr(old_pr.nb):
+                new_states.append((PRTransition.RELEASED, None))
+
+            if self.may_write():
+                # Done for all the merged PRs at once, once the rest of the queue is evaluated.
+                self.cleanups.append((new_pr, gh_pr.head.ref, dependents))
+        elif new_pr.state != 'open':
+            new_states.append((PRTransition.CLOSED, None))
+            if self.remove_pulled_pr(new_pr.nb):
+                new_states.append((PRTransition.RELEASED, None))
+
+        else:
+            # forward the state
+            new_pr.blessed = old_pr.blessed
+            new_pr.lane = getattr(old_pr, 'lane', DEFAULT_LANE)
+            new_pr.auto = getattr(old_pr, 'auto', False)
+            new_pr.start_time = old_pr.start_time if hasattr(old_pr, 'start_time') else PR.generate_start_time()
+            if new_pr.mergeable_state == 'unknown':
+                # Keep the last known state: if it comes back
+                # to the same state we don't spam the chat.
+                new_pr.mergeable_state = old_pr.mergeable_state
+                if new_pr.blessed and (idx < max(1, self.max_pulled_prs) or new_pr.nb in self.pulled_prs):
+                    # Close to be merged, worth asking again soon.
+                    self.unknown_prs.append(new_pr.nb)
+            elif new_pr.mergeable_state == 'unstable':
+                # The GH will mark  a PR as unstable if a
+                # non-required status check has not passed
+                if self.check_required_statuses(new_pr, gh_repo):
+                    new_pr.mergeable_state = 'clean'
+            elif new_pr.mergeable_state == 'dirty':
+                #Dirty PR signify merge conflicts and will back up the pull queue
+                self.remove_pulled_pr(new_pr.nb)
+
+            old_version = getattr(old_pr, 'version', None) or 0
+            changed = new_pr.display_state() != old_pr.display_state()
+            new_pr.version = self.next_version() if changed else old_version
+
+            stays = True
+            if old_pr.positive != new_pr.positive:
+                new_states.append((PRTransition.GOT_POSITIVE, new_pr.positive))
+            if old_pr.negative != new_pr.negative:
+                new_states.append((PRTransition.GOT_NEGATIVE, new_pr.negative))
+            if old_pr.mergeable and not new_pr.mergeable:
+                new_states.append((PRTransition.NO_LONGER_MERGEABLE, None))
+            if not old_pr.mergeable and new_pr.mergeable:
+                new_states.append((PRTransition.NOW_MERGEABLE, None))
+            if old_pr.dependents_count != new_pr.dependents_count:
+                new_states.append((PRTransition.NEW_CHAINED_PR, new_pr.dependents_count))
+
+            if any(new_pr.base == branch for _, branch, _ in self.cleanups):
+                # Based on a PR merged during this check: its branch is about to be deleted, the PR is
+                # merged or pulled once the clean up moved it onto the new base.
+                log.debug('Holding PR %s until it is moved off %s.', new_pr.nb, new_pr.base)
+            elif can_merge and new_pr.mergeable_state == 'clean' and new_pr.is_ready_to_merge() \
+                    and self.may_write():
+                new_states.append((PRTransition.MERGING, None))
+                # Write ahead: a crash after the merge must not lose it.
+                self.journal.record('transition', nb=new_pr.nb, states=transition_record(new_states))
+                self.journal.sync()
+                journaled = len(new_states)
+                with span('merge', pr=new_pr.nb):
+                    try:
+                        gh_pr.merge(commit_title='Merged automatically by argobot.')
+                    except Exception:
+                        # Not retried, it may have gone through: the next check tells.
+                        log.exception('Could not merge PR %s.', new_pr.nb)
+                    else:
+                        self.stats.send_event('merged', new_pr)
+                        self.stats.send_metric('queue_time_to_merge', new_pr.get_queue_time(), new_pr)
+                merging = True
+            elif new_pr.blessed and new_pr.mergeable_state == 'behind':
+                with self.lock:
+                    pulled = new_pr.nb not in self.pulled_prs and len(self.pulled_prs) < self.max_pulled_prs
+                    if pulled:
+                        self.pulled_prs.append(new_pr.nb)
+                        self.journal_pulled()
+                if pulled:
+                    self.journal.sync()
+                    new_states.append((PRTransition.PULLED, None))
+                # pull the base of the PR into the PR.
+                if new_pr.nb in self.pulled_prs and self.may_write():
+                    with span('pull', pr=new_pr.nb) as pull_span:
+                        try:
+                            pulled = (gh_repo or self.gh_repo).merge(base=gh_pr.head.ref, head=gh_pr.base.ref)
+                        except Exception as e:
+                            # GitHub answers a conflict with a 409.
+                            log.info('Could not pull the base of PR %s: %s', new_pr.nb, e)
+                            pulled = None
+                        pull_span.set(success=bool(pulled))
+                    if pulled:
+                        new_states.append((PRTransition.PULLED_SUCCESS, None))
+                        self.stats.send_event('pulled', new_pr)
+                    else:
+                        new_states.append((PRTransition.PULLED_FAILURE, None))
+                        self.stats.send_event('pull_failed', new_pr)
+
+        if not stays:
+            self.journal.record('remove', nb=old_pr.nb)
+        elif new_pr.version != old_version or new_states:
+            self.journal_pr(new_pr)
+        if new_states[journaled:]:
+            self.journal.record('transition', nb=new_pr.nb, states=transition_record(new_states[journaled:]))
+        return new_pr, new_states, stays, merging
@@ -13,22 +13,45 @@
 #    limitations under the License.
 
 from enum import Enum, auto
-from typing import List, Tuple, Mapping
+from typing import Iterable, List, Optional, Tuple, Mapping
+import sys
 import time
 from github_wrapper import PullRequest
 
+DEFAULT_LANE = 'normal'
+# Only the first lines of the descriptions are kept, the verbose listing shows nothing more.
+DESCRIPTION_LINES = 5
+MAX_DESCRIPTION = 1000
+
+
+def intern(value):
+    """
+    Share the strings repeated across PRs (users, branches, states).
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def short_description(body: Optional[str]) -> Optional[str]:
+    if not body:
+        return body
+    return '\n'.join(body.splitlines()[:DESCRIPTION_LINES])[:MAX_DESCRIPTION]
+
 
 class PR:
     """
     This is our internal representation of a PR.
     """
+    __slots__ = ('nb', 'blessed', 'lane', 'url', 'user', 'state', 'positive', 'negative', 'pending', 'mergeable',
+                 'mergeable_state', 'title', 'description', 'head', 'base', 'dependents', 'dependents_count',
+                 'start_time', 'version', 'auto')
 
     def __init__(self, gh_pr: PullRequest, dependents: List['PR'] = None):
         self.nb = gh_pr.number
         self.blessed = False
+        self.lane = DEFAULT_LANE
         self.url = gh_pr.html_url
-        self.user = gh_pr.user.login
-        self.state = gh_pr.state
+        self.user = intern(gh_pr.user.login)
+        self.state = intern(gh_pr.state)
         self.positive = 0
         self.negative = 0
         self.pending = 0
@@ -46,22 +69,53 @@ class PR:
                         self.pending += 1
 
         self.mergeable = gh_pr.mergeable
-        self.mergeable_state = gh_pr.mergeable_state
+        self.mergeable_state = intern(gh_pr.mergeable_state)
         self.title = gh_pr.title
-        self.description = gh_pr.body
+        self.description = short_description(gh_pr.body)
 
-        self.head = gh_pr.head.ref
-        self.base = gh_pr.base.ref
-        self._dependents = dependents if dependents else []
+        self.head = intern(gh_pr.head.ref)
+        self.base = intern(gh_pr.base.ref)
+        self.chain(dependents or ())
         self.start_time = time.time()
+        # Bumped by the MergeQueue when the PR changes, None for PRs outside a queue.
+        self.version = None
+        # Added because of its label, and removed when the label goes away.
+        self.auto = False
 
-    @property
-    def dependents(self) -> List['PR']:
-        return self._dependents
+    def chain(self, dependents: Iterable['PR']):
+        """
+        Set the PRs based on this one. Only their numbers are kept, the size
+        of the whole tree is computed once.
+        """
+        dependents = tuple(dependents)
+        self.dependents: Tuple[int, ...] = tuple(dependent.nb for dependent in dependents)
+        self.dependents_count = sum(1 + dependent.dependents_count for dependent in dependents)
 
-    @dependents.setter
-    def dependents(self, value: List['PR']):
-        self._dependents = value
+    def __getstate__(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__ if hasattr(self, field)}
+
+    def __setstate__(self, state):
+        """
+        Also restores the PRs pickled before the slots: with a __dict__, and
+        their dependents as nested PRs.
+        """
+        if isinstance(state, tuple):  # (__dict__, slots)
+            state = {**(state[0] or {}), **(state[1] or {})}
+        state = dict(state)
+        dependents = state.pop('_dependents', state.pop('dependents', ()))
+        dependents_count = state.pop('_dependents_count', state.pop('dependents_count', None))
+        for field in self.__slots__:
+            setattr(self, field, state.get(field))
+        self.lane = self.lane or DEFAULT_LANE
+        self.auto = bool(self.auto)
+        self.description = short_description(self.description)
+        for field in ('user', 'state', 'mergeable_state', 'head', 'base'):
+            setattr(self, field, intern(getattr(self, field)))
+        if any(isinstance(dependent, PR) for dependent in dependents or ()):
+            self.chain(dependents)
+        else:
+            self.dependents = tuple(dependents or ())
+            self.dependents_count = len(self.dependents) if dependents_count is None else dependents_count
 
     def is_ready_to_merge(self) -> bool:
         """
@@ -70,6 +124,13 @@ class PR:
         return self.positive > 0 and self.negative < 1 and self.pending < 1 and self.mergeable and self.blessed \
                and self.mergeable_state in ('clean', 'behind')
 
+    def display_state(self) -> Tuple:
+        """
+        Everything that shows up when this PR is listed in the chat.
+        """
+        return (self.blessed, self.lane, self.url, self.user, self.title, self.description, self.positive,
+                self.negative, self.pending, self.mergeable, self.mergeable_state, self.dependents_count)
+
     def __hash__(self):
         return self.nb
 
@@ -86,6 +147,30 @@ class PR:
         """Return how long a PR has been in the queue"""
         return time.time() - self.start_time
 
+    STATE_FIELDS = ('nb', 'blessed', 'lane', 'url', 'user', 'state', 'positive', 'negative', 'pending', 'mergeable',
+                    'mergeable_state', 'title', 'description', 'head', 'base', 'start_time', 'version', 'auto',
+                    'dependents_count')
+
+    def to_state(self) -> dict:
+        """
+        JSON friendly copy of the PR, its dependents by number.
+        """
+        state = {field: getattr(self, field, None) for field in self.STATE_FIELDS}
+        state['dependents'] = list(self.dependents)
+        return state
+
+    @classmethod
+    def from_state(cls, state: Mapping) -> 'PR':
+        """
+        Rebuild a PR saved with to_state, without asking GitHub. Older states
+        have their dependents nested.
+        """
+        pr = cls.__new__(cls)
+        dependents = [cls.from_state(dependent) if isinstance(dependent, Mapping) else dependent
+                      for dependent in state.get('dependents', ())]
+        pr.__setstate__({**{field: state.get(field) for field in cls.STATE_FIELDS}, 'dependents': dependents})
+        return pr
+
 
 class PRTransition(Enum):
     """
@@ -0,0 +1,73 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Profile of one dry-run check of a queue, for `!merge profile`: where the time
+goes in the bot and in the GitHub API. The full profile is dumped for
+`python -m pstats` or snakeviz.
+"""
+from typing import List, Tuple
+import cProfile
+import os
+import pstats
+import time
+
+from github_wrapper import ApiProfile, profiling_api
+from mergequeue import MergeQueue
+
+# Functions and endpoints listed in the reply.
+TOP = 15
+
+
+def top_functions(profile: cProfile.Profile, top: int = TOP) -> List[Tuple[float, float, int, str]]:
+    """
+    :return: (cumulative seconds, own seconds, calls, function), by cumulative time.
+    """
+    stats = pstats.Stats(profile).stats
+    rows = [(cumulative, own, calls, f'{function} ({os.path.basename(path)}:{line})')
+            for (path, line, function), (_, calls, own, cumulative, _) in stats.items()]
+    return sorted(rows, key=lambda row: -row[0])[:top]
+
+
+def format_profile(seconds: float, transitions: int, functions: List, api: ApiProfile, path: str) -> str:
+    lines = [f'Dry-run check in {seconds:.2f}s, {transitions} PRs would have changed.', '',
+             'cumulative      own    calls  function']
+    lines.extend(f'{cumulative:9.3f}s {own:7.3f}s {calls:8d}  {function}'
+                 for cumulative, own, calls, function in functions)
+    lines.extend(['', 'calls     total   slowest      bytes  endpoint'])
+    lines.extend(f'{calls:5d} {total:8.3f}s {slowest:8.3f}s {size:10d}  {endpoint}'
+                 for endpoint, calls, total, slowest, size in api.summary()[:TOP])
+    lines.extend(['', f'{sum(len(calls) for calls in api.calls.values())} requests, {api.total_bytes()} bytes fetched.',
+                  f'Full profile in {path}'])
+    return '```\n' + '\n'.join(lines) + '\n```'
+
+
+def profile_check(merge_queue: MergeQueue, path: str) -> str:
+    """
+    Check a copy of the queue under the profiler, nothing is written anywhere
+    but the profile at path.
+    :return: the report for the chat.
+    """
+    dry_run = merge_queue.dry_run_copy()
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    with profiling_api() as api:
+        profile.enable()
+        try:
+            transitions = list(dry_run.check())
+        finally:
+            profile.disable()
+    seconds = time.perf_counter() - start
+    profile.dump_stats(path)
+    return format_profile(seconds, len(transitions), top_functions(profile), api, path)
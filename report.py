@@ -0,0 +1,271 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Throughput report of the merge queues from the history kept by the history
+stats plugin (`!merge statsplugin history /path/to/history.jsonl`):
+
+    python report.py history.jsonl --days 28
+
+The history is loaded once into columnar arrays (cached next to it in a .npz
+file) and every figure is computed with vectorized numpy operations.
+"""
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DAY = 86400
+WEEK = 7 * DAY
+PERCENTILES = (50, 90, 99)
+TOP = 5
+
+COLUMNS = ('time', 'kind', 'name', 'value', 'repo', 'pr', 'base')
+
+
+class History:
+    """
+    Columnar history: one array per field, strings are stored as codes into
+    the matching `<field>_names` array.
+    """
+
+    def __init__(self, columns: Dict[str, 'np.ndarray']):
+        self.columns = columns
+        for field, values in columns.items():
+            setattr(self, field, values)
+
+    def __len__(self):
+        return len(self.time)
+
+    def code(self, field: str, name: str) -> int:
+        """
+        Code of a string in a column, -1 if it never appears.
+        """
+        names = self.columns[f'{field}_names']
+        found = np.flatnonzero(names == name)
+        return int(found[0]) if len(found) else -1
+
+    def named(self, name: str, kind: str = None) -> 'np.ndarray':
+        mask = self.name == self.code('name', name)
+        if kind is not None:
+            mask &= self.kind == self.code('kind', kind)
+        return mask
+
+
+def parse(path: str, offset: int = 0) -> History:
+    """
+    Parse the history from a byte offset, only complete lines are read.
+    """
+    fields = {column: [] for column in COLUMNS}
+    codes = {column: {} for column in ('kind', 'name', 'repo', 'base')}
+    with open(path, 'rb') as history:
+        history.seek(offset)
+        for line in history:
+            if not line.endswith(b'\n'):  # being written
+                break
+            offset += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for column in COLUMNS:
+                value = record.get(column)
+                if column in codes:
+                    value = codes[column].setdefault(str(value or ''), len(codes[column]))
+                fields[column].append(value)
+    columns = {'time': np.array(fields['time'], dtype=np.float64),
+               'value': np.array([value if value is not None else np.nan for value in fields['value']],
+                                 dtype=np.float64),
+               'pr': np.array(fields['pr'], dtype=np.int64),
+               'offset': np.array(offset, dtype=np.int64)}
+    for column, column_codes in codes.items():
+        columns[column] = np.array(fields[column], dtype=np.int32)
+        columns[f'{column}_names'] = np.array(list(column_codes), dtype=str)
+    return History(columns)
+
+
+def concat(first: History, second: History) -> History:
+    """
+    History made of two consecutive parts, their string codes are merged.
+    """
+    columns = {column: np.concatenate((first.columns[column], second.columns[column]))
+               for column in ('time', 'value', 'pr')}
+    columns['offset'] = second.offset
+    for column in ('kind', 'name', 'repo', 'base'):
+        names = first.columns[f'{column}_names']
+        new_names = second.columns[f'{column}_names']
+        missing = new_names[~np.isin(new_names, names)]
+        names = np.concatenate((names, missing))
+        # Where each name of the second part ended up in the merged names.
+        order = np.argsort(names)
+        remap = order[np.searchsorted(names, new_names, sorter=order)].astype(np.int32)
+        columns[f'{column}_names'] = names
+        columns[column] = np.concatenate((first.columns[column], remap[second.columns[column]]))
+    return History(columns)
+
+
+def load(path: str, use_cache: bool = True) -> History:
+    """
+    Load the history. The columnar cache next to it is used when it exists,
+    only the records appended since it was written are parsed.
+    """
+    cache = path + '.npz'
+    if not use_cache:
+        return parse(path)
+    if os.path.exists(cache):
+        with np.load(cache) as arrays:
+            history = History({name: arrays[name] for name in arrays.files})
+        offset, size = int(history.offset), os.path.getsize(path)
+        if offset == size:
+            return history
+        # Appended to since, or rotated.
+        history = concat(history, parse(path, offset)) if offset < size else parse(path)
+    else:
+        history = parse(path)
+    try:
+        with open(cache + '.tmp', 'wb') as cache_file:
+            np.savez(cache_file, **history.columns)
+        os.replace(cache + '.tmp', cache)
+    except OSError:
+        pass  # read only history, never mind
+    return history
+
+
+def percentiles(values: 'np.ndarray') -> Optional[List[float]]:
+    return [float(value) for value in np.percentile(values, PERCENTILES)] if len(values) else None
+
+
+def pr_uids(history: History) -> 'np.ndarray':
+    """
+    Unique id of the PRs across repositories.
+    """
+    return (history.repo.astype(np.int64) << 32) | history.pr
+
+
+def blessed_to_merged(history: History, mask: 'np.ndarray') -> 'np.ndarray':
+    """
+    Seconds between the last blessing of a PR and its merge, for every merge.
+    """
+    blessed, merged = history.named('blessed', 'event') & mask, history.named('merged', 'event') & mask
+    rows = np.flatnonzero(blessed | merged)
+    uids, times = pr_uids(history)[rows], history.time[rows]
+    order = np.lexsort((times, uids))
+    uids, times, is_blessed = uids[order], times[order], blessed[rows][order]
+    # Forward fill the index of the last blessing in the sorted rows.
+    last_blessing = np.maximum.accumulate(np.where(is_blessed, np.arange(len(rows)), -1))
+    merges = np.flatnonzero(~is_blessed)
+    blessings = last_blessing[merges]
+    valid = (blessings >= 0) & (uids[np.maximum(blessings, 0)] == uids[merges])
+    return times[merges[valid]] - times[blessings[valid]]
+
+
+def weekly_percentiles(times: 'np.ndarray', values: 'np.ndarray', start: float) -> List[Optional[List[float]]]:
+    weeks = ((times - start) // WEEK).astype(np.int64)
+    order = np.lexsort((values, weeks))
+    weeks, values = weeks[order], values[order]
+    week_count = int(weeks.max()) + 1 if len(weeks) else 0
+    bounds = np.searchsorted(weeks, np.arange(week_count + 1))
+    return [percentiles(values[bounds[week]:bounds[week + 1]]) for week in range(week_count)]
+
+
+def counts_by(codes: 'np.ndarray', names: 'np.ndarray', top: int = TOP) -> List:
+    found, counts = np.unique(codes, return_counts=True)
+    order = np.argsort(-counts, kind='stable')[:top]
+    return [(str(names[found[i]]) if names is not None else int(found[i]), int(counts[i])) for i in order]
+
+
+def report(history: History, days: int = 28, now: float = None) -> Dict:
+    """
+    Figures over the last `days` days.
+    """
+    now = now if now is not None else time.time()
+    start = now - days * DAY
+    window = history.time >= start
+    merged = history.named('merged', 'event') & window
+    merge_days = ((history.time[merged] - start) // DAY).astype(np.int64)
+    per_day = np.bincount(merge_days, minlength=days)[:days]
+
+    time_to_merge = history.named('queue_time_to_merge', 'metric') & window
+    failed = history.named('pull_failed', 'event') & window
+    pulled = history.named('pulled', 'event') & window
+    failures_by_base = np.bincount(history.base[failed], minlength=len(history.base_names))
+    pulls_by_base = np.bincount(history.base[pulled], minlength=len(history.base_names)) + failures_by_base
+    failing_bases = np.flatnonzero(failures_by_base)
+    failing_bases = failing_bases[np.argsort(-failures_by_base[failing_bases], kind='stable')][:TOP]
+    failed_rows = np.flatnonzero(failed)
+    by_pr = counts_by(pr_uids(history)[failed_rows], None)
+
+    return {
+        'days': days,
+        'merges': int(merged.sum()),
+        'merges_per_day': per_day.tolist(),
+        'rolling_7_days': np.convolve(per_day, np.ones(7), 'valid').tolist() if days >= 7 else [],
+        'time_in_queue': percentiles(history.value[time_to_merge]),
+        'time_in_queue_weekly': weekly_percentiles(history.time[time_to_merge], history.value[time_to_merge], start),
+        'blessed_to_merged': percentiles(blessed_to_merged(history, window)),
+        'pull_failures': int(failed.sum()),
+        'pull_failures_by_pr': [(f'{history.repo_names[uid >> 32]}#{uid & 0xffffffff}', count)
+                                for uid, count in by_pr],
+        'pull_failures_by_base': [(str(history.base_names[base]), int(failures_by_base[base]),
+                                   float(failures_by_base[base] / pulls_by_base[base])) for base in failing_bases],
+    }
+
+
+def hours(value_percentiles: Optional[List[float]]) -> str:
+    if not value_percentiles:
+        return 'no data'
+    return ', '.join(f'p{p} {value / 3600:.1f}h' for p, value in zip(PERCENTILES, value_percentiles))
+
+
+def format_report(figures: Dict) -> str:
+    lines = [f'**Last {figures["days"]} days**: {figures["merges"]} merges, '
+             f'{figures["merges"] / figures["days"]:.1f} per day.']
+    if figures['rolling_7_days']:
+        lines.append(f'Merges over 7 days: {max(figures["rolling_7_days"]):.0f} at best, '
+                     f'{figures["rolling_7_days"][-1]:.0f} for the last 7 days.')
+    lines.append(f'Time in queue: {hours(figures["time_in_queue"])}.')
+    for week, week_percentiles in enumerate(figures['time_in_queue_weekly'], 1):
+        lines.append(f'    week {week}: {hours(week_percentiles)}')
+    lines.append(f'Blessed to merged: {hours(figures["blessed_to_merged"])}.')
+    lines.append(f'Pull failures: {figures["pull_failures"]}.')
+    if figures['pull_failures_by_pr']:
+        lines.append('    most failing PRs: ' + ', '.join(f'{pr} ({count})'
+                                                        for pr, count in figures['pull_failures_by_pr']))
+    if figures['pull_failures_by_base']:
+        lines.append('    most failing bases: ' + ', '.join(f'{base} ({count}, {rate:.0%} of the pulls)'
+                                                          for base, count, rate in figures['pull_failures_by_base']))
+    return '\n\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput report of the merge queues.')
+    parser.add_argument('history', help='History file written by the history stats plugin')
+    parser.add_argument('--days', type=int, default=28)
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the columnar cache')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    history = load(args.history, use_cache=not args.no_cache)
+    figures = report(history, args.days)
+    print(format_report(figures))
+    print(f'\n{len(history)} records in {time.perf_counter() - start:.3f}s.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Discrete-event simulation of a merge queue, to compare settings before
+changing them in production:
+
+    python simulator.py --days 1000 --depth 1 2 4 --poll 2 5 --ci lognormal:45:0.5
+
+The real MergeQueue checks a simulated repository where PRs are opened,
+reviewed, tested, pulled and merged following the distributions of the
+scenario. Polls where nothing can have changed since the previous one are
+not run again, they are counted with the GitHub calls of the previous one.
+"""
+from collections import Counter
+from itertools import count, product
+from math import ceil, inf, log
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import heapq
+import logging
+import random
+import time
+
+from mergequeue import MAX_PULLED_PR, MergeQueue
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+PERCENTILES = (50, 90, 99)
+BRANCH = 'master'
+
+
+def distribution(spec: str) -> Callable[[random.Random], float]:
+    """
+    Durations in minutes: `fixed:<minutes>`, `exp:<mean>`,
+    `uniform:<low>:<high>` or `lognormal:<median>:<sigma>`.
+    :return: a function drawing a duration in seconds.
+    """
+    kind, *params = spec.split(':')
+    try:
+        params = [float(param) for param in params]
+        if kind == 'fixed':
+            minutes, = params
+            return lambda rng: minutes * MINUTE
+        if kind == 'exp':
+            mean, = params
+            return lambda rng: rng.expovariate(1 / mean) * MINUTE
+        if kind == 'uniform':
+            low, high = params
+            return lambda rng: rng.uniform(low, high) * MINUTE
+        if kind == 'lognormal':
+            median, sigma = params
+            return lambda rng: rng.lognormvariate(log(median), sigma) * MINUTE
+    except ValueError:
+        pass
+    raise ValueError(f'Unknown distribution {spec}, use fixed:<minutes>, exp:<mean>, uniform:<low>:<high> or '
+                     f'lognormal:<median>:<sigma>')
+
+
+class Scenario:
+    """
+    What the repository goes through, and the settings of the queue.
+    """
+
+    def __init__(self,
+                 prs_per_day: float = 20,
+                 review: str = 'exp:240',
+                 ci: str = 'lognormal:30:0.4',
+                 fix: str = 'exp:120',
+                 flaky_rate: float = 0.05,
+                 conflict_rate: float = 0.02,
+                 max_pulled_prs: int = MAX_PULLED_PR,
+                 poll_minutes: float = 2,
+                 max_prs: int = None,
+                 incremental: bool = False):
+        """
+        :param prs_per_day: PRs opened per day, a Poisson process.
+        :param review: time from opening a PR to its approval and blessing.
+        :param ci: duration of a CI run.
+        :param fix: time for an author to fix a failed CI run or a conflict.
+        :param flaky_rate: share of the CI runs that fail.
+        :param conflict_rate: share of the pulls that conflict.
+        """
+        self.prs_per_day = prs_per_day
+        self.review = distribution(review)
+        self.ci = distribution(ci)
+        self.fix = distribution(fix)
+        self.flaky_rate = flaky_rate
+        self.conflict_rate = conflict_rate
+        self.max_pulled_prs = max_pulled_prs
+        self.poll_interval = poll_minutes * MINUTE
+        self.max_prs = max_prs
+        self.incremental = incremental
+
+
+class SimPull:
+    """
+    A simulated PR, with the attributes of the PyGithub PullRequest that the
+    queue reads.
+    """
+
+    def __init__(self, repo: 'SimRepo', number: int):
+        self.repo = repo
+        self.number = number
+        self.html_url = f'https://github.com/{repo.full_name}/pull/{number}'
+        self.title = f'Change {number}'
+        self.body = ''
+        self.user = SimpleNamespace(login=f'dev{number % 16}')
+        self.head = SimpleNamespace(ref=f'change-{number}')
+        self.base = SimpleNamespace(ref=BRANCH)
+        self.reviews = []
+        self.merged = False
+        self.conflict = False
+        self.merged_base = repo.base_version  # version of the base branch in the head
+        self.ci_run = 0
+        self.ci_end = 0.0
+        self.ci_failed = False
+        self.opened_at = self.updated_at = repo.sim.now
+        self.blessed_at = None
+
+    def touch(self):
+        self.updated_at = self.repo.sim.now
+        self.repo.updated.pop(self.number, None)
+        self.repo.updated[self.number] = self
+
+    @property
+    def state(self) -> str:
+        return 'closed' if self.merged else 'open'
+
+    @property
+    def mergeable(self) -> bool:
+        return not self.conflict
+
+    @property
+    def mergeable_state(self) -> str:
+        if self.conflict:
+            return 'dirty'
+        if self.ci_end > self.repo.sim.now or self.ci_failed:
+            return 'blocked'
+        if self.merged_base < self.repo.base_version:
+            return 'behind'
+        return 'clean' if self.reviews else 'blocked'
+
+    def get_reviews(self):
+        self.repo.call('get_reviews')
+        return self.reviews
+
+    def merge(self, commit_title=None):
+        self.repo.call('merge_pull')
+        self.repo.sim.merged(self)
+
+    def edit(self, title=None, body=None, state=None, base=None):
+        self.repo.call('edit_pull')
+
+
+class SimRepo:
+    """
+    The repository the queue sees, counting the GitHub calls.
+    """
+    full_name = 'simulated/repo'
+
+    def __init__(self, sim: 'Simulation'):
+        self.sim = sim
+        self.pulls: Dict[int, SimPull] = {}
+        self.open: Dict[str, SimPull] = {}  # by head branch
+        self.updated: Dict[int, SimPull] = {}  # by last update
+        self.base_version = 0
+        self.calls = Counter()
+
+    def call(self, endpoint: str):
+        self.calls[endpoint] += 1
+
+    def add(self, pull: SimPull):
+        self.pulls[pull.number] = self.open[pull.head.ref] = pull
+        pull.touch()
+
+    def close(self, pull: SimPull):
+        del self.open[pull.head.ref]
+        pull.touch()
+
+    def get_pull(self, pr_nb: int) -> SimPull:
+        self.call('get_pull')
+        return self.pulls[pr_nb]
+
+    def get_pulls(self, base: str = None, state: str = 'open', sort: str = None, direction: str = None):
+        self.call('get_pulls')
+        if sort == 'updated':
+            return reversed(self.updated.values())
+        return [pull for pull in self.open.values() if pull.base.ref == base]
+
+    def merge(self, base: str, head: str, commit_message: str = None):
+        """
+        Pull `head` into the branch `base`.
+        """
+        self.call('merge')
+        self.sim.changed = True
+        pull = self.open[base]
+        pull.touch()
+        if self.sim.rng['conflict'].random() < self.sim.scenario.conflict_rate:
+            pull.conflict = True
+            self.sim.schedule(self.sim.scenario.fix(self.sim.rng['fix']), self.sim.resolve, pull)
+            return None
+        pull.merged_base = self.base_version
+        self.sim.start_ci(pull)
+        return True
+
+    def get_git_ref(self, ref: str):
+        self.call('get_git_ref')
+        return SimpleNamespace(delete=lambda: self.call('delete_ref'))
+
+    def get_branch(self, branch: str):
+        self.call('get_branch')
+        return SimpleNamespace(contexts=['ci'], commit=SimpleNamespace(sha=str(self.base_version)))
+
+    def get_commit(self, sha: str):
+        self.call('get_commit')
+        pull = self.open[sha]
+        state = 'pending' if pull.ci_end > self.sim.now else 'failure' if pull.ci_failed else 'success'
+        return SimpleNamespace(get_statuses=lambda: [SimpleNamespace(context='ci', state=state)])
+
+
+class Simulation:
+    def __init__(self, scenario: Scenario, seed: int = 0):
+        self.scenario = scenario
+        # One stream per source of randomness: with the same seed, scenarios
+        # differing only by their settings see the same PRs and CI runs.
+        self.rng = {source: random.Random(f'{seed}:{source}')
+                    for source in ('arrival', 'review', 'ci', 'flaky', 'fix', 'conflict')}
+        self.now = 0.0
+        self.events = []
+        self.sequence = count()
+        self.repo = SimRepo(self)
+        self.queue = MergeQueue(self.repo, max_pulled_prs=scenario.max_pulled_prs)
+        self.queue.incremental = scenario.incremental
+        # Something changed on the simulated GitHub since the last poll.
+        self.changed = True
+        # The last poll did nothing and left the queue as it was.
+        self.idle = False
+        self.idle_calls = Counter()
+        self.polls = 0
+        self.skipped_polls = 0
+        self.ci_runs = 0
+        self.time_to_merge: List[float] = []
+        self.blessed_to_merged: List[float] = []
+        self.transitions = Counter()
+
+    def schedule(self, delay: float, action: Callable, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), action, args))
+
+    def start_ci(self, pull: SimPull):
+        pull.ci_run += 1
+        pull.ci_end = self.now + self.scenario.ci(self.rng['ci'])
+        pull.ci_failed = self.rng['flaky'].random() < self.scenario.flaky_rate
+        self.ci_runs += 1
+        self.schedule(pull.ci_end - self.now, self.ci_done, pull, pull.ci_run)
+
+    def ci_done(self, pull: SimPull, run: int):
+        if pull.merged or run != pull.ci_run:
+            return
+        self.changed = True
+        if pull.ci_failed:
+            self.schedule(self.scenario.fix(self.rng['fix']), self.push_fix, pull, run)
+
+    def push_fix(self, pull: SimPull, run: int):
+        if pull.merged or run != pull.ci_run:
+            return
+        self.changed = True
+        pull.touch()
+        self.start_ci(pull)
+
+    def resolve(self, pull: SimPull):
+        """
+        The author merges the base into a conflicting PR.
+        """
+        if pull.merged:
+            return
+        self.changed = True
+        pull.conflict = False
+        pull.merged_base = self.repo.base_version
+        pull.touch()
+        self.start_ci(pull)
+
+    def open_pr(self):
+        pull = SimPull(self.repo, len(self.repo.pulls) + 1)
+        self.repo.add(pull)
+        self.changed = True
+        self.start_ci(pull)
+        self.queue.ask_pr(pull.number)
+        self.schedule(self.scenario.review(self.rng['review']), self.approve, pull)
+        self.schedule(self.rng['arrival'].expovariate(self.scenario.prs_per_day / DAY), self.open_pr)
+
+    def approve(self, pull: SimPull):
+        self.changed = True
+        pull.reviews.append(SimpleNamespace(state='APPROVED', user=SimpleNamespace(login='reviewer')))
+        pull.blessed_at = self.now
+        pull.touch()
+        self.queue.bless_pr(pull.number)
+
+    def merged(self, pull: SimPull):
+        self.changed = True
+        pull.merged = True
+        self.repo.close(pull)
+        self.repo.base_version += 1
+        self.time_to_merge.append(self.now - pull.opened_at)
+        self.blessed_to_merged.append(self.now - pull.blessed_at)
+
+    def checked_state(self) -> Tuple:
+        """
+        What, besides GitHub, tells the next check what to refresh.
+        """
+        stale = self.queue.stale_prs
+        return frozenset(stale) if stale is not None else None, self.queue.update_watermark
+
+    def poll(self):
+        queue = self.queue
+        before = self.checked_state()
+        calls = Counter(self.repo.calls)
+        self.changed = False
+        queue.list_changes()
+        transitions = list(queue.check(self.scenario.max_prs))
+        for _, new_states in transitions:
+            self.transitions.update(state.name for state, _ in new_states)
+        self.polls += 1
+        self.idle = not transitions and not self.changed and self.checked_state() == before
+        self.idle_calls = self.repo.calls - calls
+
+    def run(self, days: float) -> Dict:
+        end = days * DAY
+        interval = self.scenario.poll_interval
+        next_poll = interval
+        self.schedule(0, self.open_pr)
+        while True:
+            next_event = self.events[0][0] if self.events else inf
+            if next_poll <= next_event:
+                if next_poll >= end:
+                    break
+                self.now = next_poll
+                if self.idle and not self.changed:
+                    # Every poll until the next event does what the last one did.
+                    polls = max(1, ceil((min(next_event, end) - self.now) / interval))
+                    self.repo.calls.update({endpoint: calls * polls for endpoint, calls in self.idle_calls.items()})
+                    self.polls += polls
+                    self.skipped_polls += polls
+                    next_poll += polls * interval
+                else:
+                    self.poll()
+                    next_poll += interval
+            else:
+                if next_event >= end:
+                    break
+                self.now, _, action, args = heapq.heappop(self.events)
+                action(*args)
+        return self.results(days)
+
+    def results(self, days: float) -> Dict:
+        merges = len(self.time_to_merge)
+        calls = sum(self.repo.calls.values())
+        return {
+            'days': days,
+            'opened': len(self.repo.pulls),
+            'merges': merges,
+            'merges_per_day': merges / days,
+            'time_to_merge': percentiles(self.time_to_merge),
+            'blessed_to_merged': percentiles(self.blessed_to_merged),
+            'queued_at_end': len(self.queue.queue),
+            'ci_runs': self.ci_runs,
+            'pulls': self.transitions['PULLED_SUCCESS'] + self.transitions['PULLED_FAILURE'],
+            'pull_failures': self.transitions['PULLED_FAILURE'],
+            'polls': self.polls,
+            'skipped_polls': self.skipped_polls,
+            'api_calls': calls,
+            'api_calls_per_merge': calls / merges if merges else None,
+            'api_calls_by_endpoint': dict(self.repo.calls.most_common()),
+        }
+
+
+def percentiles(values: List[float]) -> Optional[List[float]]:
+    """
+    Nearest rank percentiles.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return [values[min(len(values) - 1, max(0, ceil(p / 100 * len(values)) - 1))] for p in PERCENTILES]
+
+
+def hours(value_percentiles: Optional[List[float]]) -> str:
+    if not value_percentiles:
+        return 'no data'
+    return ' '.join(f'p{p} {value / HOUR:.1f}h' for p, value in zip(PERCENTILES, value_percentiles))
+
+
+def format_results(settings: str, results: Dict) -> str:
+    calls_per_merge = results['api_calls_per_merge']
+    return (f'{settings}: {results["merges_per_day"]:.1f} merges/day, time to merge {hours(results["time_to_merge"])}, '
+            f'blessed to merged {hours(results["blessed_to_merged"])}, '
+            f'{calls_per_merge if calls_per_merge is not None else float("nan"):.0f} API calls/merge, '
+            f'{results["pull_failures"]}/{results["pulls"]} pulls failed, {results["queued_at_end"]} PRs queued at '
+            f'the end.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a merge queue to compare settings.')
+    parser.add_argument('--days', type=float, default=365)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prs-per-day', type=float, default=20)
+    parser.add_argument('--review', default='exp:240', help='Time to approval, in minutes (see distribution())')
+    parser.add_argument('--ci', default='lognormal:30:0.4', help='Duration of a CI run, in minutes')
+    parser.add_argument('--fix', default='exp:120', help='Time to fix a failure or a conflict, in minutes')
+    parser.add_argument('--flaky-rate', type=float, default=0.05, help='Share of the CI runs that fail')
+    parser.add_argument('--conflict-rate', type=float, default=0.02, help='Share of the pulls that conflict')
+    parser.add_argument('--depth', type=int, nargs='+', default=[MAX_PULLED_PR], help='max_pulled_prs to compare')
+    parser.add_argument('--poll', type=float, nargs='+', default=[2], help='Poll intervals to compare, in minutes')
+    parser.add_argument('--max-prs', type=int, help='PRs refreshed per check')
+    parser.add_argument('--incremental', action='store_true', help='Incremental checks')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    for depth, poll in product(args.depth, args.poll):
+        scenario = Scenario(args.prs_per_day, args.review, args.ci, args.fix, args.flaky_rate, args.conflict_rate,
+                            max_pulled_prs=depth, poll_minutes=poll, max_prs=args.max_prs,
+                            incremental=args.incremental)
+        start = time.perf_counter()
+        results = Simulation(scenario, args.seed).run(args.days)
+        print(format_results(f'depth {depth}, poll {poll:g} min', results) +
+              f' ({time.perf_counter() - start:.1f}s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Per sweep snapshots of the repositories.
+
+When the same repository is queued in several rooms, all their MergeQueues
+read it through one RepoSnapshot during a sweep, so every PR, branch and
+commit status is fetched at most once per cycle. Writes go straight to
+GitHub and drop what they made stale.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Dict, List
+
+
+class SnapshotPull:
+    """
+    Proxy of a PyGithub PullRequest caching its reviews.
+    """
+
+    def __init__(self, snapshot: 'RepoSnapshot', gh_pr):
+        self._snapshot = snapshot
+        self._gh_pr = gh_pr
+
+    def __getattr__(self, name):
+        return getattr(self._gh_pr, name)
+
+    def get_reviews(self):
+        reviews = self._snapshot.reviews.get(self._gh_pr.number)
+        if reviews is None:
+            self._snapshot.stats['miss'] += 1
+            reviews = self._snapshot.reviews[self._gh_pr.number] = list(self._gh_pr.get_reviews())
+        else:
+            self._snapshot.stats['hit'] += 1
+        return reviews
+
+    def merge(self, *args, **kwargs):
+        self._snapshot.invalidate(self._gh_pr.number)
+        return self._gh_pr.merge(*args, **kwargs)
+
+    def edit(self, *args, **kwargs):
+        self._snapshot.invalidate(self._gh_pr.number)
+        return self._gh_pr.edit(*args, **kwargs)
+
+
+class RepoSnapshot:
+    """
+    PyGithub-like repository memoizing the reads of one sweep.
+    """
+
+    def __init__(self, gh_repo):
+        self.gh_repo = gh_repo
+        self.full_name = gh_repo.full_name
+        self.stats = Counter()
+        self.pulls: Dict[int, SnapshotPull] = {}
+        self.pulls_by_base: Dict[str, List[SnapshotPull]] = {}
+        self.reviews: Dict[int, List] = {}
+        self.branches = {}
+        self.commits = {}
+
+    def clear(self):
+        self.pulls.clear()
+        self.pulls_by_base.clear()
+        self.reviews.clear()
+        self.branches.clear()
+        self.commits.clear()
+
+    def invalidate(self, pr_nb: int):
+        """
+        Forget a PR after writing to it, and the lists it might appear in.
+        """
+        self.pulls.pop(pr_nb, None)
+        self.reviews.pop(pr_nb, None)
+        self.pulls_by_base.clear()
+
+    def cached(self, cache: Dict, key, fetch):
+        if key in cache:
+            self.stats['hit'] += 1
+            return cache[key]
+        self.stats['miss'] += 1
+        value = cache[key] = fetch()
+        return value
+
+    # PyGithub Repository interface used by MergeQueue.
+
+    @property
+    def requester(self):
+        # GraphQL requests go straight to GitHub.
+        return getattr(self.gh_repo, 'requester', None)
+
+    def get_pull(self, pr_nb: int) -> SnapshotPull:
+        return self.cached(self.pulls, pr_nb, lambda: SnapshotPull(self, self.gh_repo.get_pull(pr_nb)))
+
+    def get_pulls(self, base: str = None) -> List[SnapshotPull]:
+        return self.cached(self.pulls_by_base, base,
+                           lambda: [SnapshotPull(self, gh_pr) for gh_pr in self.gh_repo.get_pulls(base=base)])
+
+    def get_branch(self, branch: str):
+        return self.cached(self.branches, branch, lambda: self.gh_repo.get_branch(branch))
+
+    def get_commit(self, sha: str):
+        statuses = self.cached(self.commits, sha, lambda: list(self.gh_repo.get_commit(sha).get_statuses()))
+        return SimpleNamespace(sha=sha, get_statuses=lambda: statuses)
+
+    def get_git_ref(self, ref: str):
+        return self.gh_repo.get_git_ref(ref)
+
+    def merge(self, base: str, head: str, **kwargs):
+        # The branch of a PR moved, its mergeability has to be asked again.
+        for pr_nb, pull in list(self.pulls.items()):
+            if pull.head.ref == base:
+                self.invalidate(pr_nb)
+        return self.gh_repo.merge(base=base, head=head, **kwargs)
+
+
+class SnapshotService:
+    """
+    One RepoSnapshot per repository, shared by all the rooms queuing it.
+    """
+
+    def __init__(self):
+        self.snapshots: Dict[str, RepoSnapshot] = {}
+
+    def begin_sweep(self):
+        """
+        Start a new cycle: everything has to be fetched again.
+        """
+        for snapshot in self.snapshots.values():
+            snapshot.clear()
+
+    @contextmanager
+    def sweep(self):
+        """
+        Share the reads within the block, nothing is kept after it.
+        """
+        self.begin_sweep()
+        try:
+            yield self
+        finally:
+            self.begin_sweep()
+
+    def repo(self, gh_repo) -> RepoSnapshot:
+        """
+        The snapshot of a repository, whichever room's gh_repo is given.
+        """
+        snapshot = self.snapshots.get(gh_repo.full_name)
+        if snapshot is None:
+            snapshot = self.snapshots[gh_repo.full_name] = RepoSnapshot(gh_repo)
+        return snapshot
+
+    def status(self) -> str:
+        hits = sum(snapshot.stats['hit'] for snapshot in self.snapshots.values())
+        misses = sum(snapshot.stats['miss'] for snapshot in self.snapshots.values())
+        return f'{len(self.snapshots)} repositories, {hits} reads served from the snapshots, {misses} fetched.'
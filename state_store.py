@@ -0,0 +1,360 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Where the rooms, their queues and their saints are persisted.
+
+The errbot storage keeps everything under a single key, rewritten as a whole
+on every change. The SQLite store keeps a row per room, repository and PR so
+an update only touches the room it is about.
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, local
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+import logging
+import pickle
+import sqlite3
+import weakref
+
+from pr import PR
+
+log = logging.getLogger(__name__)
+
+ROOMS = 'rooms'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS rooms (room TEXT PRIMARY KEY, owner BLOB, saints BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS repos (room TEXT NOT NULL, repo TEXT NOT NULL, position INTEGER NOT NULL,
+                                  pulled_prs TEXT NOT NULL, PRIMARY KEY (room, repo));
+CREATE TABLE IF NOT EXISTS prs (room TEXT NOT NULL, repo TEXT NOT NULL, nb INTEGER NOT NULL,
+                                position INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (room, repo, nb));
+CREATE INDEX IF NOT EXISTS prs_by_position ON prs (room, repo, position);
+CREATE TABLE IF NOT EXISTS auto_labels (room TEXT NOT NULL, repo TEXT NOT NULL, label TEXT NOT NULL,
+                                        PRIMARY KEY (room, repo));
+"""
+
+# A room is configured once it has a repository, like for the errbot storage
+# where a room always has its first one.
+CONFIGURED = 'EXISTS (SELECT 1 FROM repos WHERE repos.room = rooms.room)'
+
+
+def new_room(name: str, owner, queue: List[PR] = None, saints: List[str] = None, pulled_prs: List[int] = None):
+    """
+    State of a room: name/queue/pulled_prs are the ones of its first
+    repository, the others are in repos.
+    """
+    room = SimpleNamespace(name=name, owner=owner, queue=queue if queue else [], saints=saints if saints else [],
+                           pulled_prs=pulled_prs if pulled_prs else [])
+    room_repos(room)
+    return room
+
+
+def room_repos(room) -> OrderedDict:
+    """
+    Repositories hosted by a room, by full name. The first one is the one the
+    room was configured with, name/queue/pulled_prs are kept pointing to it so
+    older versions can still read the state.
+    """
+    if not getattr(room, 'repos', None):
+        room.repos = OrderedDict([(room.name, SimpleNamespace(name=room.name, queue=room.queue,
+                                                              pulled_prs=room.pulled_prs))])
+    return room.repos
+
+
+class StateStore(ABC):
+    """
+    Persists the state of the rooms.
+    """
+
+    @abstractmethod
+    def rooms(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def get_room(self, room: str):
+        """
+        :return: the state of the room, None if it is not configured.
+        """
+
+    @abstractmethod
+    def put_room(self, room: str, state):
+        pass
+
+    @abstractmethod
+    def delete_room(self, room: str):
+        pass
+
+    def __contains__(self, room: str) -> bool:
+        return self.get_room(room) is not None
+
+    @contextmanager
+    def mutable_room(self, room: str):
+        """
+        Change the state of one room, saved when the block exits.
+        """
+        state = self.get_room(room)
+        yield state
+        self.put_room(room, state)
+
+    def saints(self, room: str) -> List[str]:
+        return list(self.get_room(room).saints)
+
+    def set_saints(self, room: str, saints: List[str]):
+        with self.mutable_room(room) as state:
+            state.saints[:] = saints
+
+    def auto_labels(self, room: str) -> Dict[str, str]:
+        """
+        :return: the label enqueuing PRs automatically, by repository.
+        """
+        return dict(getattr(self.get_room(room), 'auto_labels', None) or {})
+
+    def set_auto_label(self, room: str, repo_name: str, label: Optional[str]):
+        with self.mutable_room(room) as state:
+            labels = getattr(state, 'auto_labels', None) or {}
+            if label:
+                labels[repo_name] = label
+            else:
+                labels.pop(repo_name, None)
+            state.auto_labels = labels
+
+    def save_queues(self, room: str, queues: Mapping[str, Tuple[List[PR], List[int]]]):
+        """
+        Save the queue and pulled PRs of some repositories of a room.
+        """
+        with self.mutable_room(room) as state:
+            repos = room_repos(state)
+            for repo_name, (queue, pulled_prs) in queues.items():
+                repos[repo_name].queue[:] = queue
+                repos[repo_name].pulled_prs[:] = pulled_prs
+
+    def close(self):
+        pass
+
+
+class BotStorageStateStore(StateStore):
+    """
+    Everything in the errbot storage of the plugin, under the ROOMS key.
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        if ROOMS not in plugin:
+            plugin[ROOMS] = {}
+
+    def rooms(self) -> List[str]:
+        return list(self.plugin[ROOMS])
+
+    def get_room(self, room: str):
+        state = self.plugin[ROOMS].get(room)
+        if state is not None:
+            room_repos(state)
+        return state
+
+    @contextmanager
+    def mutable_room(self, room: str):
+        with self.plugin.mutable(ROOMS) as rooms:
+            state = rooms.get(room)
+            if state is not None:
+                room_repos(state)
+            yield state
+
+    def put_room(self, room: str, state):
+        with self.plugin.mutable(ROOMS) as rooms:
+            rooms[room] = state
+
+    def delete_room(self, room: str):
+        with self.plugin.mutable(ROOMS) as rooms:
+            rooms.pop(room, None)
+
+
+class ThreadReader:
+    """
+    The reader connection of a thread, in its thread local storage: dropped,
+    and the connection closed, when the thread ends.
+    """
+    __slots__ = ('db', '__weakref__')
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+
+class SQLiteStateStore(StateStore):
+    """
+    A row per room, repository and PR in a SQLite database in WAL mode:
+    readers do not wait for writers and every update is a transaction on the
+    rows of one room.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.write_lock = Lock()
+        self.local = local()
+        self.readers: List[sqlite3.Connection] = []  # of the live threads, to close them
+        self.writer = self.connect()
+        self.writer.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    @property
+    def reader(self) -> sqlite3.Connection:
+        """
+        One connection per thread so that reads run concurrently.
+        """
+        reader = getattr(self.local, 'reader', None)
+        if reader is None:
+            reader = self.local.reader = ThreadReader(self.connect())
+            with self.write_lock:
+                self.readers.append(reader.db)
+            weakref.finalize(reader, self.close_reader, reader.db)
+        return reader.db
+
+    def close_reader(self, db: sqlite3.Connection):
+        with self.write_lock:
+            self.readers = [reader for reader in self.readers if reader is not db]
+        db.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.write_lock:
+            self.writer.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.writer
+            except BaseException:
+                self.writer.execute('ROLLBACK')
+                raise
+            self.writer.execute('COMMIT')
+
+    def rooms(self) -> List[str]:
+        return [room for room, in self.reader.execute(f'SELECT room FROM rooms WHERE {CONFIGURED} ORDER BY room')]
+
+    def __contains__(self, room: str) -> bool:
+        return self.reader.execute(f'SELECT 1 FROM rooms WHERE room = ? AND {CONFIGURED}',
+                                   (room,)).fetchone() is not None
+
+    def get_room(self, room: str):
+        db = self.reader
+        db.execute('BEGIN')  # one consistent view of the room
+        try:
+            row = db.execute('SELECT owner, saints FROM rooms WHERE room = ?', (room,)).fetchone()
+            if row is None:
+                return None
+            repos = db.execute('SELECT repo, pulled_prs FROM repos WHERE room = ? ORDER BY position',
+                               (room,)).fetchall()
+            prs = db.execute('SELECT repo, data FROM prs WHERE room = ? ORDER BY repo, position', (room,)).fetchall()
+        finally:
+            db.execute('COMMIT')
+        owner, saints = row
+        state = None  # without a repository the room is not configured
+        for repo_name, pulled_prs in repos:
+            queue = [pickle.loads(data) for pr_repo, data in prs if pr_repo == repo_name]
+            pulled = [int(pr_nb) for pr_nb in pulled_prs.split(',') if pr_nb]
+            if state is None:
+                state = new_room(repo_name, pickle.loads(owner) if owner else None, queue, pickle.loads(saints), pulled)
+            else:
+                state.repos[repo_name] = SimpleNamespace(name=repo_name, queue=queue, pulled_prs=pulled)
+        return state
+
+    @staticmethod
+    def write_queue(db: sqlite3.Connection, room: str, repo_name: str, queue: List[PR], pulled_prs: List[int]):
+        db.execute('UPDATE repos SET pulled_prs = ? WHERE room = ? AND repo = ?',
+                   (','.join(str(pr_nb) for pr_nb in pulled_prs), room, repo_name))
+        db.execute(f'DELETE FROM prs WHERE room = ? AND repo = ? AND nb NOT IN ({",".join("?" * len(queue))})',
+                   [room, repo_name] + [pr.nb for pr in queue])
+        db.executemany('INSERT OR REPLACE INTO prs (room, repo, nb, position, data) VALUES (?, ?, ?, ?, ?)',
+                       [(room, repo_name, pr.nb, position, pickle.dumps(pr))
+                        for position, pr in enumerate(queue)])
+
+    def put_room(self, room: str, state):
+        repos = room_repos(state)
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO rooms (room, owner, saints) VALUES (?, ?, ?)',
+                       (room, pickle.dumps(state.owner) if state.owner is not None else None,
+                        pickle.dumps(list(state.saints))))
+            db.execute(f'DELETE FROM repos WHERE room = ? AND repo NOT IN ({",".join("?" * len(repos))})',
+                       [room] + list(repos))
+            db.execute(f'DELETE FROM prs WHERE room = ? AND repo NOT IN ({",".join("?" * len(repos))})',
+                       [room] + list(repos))
+            for position, (repo_name, repo) in enumerate(repos.items()):
+                db.execute('INSERT OR REPLACE INTO repos (room, repo, position, pulled_prs) VALUES (?, ?, ?, ?)',
+                           (room, repo_name, position, ''))
+                self.write_queue(db, room, repo_name, repo.queue, repo.pulled_prs)
+
+    def saints(self, room: str) -> List[str]:
+        row = self.reader.execute('SELECT saints FROM rooms WHERE room = ?', (room,)).fetchone()
+        return pickle.loads(row[0]) if row else []
+
+    def set_saints(self, room: str, saints: List[str]):
+        with self.transaction() as db:
+            db.execute('UPDATE rooms SET saints = ? WHERE room = ?', (pickle.dumps(list(saints)), room))
+
+    def save_queues(self, room: str, queues: Mapping[str, Tuple[List[PR], List[int]]]):
+        with self.transaction() as db:
+            for repo_name, (queue, pulled_prs) in queues.items():
+                self.write_queue(db, room, repo_name, queue, pulled_prs)
+
+    def auto_labels(self, room: str) -> Dict[str, str]:
+        return dict(self.reader.execute('SELECT repo, label FROM auto_labels WHERE room = ?', (room,)).fetchall())
+
+    def set_auto_label(self, room: str, repo_name: str, label: Optional[str]):
+        with self.transaction() as db:
+            if label:
+                db.execute('INSERT OR REPLACE INTO auto_labels (room, repo, label) VALUES (?, ?, ?)',
+                           (room, repo_name, label))
+            else:
+                db.execute('DELETE FROM auto_labels WHERE room = ? AND repo = ?', (room, repo_name))
+
+    def delete_room(self, room: str):
+        with self.transaction() as db:
+            for table in ('prs', 'repos', 'rooms', 'auto_labels'):
+                db.execute(f'DELETE FROM {table} WHERE room = ?', (room,))
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.reader.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def migrate_from(self, source: StateStore) -> int:
+        """
+        Copy the rooms of another store, only the first time.
+        :return: the number of rooms copied.
+        """
+        if self.get_meta('migrated'):
+            return 0
+        rooms = source.rooms()
+        for room in rooms:
+            self.put_room(room, source.get_room(room))
+            for repo_name, label in source.auto_labels(room).items():
+                self.set_auto_label(room, repo_name, label)
+        self.set_meta('migrated', type(source).__name__)
+        log.info('Migrated %d rooms to %s.', len(rooms), self.path)
+        return len(rooms)
+
+    def close(self):
+        with self.write_lock:
+            readers, self.readers = self.readers, []
+            for db in readers:
+                db.close()
+            self.writer.close()
@@ -0,0 +1,115 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from threading import Thread
+from types import SimpleNamespace
+import asyncio
+import pytest
+
+pytest.importorskip('aiohttp')
+from aiohttp import web
+from async_engine import AsyncCheckEngine, SnapshotRepo
+from mergequeue import MergeQueue
+from pr import PRTransition
+
+
+def pull_payload(number, head, base='develop', mergeable_state='blocked'):
+    return {'number': number, 'html_url': f'https://github.com/argoai/av/pull/{number}',
+            'user': {'login': 'gbinet-argo'}, 'state': 'open', 'merged': False,
+            'mergeable': mergeable_state == 'clean', 'mergeable_state': mergeable_state,
+            'title': 'New Pull Request', 'body': 'Some stuff',
+            'head': {'ref': head, 'sha': f'sha_{head}'}, 'base': {'ref': base, 'sha': f'sha_{base}'}}
+
+
+@pytest.fixture
+def fake_github():
+    pulls = {14: pull_payload(14, 'a', mergeable_state='clean'), 15: pull_payload(15, 'b', base='a')}
+    calls = []
+
+    async def get_pull(request):
+        calls.append(('GET', request.path_qs))
+        return web.json_response(pulls[int(request.match_info['nb'])])
+
+    async def get_reviews(request):
+        calls.append(('GET', request.path_qs))
+        return web.json_response([{'user': {'login': 'rkeelan'}, 'state': 'APPROVED'}])
+
+    async def list_pulls(request):
+        calls.append(('GET', request.path_qs))
+        return web.json_response([pull for pull in pulls.values() if pull['base']['ref'] == request.query['base']])
+
+    async def merge_pull(request):
+        calls.append(('PUT', request.path))
+        return web.json_response({'merged': True, 'sha': 'cafe', 'message': 'merged'})
+
+    app = web.Application()
+    app.router.add_get('/repos/argoai/av/pulls/{nb}', get_pull)
+    app.router.add_get('/repos/argoai/av/pulls/{nb}/reviews', get_reviews)
+    app.router.add_get('/repos/argoai/av/pulls', list_pulls)
+    app.router.add_put('/repos/argoai/av/pulls/{nb}/merge', merge_pull)
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield SimpleNamespace(url=f'http://127.0.0.1:{port}', calls=calls)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+
+
+def test_async_check(fake_github):
+    engine = AsyncCheckEngine('token', base_url=fake_github.url)
+    engine.start()
+    try:
+        merge_queue = MergeQueue(SnapshotRepo(engine, 'argoai/av'))
+        merge_queue.ask_pr(14)
+        merge_queue.bless_pr(14)
+        fake_github.calls.clear()
+
+        checked = engine.check_all({'#room': merge_queue})
+    finally:
+        engine.stop()
+
+    [(pr, transitions)] = checked['#room']
+    assert pr.nb == 14
+    assert [state for state, _ in transitions] == [PRTransition.NEW_CHAINED_PR, PRTransition.MERGING]
+    assert ('PUT', '/repos/argoai/av/pulls/14/merge') in fake_github.calls
+    assert merge_queue.queue[0].dependents == (15,)
+    # Nothing was fetched twice.
+    assert sorted(call for call in fake_github.calls if call[0] == 'GET') == sorted(set(
+        call for call in fake_github.calls if call[0] == 'GET'))
+
+
+
+def test_snapshot_invalidated_while_fetching():
+    async def get(path):
+        return pull_payload(int(path.rsplit('/', 1)[1]), 'a')
+
+    async def get_all(path, params=None):
+        return [] if path.endswith('/reviews') else [pull_payload(15, 'b', base='a')]
+
+    def call(coroutine):
+        # Another room writes to the repository while the fetch completes.
+        result = asyncio.run(coroutine)
+        repo.invalidate(15)
+        return result
+
+    repo = SnapshotRepo(SimpleNamespace(client=SimpleNamespace(get=get, get_all=get_all), call=call), 'argoai/av')
+    assert repo.get_pull(14).number == 14
+    assert [pull.number for pull in repo.get_pulls('a')] == [15]
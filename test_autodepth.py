@@ -0,0 +1,75 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from autodepth import DepthTuner
+from pr import PR, PRTransition
+from test_mergequeue import FakeGHPullRequest
+
+MINUTE = 60
+
+
+def pr(nb, mergeable_state='behind'):
+    return PR(FakeGHPullRequest(nb, mergeable_state=mergeable_state))
+
+
+def run(tuner, ci_minutes, merge_every, merges, failing=0):
+    """
+    Pull a PR, CI goes green after ci_minutes, a merge every merge_every minutes.
+    """
+    now = 0
+    for nb in range(merges):
+        tuner.observe([], [(pr(nb), [(PRTransition.PULLED_SUCCESS, None)])], now)
+        for failed in range(failing):
+            tuner.observe([], [(pr(1000 + failed), [(PRTransition.PULLED_FAILURE, None)])], now)
+        tuner.observe([pr(nb, 'clean')], [], now + ci_minutes * MINUTE)
+        now += merge_every * MINUTE
+        tuner.observe([], [(pr(nb), [(PRTransition.MERGED, None)])], now)
+
+
+def test_waits_for_observations():
+    tuner = DepthTuner(1, 8)
+    run(tuner, 30, 10, merges=2)
+    assert tuner.target() is None
+    assert tuner.decide(3) == 3
+    assert tuner.decide(12) == 8  # the bounds apply right away
+
+
+def test_littles_law():
+    tuner = DepthTuner(1, 8)
+    run(tuner, 30, 10, merges=5)
+    assert tuner.ci_duration == 30 * MINUTE and tuner.merge_interval == 10 * MINUTE
+    assert tuner.target() == 3  # three PRs in CI to merge every 10 min with a 30 min CI
+    assert tuner.decide(1) == 2  # one step at a time
+    assert tuner.decide(2) == 3
+    assert tuner.decide(3) == 3
+    assert 'CI takes 30 min' in tuner.status()
+
+    tuner.max_depth = 2
+    assert tuner.decide(3) == 2
+
+
+def test_merge_is_not_a_ci_run():
+    tuner = DepthTuner(1, 8)
+    run(tuner, 30, 10, merges=5)
+    tuner.observe([], [(pr(42), [(PRTransition.PULLED_SUCCESS, None)])], 0)
+    tuner.observe([], [(pr(42), [(PRTransition.MERGED, None)])], 120 * MINUTE)  # merged on GitHub
+    assert tuner.ci_duration == 30 * MINUTE and tuner.ci_samples == 5
+    assert 42 not in tuner.pulled_at
+
+
+def test_failures_raise_the_depth():
+    tuner = DepthTuner(1, 8)
+    run(tuner, 30, 10, merges=20, failing=1)
+    assert 0.4 < tuner.failure_rate < 0.6
+    assert tuner.target() == 6
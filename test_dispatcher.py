@@ -0,0 +1,60 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from dispatcher import MessageDispatcher
+
+
+def test_per_destination_ordering():
+    sent = []
+    dispatcher = MessageDispatcher(lambda to, text: sent.append((to, text)), workers=3)
+    dispatcher.start()
+    for i in range(50):
+        dispatcher.enqueue('#room1', f'msg {i}')
+        dispatcher.enqueue('@user', f'msg {i}')
+    dispatcher.stop()
+
+    assert [text for to, text in sent if to == '#room1'] == [f'msg {i}' for i in range(50)]
+    assert [text for to, text in sent if to == '@user'] == [f'msg {i}' for i in range(50)]
+    assert dispatcher.sent == 100
+
+
+def test_retry_then_give_up():
+    attempts = []
+
+    def flaky_send(to, text):
+        attempts.append(text)
+        if text == 'broken' or len(attempts) < 2:
+            raise IOError('backend down')
+
+    dispatcher = MessageDispatcher(flaky_send, workers=1, max_retries=2, backoff=0)
+    dispatcher.start()
+    dispatcher.enqueue('#room', 'hello')
+    dispatcher.enqueue('#room', 'broken')
+    dispatcher.stop()
+
+    assert attempts == ['hello', 'hello', 'broken', 'broken', 'broken']
+    assert dispatcher.sent == 1
+    assert dispatcher.failed == 1
+    assert dispatcher.retried == 3
+
+
+def test_backpressure_drops():
+    dispatcher = MessageDispatcher(lambda to, text: None, workers=1, max_queued=2)
+    # Not started so nothing gets consumed.
+    assert dispatcher.enqueue('#room', '1')
+    assert dispatcher.enqueue('#room', '2')
+    assert not dispatcher.enqueue('#room', '3')
+    assert dispatcher.dropped == 1
+    assert dispatcher.depth() == 2
+    assert 'high watermark 2' in dispatcher.stats()
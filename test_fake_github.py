@@ -0,0 +1,124 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import pytest
+import requests
+
+from fake_github import FakeGitHub
+from gh_graphql import delete_branches, fetch_pulls, retarget_pulls
+from github_wrapper import Github
+from mergequeue import MergeQueue
+
+
+@pytest.fixture
+def fake():
+    with FakeGitHub() as fake:
+        fake.add_repo('argoai/av')
+        yield fake
+
+
+def github(fake: FakeGitHub) -> Github:
+    return Github(base_url=fake.url, seconds_between_requests=None, seconds_between_writes=None)
+
+
+def test_pull_and_merge(fake):
+    fake.add_pull('argoai/av', 1, behind=True)
+    fake.add_pull('argoai/av', 2, base='change-1')
+    gh_repo = github(fake).get_repo('argoai/av')
+    gh_pr = gh_repo.get_pull(1)
+    assert (gh_pr.mergeable_state, gh_pr.head.ref, gh_pr.base.ref) == ('behind', 'change-1', 'master')
+    assert [review.user.login for review in gh_pr.get_reviews()] == ['reviewer']
+    assert [pull.number for pull in gh_repo.get_pulls(base='change-1')] == [2]
+    assert list(gh_repo.get_branch('master').protection.required_status_checks.contexts) == ['ci']
+
+    assert gh_repo.merge(base='change-1', head='master').sha
+    assert gh_repo.merge(base='change-1', head='master') is None  # nothing left to merge
+    assert gh_repo.get_pull(1).mergeable_state == 'blocked'
+    assert [status.state for status in gh_repo.get_commit('change-1').get_statuses()] == ['pending']
+    fake.tick()
+    gh_pr = gh_repo.get_pull(1)
+    assert gh_pr.mergeable_state == 'clean'
+    assert gh_pr.merge(commit_title='Merged').merged
+    assert gh_repo.get_pull(1).merged
+
+    gh_repo.get_pull(2).edit(base='master')
+    gh_repo.get_git_ref('heads/change-1').delete()
+    assert 'change-1' not in fake.repos['argoai/av'].branches
+    assert fake.pull('argoai/av', 2).open and fake.calls['DELETE /repos/:repo/git/refs/:ref'] == 1
+
+
+def test_pages(fake):
+    for nb in range(1, 36):
+        fake.add_pull('argoai/av', nb)
+    fake.review('argoai/av', 3, 'late')  # the most recently updated
+    gh_repo = github(fake).get_repo('argoai/av')
+    assert len(list(gh_repo.get_pulls(base='master'))) == 35
+    assert next(iter(gh_repo.get_pulls(state='all', sort='updated', direction='desc'))).number == 3
+    assert fake.calls['GET /repos/:repo/pulls'] == 3
+
+
+def test_graphql(fake):
+    fake.add_pull('argoai/av', 1, labels=['merge'])
+    fake.add_pull('argoai/av', 2, base='change-1')
+    gh_repo = github(fake).get_repo('argoai/av')
+    pulls = fetch_pulls(gh_repo, [1, 2, 3])
+    assert sorted(pulls) == [1, 2]
+    assert pulls[1].mergeable_state == 'clean' and pulls[1].labels[0].name == 'merge'
+    assert retarget_pulls(gh_repo, {2: 'master', 3: 'master'}) == {3}
+    assert fake.pull('argoai/av', 2).base == 'master'
+    assert delete_branches(gh_repo, ['change-1', 'gone']) == {'gone'}
+    assert 'change-1' not in fake.repos['argoai/av'].branches
+
+
+def test_faults(fake):
+    url = f'{fake.url}/repos/argoai/av'
+    assert requests.get(url).headers['X-RateLimit-Remaining'] == '4999'
+    fake.error_rate = 1.0
+    assert requests.get(url).status_code == 502
+    fake.error_rate, fake.secondary_rate_limit, fake.retry_after = 0.0, 1.0, 2
+    response = requests.get(url)
+    assert response.status_code == 403 and response.headers['Retry-After'] == '2'
+    fake.secondary_rate_limit, fake.remaining = 0.0, 0
+    response = requests.get(url)
+    assert response.status_code == 403 and response.headers['X-RateLimit-Remaining'] == '0'
+    assert fake.injected == {'server_error': 1, 'secondary_rate_limited': 1, 'rate_limited': 1}
+
+
+def test_check_against_fake(fake):
+    fake.add_pull('argoai/av', 1, behind=True)
+    fake.add_pull('argoai/av', 2, approved_by=())
+    fake.at(1, lambda fake: fake.review('argoai/av', 2, 'reviewer'))
+    merge_queue = MergeQueue(github(fake).get_repo('argoai/av'))
+    for nb in (1, 2):
+        merge_queue.ask_pr(nb)
+        merge_queue.bless_pr(nb)
+    for _ in range(6):
+        list(merge_queue.check())
+        fake.tick()
+    assert fake.merged_count() == 2 and not merge_queue.get_queue()
+    assert 'change-1' not in fake.repos['argoai/av'].branches
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_load_run(engine):
+    pytest.importorskip('errbot')
+    if engine == 'async':
+        pytest.importorskip('aiohttp')
+    import load_test
+    results = load_test.run(rooms=3, prs=6, cycles=5, engine=engine)
+    assert len(results['cycles']) == 5 and results['setup'][1] == 6  # a repo and a GraphQL query per room
+    merged = sum(merged for _, _, merged in results['cycles'])
+    assert merged >= 6 and results['queued'] < 18
+    assert results['messages'] > 0 and not results['injected']
+    assert load_test.format_results(results).startswith(f'3 rooms, 18 PRs, {engine} engine')
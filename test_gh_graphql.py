@@ -0,0 +1,164 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import re
+
+from gh_graphql import GraphQLPull
+from mergequeue import MergeQueue
+from pr import PR, PRTransition
+from test_mergequeue import FakeGHPullRequest, FakeGHRef, FakeGHRepo
+
+
+def pull_data(nb, state='OPEN', label=None):
+    return {'id': f'PR_{nb}', 'number': nb, 'url': f'https://github.com/argoai/av/pull/{nb}', 'state': state, 'title': f'PR {nb}',
+            'body': '', 'mergeable': 'MERGEABLE', 'mergeStateStatus': 'BEHIND', 'headRefName': f'branch-{nb}',
+            'baseRefName': 'master', 'author': {'login': 'dugenou'}, 'updatedAt': f'2026-10-19T10:00:{nb}Z',
+            'labels': {'nodes': [{'name': label}] if label else []},
+            'reviews': {'nodes': [{'state': 'APPROVED', 'author': {'login': 'dugland'}},
+                                  {'state': 'COMMENTED', 'author': None}]}}
+
+
+class FakeRequester:
+    graphql_url = 'https://api.github.com/graphql'
+
+    def __init__(self, pulls, branches=()):
+        self.pulls = {pull['number']: pull for pull in pulls}
+        self.branches = set(branches)
+        self.queries = []
+        self.failing = set()  # PRs that cannot be retargeted
+
+    def requestJsonAndCheck(self, verb, url, input):
+        self.queries.append(input)
+        if input['query'].strip().startswith('mutation'):
+            data = {}
+            for alias, pr_id, base in re.findall(r'(\w+): updatePullRequest\(input: {pullRequestId: "(\w+)", '
+                                                 r'baseRefName: "([^"]+)"}', input['query']):
+                pull = self.pulls[int(pr_id[3:])]
+                if pull['number'] not in self.failing:
+                    pull['baseRefName'] = base
+                data[alias] = None if pull['number'] in self.failing else {'clientMutationId': None}
+            for alias, ref_id in re.findall(r'(\w+): deleteRef\(input: {refId: "(\w+)"}', input['query']):
+                self.branches.remove(ref_id[4:])
+                data[alias] = {'clientMutationId': None}
+            return {}, {'data': data}
+        refs = {alias: {'id': f'REF_{branch}'} if branch in self.branches else None
+                for alias, branch in re.findall(r'(\w+): ref\(qualifiedName: "refs/heads/([^"]+)"\)', input['query'])}
+        if refs:
+            return {}, {'data': {'repository': refs}}
+        if 'search' in input['query']:
+            search = input['variables']['query']
+            nodes = [pull for pull in self.pulls.values() if pull['state'] == 'OPEN']
+            label = re.search(r'label:"([^"]+)"', search)
+            if label:
+                nodes = [pull for pull in nodes if {'name': label.group(1)} in pull['labels']['nodes']]
+            updated = re.search(r'updated:>=(\S+)', search)
+            if updated:
+                nodes = [pull for pull in nodes if pull['updatedAt'] >= updated.group(1)]
+            return {}, {'data': {'search': {'pageInfo': {'hasNextPage': False, 'endCursor': None}, 'nodes': nodes}}}
+        numbers = [int(nb) for nb in re.findall(r'pullRequest\(number: (\d+)\)', input['query'])]
+        return {}, {'data': {'repository': {f'pr{nb}': self.pulls.get(nb) for nb in numbers}},
+                    'errors': [{'type': 'NOT_FOUND', 'message': f'No PR {nb}'}
+                               for nb in numbers if nb not in self.pulls]}
+
+
+class GraphQLRepo(FakeGHRepo):
+    full_name = 'argoai/av'
+
+    def __init__(self, pulls, branches=()):
+        super().__init__()
+        self.requester = FakeRequester(pulls, branches)
+
+
+def test_fetch_many_in_one_request():
+    repo = GraphQLRepo([pull_data(14), pull_data(15), pull_data(16, state='MERGED')])
+    mq = MergeQueue(repo)
+    mq.ask_pr(15)
+    prs, refused = mq.fetch_prs([14, 15, 16, 17, 14])
+    assert len(repo.requester.queries) == 1
+    assert [pr.nb for pr in prs] == [14]
+    assert refused == {15: 'already in the queue', 16: 'closed', 17: 'not found'}
+    assert prs[0].positive == 1 and prs[0].mergeable and prs[0].mergeable_state == 'behind'
+    assert prs[0].user == 'dugenou' and prs[0].head == 'branch-14'
+
+    assert mq.add_prs(prs) == []
+    assert [pr.nb for pr in mq.queue] == [15, 14]
+
+
+def test_fetch_by_label():
+    repo = GraphQLRepo([pull_data(14, label='release'), pull_data(15), pull_data(16, label='release')])
+    mq = MergeQueue(repo)
+    prs, refused = mq.fetch_prs(search='label:"release"')
+    assert [pr.nb for pr in prs] == [14, 16]
+    assert refused == {}
+    mq.ask_pr(16)
+    assert mq.add_prs(prs, lane='hotfix') == [16]  # queued in the meantime
+    assert [(pr.nb, pr.lane) for pr in mq.queue] == [(16, 'normal'), (14, 'hotfix')]
+
+
+def test_fetch_without_graphql():
+    mq = MergeQueue(FakeGHRepo())
+    mq.ask_pr(15)
+    prs, refused = mq.fetch_prs([14, 15])
+    assert [pr.nb for pr in prs] == [14]
+    assert refused == {15: 'already in the queue'}
+
+
+def test_auto_label():
+    pulls = [pull_data(14, label='merge-queue'), pull_data(15), pull_data(16, label='merge-queue')]
+    repo = GraphQLRepo(pulls)
+    mq = MergeQueue(repo)
+    mq.ask_pr(15)
+    mq.auto_label = 'merge-queue'
+    added, removed = mq.sync_auto_label()
+    assert [pr.nb for pr in added] == [14, 16] and removed == []
+    assert [(pr.nb, pr.auto) for pr in mq.queue] == [(15, False), (14, True), (16, True)]
+    assert mq.label_watermark == '2026-10-19T10:00:16Z'
+
+    # Only what changed since is searched: 16 lost its label, 15 was asked for by hand.
+    pulls[2].update(labels={'nodes': []}, updatedAt='2026-10-19T11:00:00Z')
+    pulls[1].update(labels={'nodes': []}, updatedAt='2026-10-19T11:00:00Z')
+    added, removed = mq.sync_auto_label()
+    assert 'updated:>=2026-10-19T10:00:16Z' in repo.requester.queries[-1]['variables']['query']
+    assert added == [] and [pr.nb for pr in removed] == [16]
+    assert [pr.nb for pr in mq.queue] == [15, 14]
+
+    # After a restart the full search catches what happened in the meantime.
+    # 17 got merged meanwhile, the check reports it and cleans up after it.
+    merged = PR(GraphQLPull(pull_data(17, label='merge-queue')))
+    merged.auto = True
+    repo.requester.pulls[17] = pull_data(17, state='MERGED', label='merge-queue')
+    restarted = MergeQueue(repo, initial_queue=mq.queue + [merged])
+    restarted.auto_label = 'merge-queue'
+    pulls[0].update(labels={'nodes': []})
+    added, removed = restarted.sync_auto_label()
+    assert [pr.nb for pr in removed] == [14]
+    assert [pr.nb for pr in restarted.queue] == [15, 17]
+
+
+def test_clean_up_after_merges():
+    repo = GraphQLRepo([pull_data(nb) for nb in (21, 22, 23)], branches=['a', 'c'])
+    repo.requester.failing = {23}
+    mq = MergeQueue(repo)
+    merged = [PR(FakeGHPullRequest(nb, head=FakeGHRef(branch))) for nb, branch in ((20, 'a'), (24, 'c'))]
+    dependents = [PR(FakeGHPullRequest(nb)) for nb in (21, 22, 23)]
+    mq.cleanups = [(merged[0], 'a', dependents[:2]), (merged[1], 'c', dependents[2:])]
+
+    transitions = list(mq.clean_up())
+    assert [(pr.nb, [(state, params[0]) for state, params in states]) for pr, states in transitions] == [
+        (20, [(PRTransition.NEW_BASE, 21), (PRTransition.NEW_BASE, 22)]), (24, [(PRTransition.NEW_BASE_ERROR, 23)])]
+    assert [repo.requester.pulls[nb]['baseRefName'] for nb in (21, 22, 23)] == ['develop', 'develop', 'master']
+    # The branch of 24 is kept, deleting it would close 23.
+    assert repo.requester.branches == {'c'}
+    # Ids of the PRs, their new base, ids of the branches, their deletion.
+    assert len(repo.requester.queries) == 4
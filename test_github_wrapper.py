@@ -0,0 +1,154 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import json
+import pytest
+import requests
+
+from bench_check import load_queues
+import github_wrapper
+from github_wrapper import PooledHTTPSConnection, Github, recording, replaying, CassetteMismatch
+from pr import PR
+from test_mergequeue import FakeGHPullRequest
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text='{}'):
+        self.status_code = status_code
+        self.headers = headers if headers else {}
+        self.text = text
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, verb, url, **kwargs):
+        self.requests.append((verb, url, kwargs['timeout']))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(github_wrapper.time, 'sleep', sleeps.append)
+    github_wrapper.transport_stats.clear()
+    return sleeps
+
+
+def connection(monkeypatch, responses, verb='GET', url='/repos/argoai/av/pulls/12'):
+    session = FakeSession(responses)
+    monkeypatch.setattr(PooledHTTPSConnection, 'session', classmethod(lambda cls: session))
+    cnx = PooledHTTPSConnection('api.github.com', timeout=15)
+    cnx.request(verb, url, None, {})
+    return cnx, session
+
+
+def test_retry_server_errors(monkeypatch, sleeps):
+    cnx, session = connection(monkeypatch, [FakeResponse(502), requests.ConnectionError(), FakeResponse(200)])
+    assert cnx.getresponse().status == 200
+    assert len(session.requests) == 3
+    assert len(sleeps) == 2
+    assert github_wrapper.transport_stats['retried'] == 2
+    assert github_wrapper.transport_stats['success'] == 1
+
+
+def test_no_retry_on_post(monkeypatch, sleeps):
+    cnx, session = connection(monkeypatch, [FakeResponse(502)], verb='POST', url='/repos/argoai/av/merges')
+    assert cnx.getresponse().status == 502
+    assert session.requests == [('POST', 'https://api.github.com:443/repos/argoai/av/merges', 60)]
+    assert github_wrapper.transport_stats['gave_up'] == 1
+
+
+def test_no_retry_on_merge(monkeypatch, sleeps):
+    cnx, session = connection(monkeypatch, [FakeResponse(502)], verb='PUT', url='/repos/argoai/av/pulls/12/merge')
+    assert cnx.getresponse().status == 502
+    assert len(session.requests) == 1 and sleeps == []
+    assert github_wrapper.transport_stats['gave_up'] == 1
+
+
+def test_secondary_rate_limit_retry_after(monkeypatch, sleeps):
+    limited = FakeResponse(403, {'Retry-After': '7'}, '{"message": "You have exceeded a secondary rate limit."}')
+    cnx, session = connection(monkeypatch, [limited, FakeResponse(200)], verb='POST', url='/repos/argoai/av/merges')
+    assert cnx.getresponse().status == 200
+    assert sleeps == [7.0]
+    assert github_wrapper.transport_stats['rate_limited'] == 1
+
+
+def test_primary_rate_limit_not_retried(monkeypatch, sleeps):
+    cnx, session = connection(monkeypatch, [FakeResponse(403, {'X-RateLimit-Remaining': '0'})])
+    assert cnx.getresponse().status == 403
+    assert sleeps == []
+    assert github_wrapper.transport_stats['client_error'] == 1
+
+
+def test_gives_up(monkeypatch, sleeps):
+    cnx, session = connection(monkeypatch, [FakeResponse(503)] * (github_wrapper.MAX_RETRIES + 1))
+    assert cnx.getresponse().status == 503
+    assert len(sleeps) == github_wrapper.MAX_RETRIES
+    assert github_wrapper.transport_stats['gave_up'] == 1
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({'full_name': 'argoai/av', 'name': 'av', 'url': 'http://localhost/repos/argoai/av'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_record_replay(tmp_path):
+    server = HTTPServer(('127.0.0.1', 0), FakeGithubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    path = str(tmp_path / 'cassette.jsonl')
+
+    with recording(path, meta={'rooms': 1}):
+        assert Github(base_url=base_url).get_repo('argoai/av').full_name == 'argoai/av'
+    server.shutdown()
+    server.server_close()
+
+    with replaying(path) as cassette:
+        assert cassette.meta == {'rooms': 1}
+        gh = Github(base_url=base_url)
+        assert gh.get_repo('argoai/av').full_name == 'argoai/av'
+        with pytest.raises(CassetteMismatch):
+            gh.get_repo('argoai/av')
+        cassette.rewind()
+        assert gh.get_repo('argoai/av').name == 'av'
+
+
+def test_cassette_queues(tmp_path):
+    path = str(tmp_path / 'cassette.jsonl')
+    queue = [PR(FakeGHPullRequest(12)), PR(FakeGHPullRequest(13))]
+    meta = {'queues': {'room argoai/av': {'repo': 'argoai/av', 'max_pulled_prs': 2,
+                                          'queue': [pr.to_state() for pr in queue], 'pulled_prs': [12]}}}
+    with recording(path, meta=meta):
+        pass
+
+    with replaying(path) as cassette:
+        merge_queue = load_queues(Github('replayed-token'), cassette.meta)['room argoai/av']
+        assert [pr.nb for pr in merge_queue.get_queue()] == [12, 13]
+        assert merge_queue.get_pulled_prs() == [12]
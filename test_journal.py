@@ -0,0 +1,135 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import pytest
+
+from journal import Journal
+from mergequeue import MergeQueue
+from test_mergequeue import FakeGHRepo, FakeGHPullRequest, FakeGHReview, CLEAN
+
+
+class CrashingGHPullRequest(FakeGHPullRequest):
+    def merge(self, commit_title=None):
+        raise KeyboardInterrupt('killed in the middle of the merge')
+
+
+def journaled_queue(tmp_path, prs):
+    journal = Journal(str(tmp_path / 'room'), sync_every=1000, sync_interval=1000)
+    journal.compact([], [])
+    return MergeQueue(FakeGHRepo(injected_prs=prs), journal=journal), journal
+
+
+def test_replay_rebuilds_the_queue(tmp_path):
+    pr_15 = FakeGHPullRequest(15, reviews=[])
+    merge_queue, journal = journaled_queue(tmp_path, [pr_15])
+    merge_queue.ask_pr(14)
+    merge_queue.ask_pr(15)
+    merge_queue.ask_pr(16)
+    merge_queue.bless_pr(14)
+    merge_queue.sink_pr(14)
+    merge_queue.rm_pr(16)
+    pr_15.add_review(FakeGHReview('dugenou'))
+    list(merge_queue.check())  # syncs at the end
+
+    queue, pulled_prs = Journal(str(tmp_path / 'room')).replay()
+    assert [pr.nb for pr in queue] == [15, 14]
+    assert queue[1].blessed and queue[0].positive == 1
+    assert [pr.display_state() for pr in queue] == [pr.display_state() for pr in merge_queue.queue]
+
+    # Compacting keeps the same state, a torn record at the end is ignored.
+    journal.compact(merge_queue.queue, merge_queue.pulled_prs)
+    merge_queue.bump_pr(14)
+    journal.sync()
+    with open(journal.journal_path, 'a') as torn:
+        torn.write('{"seq": 99, "op": "rem')
+    queue, pulled_prs = Journal(str(tmp_path / 'room')).replay()
+    assert [pr.nb for pr in queue] == [14, 15]
+    assert pulled_prs == [14]
+
+
+def test_merge_is_written_ahead(tmp_path):
+    pr_14 = CrashingGHPullRequest(14, reviews=[FakeGHReview()], mergeable=True, mergeable_state=CLEAN)
+    merge_queue, journal = journaled_queue(tmp_path, [pr_14])
+    merge_queue.ask_pr(14)
+    merge_queue.bless_pr(14)
+    with pytest.raises(KeyboardInterrupt):
+        list(merge_queue.check())
+
+    with open(journal.journal_path) as journal_file:
+        records = [json.loads(line) for line in journal_file]
+    assert records[-1]['op'] == 'transition' and records[-1]['states'] == [['MERGING', None]]
+    queue, _ = Journal(str(tmp_path / 'room')).replay()
+    assert queue[0].blessed
+
+
+def test_merge_is_journaled_once(tmp_path):
+    pr_14 = FakeGHPullRequest(14, reviews=[FakeGHReview()], mergeable=True, mergeable_state=CLEAN)
+    merge_queue, journal = journaled_queue(tmp_path, [pr_14])
+    merge_queue.ask_pr(14)
+    merge_queue.bless_pr(14)
+    list(merge_queue.check())
+
+    with open(journal.journal_path) as journal_file:
+        records = [json.loads(line) for line in journal_file]
+    transitions = [record['states'] for record in records if record['op'] == 'transition']
+    assert transitions == [[['MERGING', None]]]
+
+
+def test_replay_over_the_storage(tmp_path):
+    merge_queue, journal = journaled_queue(tmp_path, [])
+    merge_queue.ask_pr(14)
+    merge_queue.ask_pr(15)
+    stored = list(merge_queue.queue)
+    journal.saved(journal.seq)  # what the storage has
+    assert Journal(str(tmp_path / 'room')).replay(stored, []) is None
+
+    # Only the changes the storage missed are applied over it.
+    merge_queue.rm_pr(14)
+    journal.sync()
+    queue, _ = Journal(str(tmp_path / 'room')).replay([stored[1]], [])
+    assert [pr.nb for pr in queue] == [15]
+
+    # A storage older than the snapshot gives way to it.
+    journal.compact(merge_queue.queue, merge_queue.pulled_prs)
+    queue, _ = Journal(str(tmp_path / 'room')).replay(stored, [])
+    assert [pr.nb for pr in queue] == [15]
+
+
+def test_merge_in_flight_is_checked_first(tmp_path):
+    pr_14 = CrashingGHPullRequest(14, reviews=[FakeGHReview()], mergeable=True, mergeable_state=CLEAN)
+    merge_queue, journal = journaled_queue(tmp_path, [pr_14])
+    merge_queue.ask_pr(14)
+    merge_queue.bless_pr(14)
+    with pytest.raises(KeyboardInterrupt):
+        list(merge_queue.check())
+
+    restarted = Journal(str(tmp_path / 'room'))
+    queue, pulled_prs = restarted.replay()
+    assert restarted.merging == {14}
+    pr_14 = FakeGHPullRequest(14, reviews=[FakeGHReview()], mergeable=True, mergeable_state=CLEAN)
+    merge_queue = MergeQueue(FakeGHRepo(injected_prs=[pr_14]), initial_queue=queue, journal=restarted)
+    # The merge did not go through: it is not merged blindly again in the same check.
+    assert list(merge_queue.check()) == [] and not pr_14.asked_to_be_merged
+    assert merge_queue.unverified_merges == set()
+    list(merge_queue.check())
+    assert pr_14.asked_to_be_merged
+
+
+def test_delete(tmp_path):
+    merge_queue, journal = journaled_queue(tmp_path, [])
+    merge_queue.ask_pr(14)
+    journal.delete()
+    merge_queue.ask_pr(15)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,117 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+
+from leases import LeaseStore, Sharder
+
+ROOMS = [f'#team{i}' for i in range(20)]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def instances(tmp_path, *names):
+    clock = Clock()
+    path = str(tmp_path / 'leases.sqlite')
+    return clock, [Sharder(LeaseStore(path), name, ttl=300, clock=clock) for name in names]
+
+
+def test_rebalance_on_join_and_leave(tmp_path):
+    clock, (a, b) = instances(tmp_path, 'a', 'b')
+    assert a.rebalance(ROOMS) == set(ROOMS)
+
+    # b joins: it waits for a to hand the rooms over, nobody owns them twice meanwhile.
+    assert b.rebalance(ROOMS) == set()
+    moving = {room for room in ROOMS if Sharder.owner_of(room, ['a', 'b']) == 'b'}
+    assert moving and moving != set(ROOMS)
+    clock.now += 120
+    assert a.rebalance(ROOMS) == set(ROOMS) - moving
+    assert b.rebalance(ROOMS) == moving
+    assert all(a.owns(room) != b.owns(room) for room in ROOMS)
+
+    # b leaves cleanly, a takes everything back without waiting for the leases to expire.
+    b.stop()
+    assert a.rebalance(ROOMS) == set(ROOMS)
+
+
+def test_fencing_after_stall(tmp_path):
+    clock, (a, b) = instances(tmp_path, 'a', 'b')
+    a.rebalance(['#room'])
+    b.rebalance(['#room'])
+    owner, other = (a, b) if a.owns('#room') else (b, a)
+
+    # The owner stalls past its lease: the other instance takes the room over...
+    clock.now += 400
+    assert other.rebalance(['#room']) == {'#room'}
+    # ...and the stalled one must not merge anymore, even though it thinks it owns the room.
+    assert '#room' in owner.tokens
+    assert not owner.owns('#room')
+    assert other.owns('#room')
+
+
+def test_elected_for_new_rooms(tmp_path):
+    _, (a, b) = instances(tmp_path, 'a', 'b')
+    a.rebalance([])
+    b.rebalance([])
+    # Exactly one instance answers for a room nobody holds the lease of yet.
+    assert all(a.elected(room) != b.elected(room) for room in ROOMS)
+    assert {room for room in ROOMS if b.elected(room)} == {room for room in ROOMS
+                                                           if Sharder.owner_of(room, ['a', 'b']) == 'b'}
+
+
+def test_rooms_configured_by_another_instance(tmp_path):
+    pytest.importorskip('errbot')
+    from fake_github import FakeGitHub
+    from load_test import LoadBot, LoadSummit
+
+    def summit(instance):
+        plugin = LoadSummit(LoadBot(str(tmp_path)), 'Summit')
+        plugin.configure({'github-token': 'token', 'github-url': fake.url, 'instance-id': instance,
+                          'shard-store': str(tmp_path / 'leases.sqlite'),
+                          'state-store': str(tmp_path / 'rooms.sqlite')})
+        plugin.activate()
+        return plugin
+
+    room = next(room for room in ROOMS if Sharder.owner_of(room, ['a', 'b']) == 'a')
+    msg = SimpleNamespace(is_group=True, frm=SimpleNamespace(room=room, aclattr='dugenou'))
+    with FakeGitHub() as fake:
+        fake.add_repo('argoai/av')
+        a, b = summit('a'), summit('b')
+        # Both instances hear the command, the one elected for the room configures it.
+        assert b.merge_config(msg, ['argoai/av']) is None
+        assert a.merge_config(msg, ['argoai/av']).startswith('Configured')
+        assert b.merge_saints(msg, None) is None
+        assert a.merge_saints(msg, None).endswith('Saint dugenou')
+
+        # a leaves: b takes over the room it did not load when it started.
+        a.deactivate()
+        b.check_pr_states()
+        assert b.merge_saints(msg, None).endswith('Saint dugenou')
+
+        # a is back and b deconfigures the room: a no longer checks it.
+        a = summit('a')
+        assert room in a.queues
+        assert b.merge_deconfig(msg, None).startswith('You no longer have a queue')
+        a.check_pr_states()
+        assert room not in a.queues and room not in a.sharder.tokens
+        a.deactivate()
+        b.deactivate()
@@ -12,6 +12,9 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+from datetime import datetime
+import pickle
+from types import SimpleNamespace
 from typing import List
 from mergequeue import MergeQueue, MergeQueueException
 from pr import PR, PRTransition
@@ -92,6 +95,9 @@ class FakeGHPullRequest:
     def merge(self, commit_title=None):
         self.asked_to_be_merged = True
 
+    def edit(self, base=None):
+        self.base = FakeGHRef(base)
+
     def add_review(self, review):
         self.reviews.append(review)
 
@@ -108,6 +114,7 @@ class FakeGHRepo:
     def __init__(self, injected_prs: List[FakeGHPullRequest]=None):
         self.injected_prs = injected_prs if injected_prs else {}
         self.merge_requests = []
+        self.deleted_refs = []
 
     def get_pull(self, pr_nb):
         # if we have a precise desire fullfill it...
@@ -118,12 +125,15 @@ class FakeGHRepo:
         return FakeGHPullRequest(number=pr_nb)
 
     def get_pulls(self, base=None):
-        return []
+        return [pr for pr in self.injected_prs if pr.base.ref == base]
 
     def merge(self, base=None, head=None):
         self.merge_requests.append((base, head))
         return True
 
+    def get_git_ref(self, ref):
+        return SimpleNamespace(delete=lambda: self.deleted_refs.append(ref))
+
 
 @pytest.fixture(autouse=True)
 def no_requests(monkeypatch):
@@ -261,6 +271,30 @@ def test_check_merged_externally():
     assert transition == PRTransition.MERGED
 
 
+class EventStats(NoStats):
+    def __init__(self):
+        self.events = []
+
+    def send_event(self, event_type, pr):
+        self.events.append((event_type, pr.nb))
+
+
+class FailingMergeGHPullRequest(FakeGHPullRequest):
+    def merge(self, commit_title=None):
+        raise Exception('409 Base branch was modified')
+
+
+def test_failed_merge_is_not_counted():
+    pr_14 = FailingMergeGHPullRequest(14, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True,
+                                      mergeable_state=CLEAN)
+    mq = MergeQueue(FakeGHRepo(injected_prs=[pr_14]), stats=EventStats())
+    mq.ask_pr(14)
+    mq.bless_pr(14)
+    transitions = list(mq.check())
+    assert [state for state, _ in transitions[0][1]] == [PRTransition.MERGING]
+    assert ('merged', 14) not in mq.stats.events
+
+
 def test_check_merged_by_errbot():
     pr_14 = FakeGHPullRequest(14, reviews=[FakeGHReview('user1', APPROVED)])
     repo = FakeGHRepo(injected_prs=[pr_14])
@@ -285,6 +319,53 @@ def test_check_merged_by_errbot():
 
 
 
+def test_clean_up_after_merge():
+    pr_20 = FakeGHPullRequest(20, head=FakeGHRef('a'), reviews=[FakeGHReview('user1', APPROVED)],
+                              mergeable=True, mergeable_state=CLEAN)
+    pr_21 = FakeGHPullRequest(21, head=FakeGHRef('b'), base=FakeGHRef('a'))
+    pr_22 = FakeGHPullRequest(22, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True, mergeable_state=CLEAN)
+    repo = FakeGHRepo(injected_prs=[pr_20, pr_21, pr_22])
+    mq = MergeQueue(repo)
+    for nb in (20, 22):
+        mq.ask_pr(nb)
+        mq.bless_pr(nb)
+    list(mq.check())
+    pr_20.merged = True
+
+    transitions = list(mq.check())
+    # The rest of the queue is checked before the clean up.
+    assert [(pr.nb, [state for state, _ in states]) for pr, states in transitions] == [
+        (20, [PRTransition.MERGED]), (22, [PRTransition.MERGING]), (20, [PRTransition.NEW_BASE])]
+    assert transitions[-1][1][0][1] == (21, pr_21.html_url, 'develop')
+    assert pr_21.base.ref == 'develop' and repo.deleted_refs == ['heads/a']
+    assert mq.cleanups == []
+
+
+def test_hold_dependents_of_merged_pr():
+    pr_20 = FakeGHPullRequest(20, head=FakeGHRef('a'), merged=True)
+    pr_21 = FakeGHPullRequest(21, base=FakeGHRef('a'), reviews=[FakeGHReview('user1', APPROVED)],
+                              mergeable=True, mergeable_state=CLEAN)
+    pr_22 = FakeGHPullRequest(22, base=FakeGHRef('a'), reviews=[FakeGHReview('user1', APPROVED)],
+                              mergeable=True, mergeable_state='behind')
+    repo = FakeGHRepo(injected_prs=[pr_20, pr_21, pr_22])
+    mq = MergeQueue(repo)
+    for nb in (20, 21, 22):
+        mq.ask_pr(nb)
+        mq.bless_pr(nb)
+
+    transitions = list(mq.check())
+    # Neither merged nor pulled into the branch the clean up deletes.
+    assert [(pr.nb, [state for state, _ in states]) for pr, states in transitions] == [
+        (20, [PRTransition.MERGED]), (20, [PRTransition.NEW_BASE, PRTransition.NEW_BASE])]
+    assert not pr_21.asked_to_be_merged and repo.merge_requests == [] and mq.pulled_prs == []
+    assert (pr_21.base.ref, pr_22.base.ref) == ('develop', 'develop') and repo.deleted_refs == ['heads/a']
+
+    transitions = list(mq.check())
+    assert [(pr.nb, [state for state, _ in states]) for pr, states in transitions] == [
+        (21, [PRTransition.MERGING]), (22, [PRTransition.PULLED, PRTransition.PULLED_SUCCESS])]
+    assert pr_21.asked_to_be_merged and repo.merge_requests == [('feature/stuff_22', 'develop')]
+
+
 def test_reviews():
     pr_1 = FakeGHPullRequest(1, reviews=[FakeGHReview('user1', APPROVED)], mergeable_state=CLEAN)
     repo = FakeGHRepo(injected_prs=[pr_1])
@@ -363,6 +444,327 @@ def test_check_queue_depth():
     assert len(mq.pulled_prs) == 1
 
 
+def test_pr_version():
+    pr_14 = FakeGHPullRequest(14)
+    mq = MergeQueue(FakeGHRepo(injected_prs=[pr_14]))
+    mq.ask_pr(14)
+    assert mq.queue[0].version == 1
+    list(mq.check())
+    assert mq.queue[0].version == 1  # nothing changed
+
+    pr_14.reviews.append(FakeGHReview('dugenou', APPROVED))
+    list(mq.check())
+    assert mq.queue[0].version == 2
+
+    mq.bless_pr(14)
+    assert mq.queue[0].version == 3
+    list(mq.check())
+    assert mq.queue[0].version == 3
+
+    # Added again, it does not get a version a rendering was cached for.
+    mq.rm_pr(14)
+    mq.ask_pr(14)
+    assert mq.queue[0].version == 4
+    assert MergeQueue(FakeGHRepo(), initial_queue=mq.queue).next_version() == 5
+
+
+def test_chained_prs_count():
+    pr_20 = FakeGHPullRequest(20, head=FakeGHRef('a'))
+    pr_21 = FakeGHPullRequest(21, head=FakeGHRef('b'), base=FakeGHRef('a'))
+    pr_22 = FakeGHPullRequest(22, head=FakeGHRef('c'), base=FakeGHRef('b'))
+    pr_23 = FakeGHPullRequest(23, head=FakeGHRef('d'), base=FakeGHRef('a'))
+    repo = FakeGHRepo(injected_prs=[pr_20, pr_21, pr_22, pr_23])
+    mq = MergeQueue(repo)
+    mq.ask_pr(20)
+
+    transitions = list(mq.check())
+    assert len(transitions) == 1
+    pr, [(transition, params)] = transitions[0]
+    assert transition == PRTransition.NEW_CHAINED_PR and params == 3
+    assert mq.count_dependent_prs(mq.queue[0]) == 3
+    assert mq.queue[0].dependents == (21, 23)
+    assert [dependent.nb for dependent in mq.dependents_of(mq.queue[0])] == [21, 23]
+    assert mq.chained[21].dependents == (22,) and mq.chained[21].dependents_count == 1
+
+    assert len(list(mq.check())) == 0  # same tree, no transition
+
+    # Only the queue is stored: after a restart the listing waits for the next check to fetch the chained PRs.
+    listed = []
+    offline_repo = FakeGHRepo()
+    offline_repo.get_pulls = lambda base=None: listed.append(base) or []
+    restarted = MergeQueue(offline_repo, initial_queue=pickle.loads(pickle.dumps(mq.queue)))
+    restarted.incremental, restarted.stale_prs = True, set()
+    assert restarted.dependents_of(restarted.queue[0]) == [] and listed == []
+    assert restarted.stale_prs == {20}
+    restarted.gh_repo = repo
+    list(restarted.check())
+    assert [dependent.nb for dependent in restarted.dependents_of(restarted.queue[0])] == [21, 23]
+    assert [dependent.nb for dependent in restarted.dependents_of(restarted.chained[21])] == [22]
+
+
+def test_chained_prs_cycle():
+    pr_20 = FakeGHPullRequest(20, head=FakeGHRef('a'), base=FakeGHRef('b'))
+    pr_21 = FakeGHPullRequest(21, head=FakeGHRef('b'), base=FakeGHRef('a'))
+    repo = FakeGHRepo(injected_prs=[pr_20, pr_21])
+    mq = MergeQueue(repo)
+    pr, _ = mq.get_pr(20)
+    dependents = mq.get_dependents_prs(pr)
+    assert [dependent.nb for dependent in dependents] == [21]
+    assert dependents[0].dependents == () and mq.chained[21] is dependents[0]
+
+
+class LegacyPickle:
+    """
+    Pickles like the PRs did before they had slots.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __reduce__(self):
+        return PR.__new__, (PR,), self.state
+
+
+def test_pr_storage():
+    body = '\n'.join(f'line {i}' for i in range(50))
+    pr = PR(FakeGHPullRequest(20, body=body, user=FakeGHUser(''.join(['gbinet', '-argo']))))
+    assert not hasattr(pr, '__dict__')
+    assert pr.description == '\n'.join(f'line {i}' for i in range(5))
+    assert pr.user is PR(FakeGHPullRequest(21)).user  # interned
+    pr.chain([PR(FakeGHPullRequest(21))])
+    restored = pickle.loads(pickle.dumps(pr))
+    assert restored.display_state() == pr.display_state() and restored.dependents == (21,)
+    assert PR.from_state(pr.to_state()).display_state() == pr.display_state()
+
+    # Stored before: a __dict__ without lane or version, and nested dependents.
+    child = dict(PR(FakeGHPullRequest(22)).__getstate__(), _dependents=())
+    del child['dependents'], child['dependents_count']
+    legacy = dict(child, nb=21, description=body, _dependents=(LegacyPickle(child),), _dependents_count=1)
+    del legacy['lane'], legacy['version']
+    old = pickle.loads(pickle.dumps(LegacyPickle(legacy)))
+    assert old.nb == 21 and old.lane == 'normal' and old.version is None
+    assert old.dependents == (22,) and old.dependents_count == 1 and old.description.count('\n') == 4
+    nested = dict(pr.to_state(), dependents=[dict(PR(FakeGHPullRequest(21)).to_state(), dependents=[{'nb': 22}])])
+    assert PR.from_state(nested).dependents == (21,) and PR.from_state(nested).dependents_count == 2
+
+
+def test_check_survives_fetch_error():
+    pr_15 = FakeGHPullRequest(15, reviews=[])
+    repo = FakeGHRepo(injected_prs=[pr_15])
+    mq = MergeQueue(repo)
+    mq.ask_pr(14)
+    mq.ask_pr(15)
+
+    get_pull = repo.get_pull
+
+    def flaky_get_pull(pr_nb):
+        if pr_nb == 14:
+            raise IOError('502 Bad Gateway')
+        return get_pull(pr_nb)
+
+    repo.get_pull = flaky_get_pull
+    pr_15.reviews.append(FakeGHReview('dugenou', APPROVED))
+    transitions = list(mq.check())
+    assert len(transitions) == 1
+    assert transitions[0][0].nb == 15
+    assert [pr.nb for pr in mq.queue] == [14, 15]
+
+
+def test_recheck_unknown():
+    pr_14 = FakeGHPullRequest(14, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True, mergeable_state=BEHIND)
+    pr_15 = FakeGHPullRequest(15, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True, mergeable_state=BEHIND)
+    repo = FakeGHRepo(injected_prs=[pr_14, pr_15])
+    mq = MergeQueue(repo, max_pulled_prs=1)
+    mq.ask_pr(14)
+    mq.ask_pr(15)
+    mq.bless_pr(14)
+    mq.bless_pr(15)
+    list(mq.check())
+    assert mq.unknown_prs == []
+
+    # Just pulled, GitHub is computing the mergeability again.
+    pr_14.mergeable_state = UNKNOWN
+    pr_15.mergeable_state = UNKNOWN
+    list(mq.check())
+    assert mq.unknown_prs == [14]  # 15 is too far in the queue to be worth it
+
+    pr_14.mergeable_state = CLEAN
+    pr_15.mergeable_state = CLEAN
+    transitions = list(mq.recheck(mq.unknown_prs))
+    assert len(transitions) == 1
+    pr, [(transition, params)] = transitions[0]
+    assert pr.nb == 14 and transition == PRTransition.MERGING
+    assert pr_14.asked_to_be_merged and not pr_15.asked_to_be_merged
+    assert mq.unknown_prs == []
+    assert [pr.nb for pr in mq.queue] == [14, 15]
+    assert mq.queue[0].mergeable_state == CLEAN
+    assert mq.queue[1].mergeable_state == BEHIND
+
+
+def test_lanes_scheduling():
+    mq = MergeQueue(FakeGHRepo())
+    for nb in range(1, 5):
+        mq.ask_pr(nb)
+    for nb in range(5, 8):
+        mq.ask_pr(nb, lane='hotfix')
+    mq.ask_pr(8, lane='low')
+    with pytest.raises(MergeQueueException):
+        mq.ask_pr(9, lane='urgent')
+
+    # hotfix:4, normal:2, low:1
+    assert [pr.nb for pr in mq.scheduled_queue()] == [5, 1, 6, 8, 7, 2, 3, 4]
+    mq.move_pr(8, 'hotfix')
+    assert mq.queue[7].lane == 'hotfix'
+    assert [pr.nb for pr in mq.scheduled_queue()] == [5, 1, 6, 7, 2, 8, 3, 4]
+    with pytest.raises(MergeQueueException):
+        mq.move_pr(8, 'urgent')
+
+
+def test_lanes_merge_and_pull_slots():
+    prs = [FakeGHPullRequest(nb, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True, mergeable_state=BEHIND)
+           for nb in (14, 15, 16)]
+    repo = FakeGHRepo(injected_prs=prs)
+    mq = MergeQueue(repo, max_pulled_prs=1)
+    mq.ask_pr(14)
+    mq.ask_pr(15)
+    mq.ask_pr(16, lane='hotfix')
+    for nb in (14, 15, 16):
+        mq.bless_pr(nb)
+
+    list(mq.check())
+    assert mq.pulled_prs == [16]  # the hotfix got the pull slot
+
+    for pr in prs:
+        pr.mergeable_state = CLEAN
+    list(mq.check())
+    assert [pr.asked_to_be_merged for pr in prs] == [False, False, True]
+    assert [pr.nb for pr in mq.queue] == [14, 15, 16]  # the queue order itself is kept
+    assert mq.queue[2].lane == 'hotfix'
+
+
+def test_check_budget():
+    prs = [FakeGHPullRequest(nb, reviews=[]) for nb in (14, 15, 16)]
+    repo = FakeGHRepo(injected_prs=prs)
+    mq = MergeQueue(repo)
+    for nb in (14, 15, 16):
+        mq.ask_pr(nb)
+    mq.move_pr(16, 'hotfix')
+
+    for pr in prs:
+        pr.reviews.append(FakeGHReview('user1', APPROVED))
+    transitions = list(mq.check(max_prs=2))
+    assert [pr.nb for pr, _ in transitions] == [16, 14]  # in scheduling order
+    assert [pr.positive for pr in mq.queue] == [1, 0, 1]  # 15 waits for the next cycle
+    assert [pr.nb for pr in mq.queue] == [14, 15, 16]
+
+    # The next window starts where this one stopped, then wraps around.
+    transitions = list(mq.check(max_prs=2))
+    assert [pr.nb for pr, _ in transitions] == [15]
+    assert [pr.positive for pr in mq.queue] == [1, 1, 1]
+    assert [pr.nb for _, pr in mq.to_refresh(max_prs=2)] == [14, 15]
+
+    # Blessed PRs are refreshed every time.
+    mq.bless_pr(15)
+    assert [pr.nb for _, pr in mq.to_refresh(max_prs=2)] == [16, 15]
+
+
+
+def test_commands_during_check():
+    pr_14 = FakeGHPullRequest(14, reviews=[])
+    pr_15 = FakeGHPullRequest(15, reviews=[])
+    repo = FakeGHRepo(injected_prs=[pr_14, pr_15])
+    mq = MergeQueue(repo)
+    mq.ask_pr(14)
+    mq.ask_pr(15)
+
+    get_pull = repo.get_pull
+
+    def get_pull_while_commands_run(pr_nb):
+        # What the room does while the check waits on GitHub.
+        if pr_nb == 14:
+            mq.bless_pr(14)
+            mq.rm_pr(15)
+            mq.ask_pr(16)
+        return get_pull(pr_nb)
+
+    repo.get_pull = get_pull_while_commands_run
+    pr_14.reviews.append(FakeGHReview('dugenou', APPROVED))
+    list(mq.check())
+    repo.get_pull = get_pull
+    assert [pr.nb for pr in mq.queue] == [14, 16]
+    assert mq.queue[0].blessed and mq.queue[0].positive == 1
+    assert mq.queue[0].version > mq.pr_version(16)
+
+
+def test_fetch_then_add():
+    mq = MergeQueue(FakeGHRepo())
+    pr = mq.fetch_pr(14)
+    assert mq.queue == []  # nothing changes before it is applied
+    revision = mq.revision
+    mq.add_pr(pr, lane='hotfix')
+    assert mq.revision == revision + 1
+    assert mq.pr_version(14) == 1 and mq.pr_version(15) is None
+    with pytest.raises(MergeQueueException):
+        mq.add_pr(pr)
+
+
+
+class ListingGHRepo(FakeGHRepo):
+    full_name = 'argoai/av'
+
+    def __init__(self, injected_prs):
+        super().__init__(injected_prs)
+        self.fetched = []
+        self.base_sha = 'a'
+
+    def get_pull(self, pr_nb):
+        self.fetched.append(pr_nb)
+        return super().get_pull(pr_nb)
+
+    def get_pulls(self, base=None, state=None, sort=None, direction=None):
+        if sort is None:
+            return super().get_pulls(base)
+        return sorted(self.injected_prs, key=lambda pr: pr.updated_at, reverse=True)
+
+    def get_branch(self, branch):
+        return SimpleNamespace(contexts=[], commit=SimpleNamespace(sha=self.base_sha))
+
+
+def test_incremental_check():
+    prs = [FakeGHPullRequest(nb, reviews=[]) for nb in (14, 15, 16)]
+    for minute, pr in enumerate(prs):
+        pr.updated_at = datetime(2026, 10, 19, 10, minute)
+    repo = ListingGHRepo(prs)
+    mq = MergeQueue(repo)
+    mq.incremental = True
+    for pr in prs:
+        mq.ask_pr(pr.number)
+    mq.bless_pr(16)
+
+    def check():
+        repo.fetched.clear()
+        mq.list_changes()
+        return list(mq.check())
+
+    check()
+    assert repo.fetched == [14, 15, 16]  # everything the first time
+
+    check()
+    assert repo.fetched == [16]  # blessed PRs are always refreshed, 14 and 15 did not change
+
+    prs[0].reviews.append(FakeGHReview('dugenou', APPROVED))
+    prs[0].updated_at = datetime(2026, 10, 19, 11, 0)
+    transitions = check()
+    assert sorted(repo.fetched) == [14, 16]
+    assert transitions[0][0].nb == 14 and mq.queue[0].positive == 1
+
+    repo.base_sha = 'b'  # the base moved, every PR on it may have become conflicting
+    check()
+    assert sorted(repo.fetched) == [14, 15, 16]
+    check()
+    assert sorted(repo.fetched) == [14, 16]
+
+
 def test_set_stats_plugin():
     """Test setting stats plugin"""
     repo = FakeGHRepo()
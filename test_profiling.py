@@ -0,0 +1,49 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import pstats
+
+from github_wrapper import ApiProfile, profiling_api
+from mergequeue import MergeQueue
+from profiling import profile_check
+from test_mergequeue import FakeGHRepo, FakeGHPullRequest, FakeGHReview, APPROVED, CLEAN, BEHIND
+
+
+def test_profile_is_a_dry_run(tmp_path):
+    pr_14 = FakeGHPullRequest(14, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True, mergeable_state=CLEAN)
+    pr_15 = FakeGHPullRequest(15, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True, mergeable_state=BEHIND)
+    repo = FakeGHRepo(injected_prs=[pr_14, pr_15])
+    mq = MergeQueue(repo)
+    for nb in (14, 15):
+        mq.ask_pr(nb)
+        mq.bless_pr(nb)
+    queue, revision = list(mq.queue), mq.revision
+
+    path = str(tmp_path / 'check.prof')
+    report = profile_check(mq, path)
+    assert not pr_14.asked_to_be_merged and repo.merge_requests == []
+    assert mq.queue == queue and mq.revision == revision and mq.pulled_prs == []
+    assert 'check_pr' in report and path in report
+    assert pstats.Stats(path).total_calls > 0
+
+
+def test_api_profile():
+    with profiling_api() as api:
+        api.record('GET', '/repos/argoai/av/pulls/14', 0.2, 1000)
+        api.record('GET', '/repos/argoai/av/pulls/15', 0.5, 3000)
+        api.record('GET', '/repos/argoai/av/pulls/15/reviews?per_page=100', 0.1, 10)
+    assert api.summary() == [('GET /repos/:repo/pulls/:number', 2, 0.7, 0.5, 4000),
+                             ('GET /repos/:repo/pulls/:number/reviews', 1, 0.1, 0.1, 10)]
+    assert api.total_bytes() == 4010
+    assert ApiProfile.endpoint('/repos/argoai/av/branches/release/2.4') == '/repos/:repo/branches/:ref'
@@ -0,0 +1,83 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import pytest
+
+from history_stats import Stats, history_path
+from pr import PR
+from test_mergequeue import FakeGHPullRequest
+
+NOW = 1_600_000_000.0
+HOUR = 3600
+
+
+def write_history(path, records):
+    with open(path, 'w') as history:
+        for when, kind, name, value, nb, base in records:
+            history.write(json.dumps({'time': NOW - when, 'kind': kind, 'name': name, 'value': value,
+                                      'repo': 'argoai/av', 'pr': nb, 'base': base, 'lane': 'normal'}) + '\n')
+
+
+def test_history_stats(tmp_path):
+    stats = Stats(str(tmp_path / 'history.jsonl'))
+    pr = PR(FakeGHPullRequest(12))
+    stats.send_event('blessed', pr)
+    stats.send_metric('queue_time_to_merge', 42.0, pr)
+    with open(stats.path) as history:
+        records = [json.loads(line) for line in history]
+    assert [(record['kind'], record['name'], record['repo'], record['pr']) for record in records] == [
+        ('event', 'blessed', 'argoai/av', 12), ('metric', 'queue_time_to_merge', 'argoai/av', 12)]
+
+
+def test_history_path(tmp_path):
+    data_dir = str(tmp_path)
+    assert history_path(data_dir, 'history/merges.jsonl') == str(tmp_path / 'history' / 'merges.jsonl')
+    for name in ['/etc/passwd', '../history.jsonl', 'history/../../history.jsonl']:
+        with pytest.raises(ValueError):
+            history_path(data_dir, name)
+    assert Stats('history.jsonl', data_dir=data_dir).path == str(tmp_path / 'history.jsonl')
+
+
+def test_report(tmp_path):
+    pytest.importorskip('numpy')
+    import report
+    path = str(tmp_path / 'history.jsonl')
+    write_history(path, [
+        (40 * 24 * HOUR, 'event', 'merged', 0, 1, 'develop'),  # out of the window
+        (10 * HOUR, 'event', 'blessed', 0, 12, 'develop'),
+        (9 * HOUR, 'event', 'pull_failed', 0, 12, 'develop'),
+        (8 * HOUR, 'event', 'pulled', 0, 12, 'develop'),
+        (6 * HOUR, 'event', 'merged', 0, 12, 'develop'),
+        (6 * HOUR, 'metric', 'queue_time_to_merge', 20 * HOUR, 12, 'develop'),
+        (30 * HOUR, 'event', 'blessed', 0, 13, 'release'),
+        (29 * HOUR, 'event', 'excommunicated', 0, 13, 'release'),
+        (27 * HOUR, 'event', 'blessed', 0, 13, 'release'),
+        (25 * HOUR, 'event', 'pull_failed', 0, 13, 'release'),
+        (24 * HOUR, 'event', 'merged', 0, 13, 'release'),
+        (24 * HOUR, 'metric', 'queue_time_to_merge', 40 * HOUR, 13, 'release'),
+        (26 * HOUR, 'event', 'merged', 0, 14, 'develop'),  # never blessed
+    ])
+
+    history = report.load(path)
+    assert len(history) == 13
+    assert len(report.load(path)) == 13  # from the cache
+    figures = report.report(history, days=28, now=NOW)
+    assert figures['merges'] == 3
+    assert sum(figures['merges_per_day']) == 3 and figures['merges_per_day'][-2:] == [1, 2]
+    assert figures['time_in_queue'][0] == 30 * HOUR
+    assert sorted(report.blessed_to_merged(history, history.time >= NOW - 28 * 24 * HOUR)) == [3 * HOUR, 4 * HOUR]
+    assert figures['pull_failures'] == 2
+    assert figures['pull_failures_by_base'] == [('develop', 1, 0.5), ('release', 1, 1.0)]
+    assert 'Blessed to merged: p50 3.5h' in report.format_report(figures)
@@ -0,0 +1,68 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import random
+
+import pytest
+
+from simulator import MINUTE, Scenario, Simulation, distribution, percentiles
+
+
+class EveryPoll(Simulation):
+    """
+    Runs all the polls, even the ones that cannot change anything.
+    """
+
+    def poll(self):
+        super().poll()
+        self.idle = False
+
+
+def test_distribution():
+    rng = random.Random(0)
+    assert distribution('fixed:30')(rng) == 30 * MINUTE
+    assert 10 * MINUTE <= distribution('uniform:10:20')(rng) <= 20 * MINUTE
+    draws = [distribution('exp:60')(rng) for _ in range(2000)]
+    assert 50 * MINUTE < sum(draws) / len(draws) < 70 * MINUTE
+    with pytest.raises(ValueError):
+        distribution('normal:30')
+    with pytest.raises(ValueError):
+        distribution('lognormal:30')
+
+
+def test_percentiles():
+    assert percentiles([]) is None
+    assert percentiles(list(range(1, 101))) == [50, 90, 99]
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_skipped_polls_change_nothing(incremental):
+    scenario = Scenario(prs_per_day=30, flaky_rate=0.2, conflict_rate=0.1, incremental=incremental)
+    results = Simulation(scenario, seed=1).run(3)
+    every_poll = EveryPoll(scenario, seed=1).run(3)
+    assert results['skipped_polls'] > results['polls'] / 2 and every_poll['skipped_polls'] == 0
+    for figures in (results, every_poll):
+        del figures['skipped_polls']
+    assert results == every_poll
+
+
+def test_deeper_queue_merges_faster():
+    # Slow CI, the queue keeps up only when several PRs are tested at once.
+    slow_ci = dict(prs_per_day=40, review='fixed:10', ci='fixed:120', flaky_rate=0, conflict_rate=0)
+    shallow = Simulation(Scenario(max_pulled_prs=1, **slow_ci)).run(5)
+    deep = Simulation(Scenario(max_pulled_prs=6, **slow_ci)).run(5)
+    assert shallow['opened'] == deep['opened']
+    assert deep['merges'] > shallow['merges']
+    assert deep['blessed_to_merged'][0] < shallow['blessed_to_merged'][0]
+    assert deep['api_calls_per_merge'] > 0 and shallow['pull_failures'] == deep['pull_failures'] == 0
@@ -0,0 +1,103 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from collections import Counter
+
+from mergequeue import MergeQueue
+from snapshot import SnapshotService
+from test_mergequeue import FakeGHRepo, FakeGHPullRequest, FakeGHReview, CLEAN
+
+
+class CountingGHRepo(FakeGHRepo):
+    full_name = 'argoai/av'
+
+    def __init__(self, injected_prs):
+        super().__init__(injected_prs)
+        self.calls = Counter()
+
+    def get_pull(self, pr_nb):
+        self.calls['get_pull', pr_nb] += 1
+        return super().get_pull(pr_nb)
+
+    def get_pulls(self, base=None):
+        self.calls['get_pulls', base] += 1
+        return super().get_pulls(base)
+
+
+def check_rooms(service, queues):
+    with service.sweep():
+        for merge_queue in queues:
+            list(merge_queue.check(gh_repo=service.repo(merge_queue.gh_repo)))
+
+
+def test_rooms_share_fetches():
+    pr_14 = FakeGHPullRequest(14, reviews=[])
+    pr_15 = FakeGHPullRequest(15, reviews=[])
+    repo = CountingGHRepo([pr_14, pr_15])
+    team_a, team_b = MergeQueue(repo), MergeQueue(repo)
+    team_a.ask_pr(14)
+    team_b.ask_pr(14)
+    team_b.ask_pr(15)
+    repo.calls.clear()
+
+    service = SnapshotService()
+    pr_14.reviews.append(FakeGHReview('dugenou'))
+    check_rooms(service, [team_a, team_b])
+    assert repo.calls['get_pull', 14] == 1
+    assert repo.calls['get_pull', 15] == 1
+    assert team_a.queue[0].positive == team_b.queue[0].positive == 1
+
+    # Nothing is kept from one sweep to the next.
+    check_rooms(service, [team_a, team_b])
+    assert repo.calls['get_pull', 14] == 2
+
+
+def test_merge_invalidates():
+    pr_14 = FakeGHPullRequest(14, reviews=[FakeGHReview()], mergeable=True, mergeable_state=CLEAN)
+    repo = CountingGHRepo([pr_14])
+    team_a, team_b = MergeQueue(repo), MergeQueue(repo)
+    for merge_queue in (team_a, team_b):
+        merge_queue.ask_pr(14)
+        merge_queue.bless_pr(14)
+    repo.calls.clear()
+
+    service = SnapshotService()
+    with service.sweep():
+        list(team_a.check(gh_repo=service.repo(repo)))
+        assert pr_14.asked_to_be_merged
+        pr_14.merged = True
+        transitions = list(team_b.check(gh_repo=service.repo(repo)))
+    # The second room saw the merge instead of a stale open PR.
+    assert repo.calls['get_pull', 14] == 2
+    assert team_b.queue == []
+    assert transitions[0][0].nb == 14
+
+
+def test_commands_during_check_skip_snapshots():
+    pr_14 = FakeGHPullRequest(14, reviews=[])
+    repo = CountingGHRepo([pr_14, FakeGHPullRequest(15, reviews=[])])
+    merge_queue = MergeQueue(repo)
+    merge_queue.ask_pr(14)
+    pr_14.reviews.append(FakeGHReview('dugenou'))
+
+    service = SnapshotService()
+    with service.sweep():
+        check = merge_queue.check(gh_repo=service.repo(repo))
+        pr, _ = next(check)  # the check is paused on its first transition
+        assert pr.nb == 14
+        service.repo(repo).get_pull(15)  # in the snapshot of the sweep now
+        repo.calls.clear()
+        # A command meanwhile reads GitHub, not the snapshot of the check.
+        assert merge_queue.fetch_pr(15).nb == 15 and repo.calls['get_pull', 15] == 1
+        list(check)
@@ -0,0 +1,109 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from contextlib import contextmanager
+from threading import Thread
+from types import SimpleNamespace
+import copy
+import sqlite3
+
+import pytest
+
+from pr import PR
+from state_store import BotStorageStateStore, SQLiteStateStore, new_room, room_repos
+from test_mergequeue import FakeGHPullRequest
+
+
+class FakePluginStorage(dict):
+    """
+    Like the errbot storage, what is read is a copy.
+    """
+    def __getitem__(self, key):
+        return copy.deepcopy(super().__getitem__(key))
+
+    @contextmanager
+    def mutable(self, key):
+        value = self[key]
+        yield value
+        self[key] = value
+
+
+def prs(*nbs):
+    return [PR(FakeGHPullRequest(nb)) for nb in nbs]
+
+
+def test_sqlite_round_trip(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / 'state.sqlite'))
+    room = new_room('argoai/av', 'gbin', prs(14, 15), ['@gbin'], [14])
+    room_repos(room)['argoai/maps'] = SimpleNamespace(name='argoai/maps', queue=prs(3), pulled_prs=[])
+    store.put_room('#av', room)
+    store.put_room('#other', new_room('argoai/other', 'rkeelan'))
+
+    assert store.rooms() == ['#av', '#other']
+    assert '#av' in store and '#nope' not in store
+    loaded = store.get_room('#av')
+    assert loaded.name == 'argoai/av' and loaded.owner == 'gbin'
+    assert [pr.nb for pr in loaded.queue] == [14, 15] and loaded.pulled_prs == [14]
+    assert [pr.nb for pr in loaded.repos['argoai/maps'].queue] == [3]
+    assert loaded.repos['argoai/av'].queue is loaded.queue
+
+    # Per room updates leave the other rooms alone.
+    store.save_queues('#av', {'argoai/av': (prs(16, 14), [])})
+    loaded = store.get_room('#av')
+    assert [pr.nb for pr in loaded.queue] == [16, 14] and loaded.pulled_prs == []
+    assert [pr.nb for pr in loaded.repos['argoai/maps'].queue] == [3]
+    store.set_saints('#av', ['@gbin', '@rkeelan'])
+    assert store.saints('#av') == ['@gbin', '@rkeelan']
+    store.set_auto_label('#av', 'argoai/maps', 'merge-queue')
+    assert store.auto_labels('#av') == {'argoai/maps': 'merge-queue'}
+    assert store.auto_labels('#other') == {}
+
+    store.delete_room('#av')
+    assert store.auto_labels('#av') == {}
+    assert store.rooms() == ['#other']
+    thread_readers = []
+    thread = Thread(target=lambda: thread_readers.append(store.reader))
+    thread.start()
+    thread.join()
+    readers = list(store.readers)
+    assert len(readers) == 1 and readers[0] is not thread_readers[0]  # closed with its thread
+    store.close()
+    for db in readers + thread_readers:
+        with pytest.raises(sqlite3.ProgrammingError):
+            db.execute('SELECT 1')
+
+
+def test_sqlite_room_without_repository(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / 'state.sqlite'))
+    store.put_room('#av', new_room('argoai/av', 'gbin'))
+    with store.transaction() as db:
+        db.execute('DELETE FROM repos WHERE room = ?', ('#av',))
+    assert store.get_room('#av') is None
+    assert '#av' not in store and store.rooms() == []
+
+
+def test_migration(tmp_path):
+    plugin = FakePluginStorage()
+    legacy = SimpleNamespace(name='argoai/av', owner='gbin', queue=prs(14), saints=['@gbin'], pulled_prs=[14])
+    plugin['rooms'] = {'#av': legacy}
+    source = BotStorageStateStore(plugin)
+    source.set_auto_label('#av', 'argoai/av', 'merge-queue')
+
+    store = SQLiteStateStore(str(tmp_path / 'state.sqlite'))
+    assert store.migrate_from(source) == 1
+    assert store.migrate_from(source) == 0  # only once
+    loaded = store.get_room('#av')
+    assert [pr.nb for pr in loaded.queue] == [14] and loaded.pulled_prs == [14]
+    assert store.saints('#av') == ['@gbin']
+    assert store.auto_labels('#av') == {'argoai/av': 'merge-queue'}
@@ -0,0 +1,140 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from threading import Thread
+import json
+
+import pytest
+
+import tracing
+from dispatcher import MessageDispatcher
+from mergequeue import MergeQueue
+from test_mergequeue import FakeGHRepo, FakeGHPullRequest, FakeGHReview, APPROVED, CLEAN
+from tracing import JsonLinesExporter, MemoryExporter, OtlpJsonExporter, exporter_from_config, span, tracer
+
+
+@pytest.fixture
+def spans():
+    exporter = MemoryExporter()
+    tracing.configure(exporter)
+    yield exporter.spans
+    tracing.configure(None)
+
+
+def by_name(spans):
+    return {span.name: span for span in spans}
+
+
+def test_nested_spans(spans):
+    with span('poll') as poll:
+        with span('check', repo='argoai/av'):
+            tracing.current().set(prs=2)
+        with pytest.raises(KeyError):
+            with span('notify'):
+                raise KeyError('room')
+    named = by_name(spans)
+    assert [span.name for span in spans] == ['check', 'notify', 'poll']
+    assert named['check'].parent_id == poll.span_id and named['check'].trace_id == poll.trace_id
+    assert named['check'].attributes == {'repo': 'argoai/av', 'prs': 2}
+    assert named['notify'].error == "KeyError: 'room'"
+    assert poll.parent_id is None and poll.end >= named['check'].end
+
+
+def test_no_exporter():
+    with span('poll') as poll:
+        poll.set(queues=1)
+        assert tracing.current() is tracing.NULL_SPAN
+    assert exporter_from_config(None) is None
+    with pytest.raises(ValueError):
+        exporter_from_config('zipkin:localhost')
+
+
+def run_attached(parent):
+    with tracer.attach(parent), span('check'):
+        pass
+    assert tracing.current() is tracing.NULL_SPAN
+
+
+def test_attach_from_another_thread(spans):
+    with span('poll') as poll:
+        thread = Thread(target=run_attached, args=(poll,))
+        thread.start()
+        thread.join()
+    assert by_name(spans)['check'].parent_id == poll.span_id
+
+
+def test_check_spans(spans):
+    pr = FakeGHPullRequest(14, reviews=[FakeGHReview('user1', APPROVED)], mergeable=True, mergeable_state=CLEAN)
+    mq = MergeQueue(FakeGHRepo(injected_prs=[pr]))
+    mq.ask_pr(14)
+    mq.bless_pr(14)
+    spans.clear()
+    with span('check'):
+        list(mq.check())
+    named = by_name(spans)
+    assert named['check_pr'].parent_id == named['check'].span_id
+    assert named['check_pr'].attributes['pr'] == 14
+    assert named['get_pr'].parent_id == named['check_pr'].span_id
+    assert named['merge'].parent_id == named['check_pr'].span_id
+
+
+def test_message_spans(spans):
+    sent = []
+    dispatcher = MessageDispatcher(lambda to, text: sent.append(text), workers=1)
+    dispatcher.start()
+    with span('notify') as notify:
+        dispatcher.enqueue('room', 'merged')
+    dispatcher.stop()
+    assert sent == ['merged']
+    send = by_name(spans)['send']
+    assert send.parent_id == notify.span_id and send.attributes == {'to': 'room', 'sent': True}
+
+
+def test_json_lines(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    exporter = exporter_from_config(f'jsonl:{path}')
+    assert isinstance(exporter, JsonLinesExporter)
+    tracing.configure(exporter)
+    try:
+        with span('poll'), span('check', repo='argoai/av'):
+            pass
+    finally:
+        tracing.configure(None)
+    check, poll = [json.loads(line) for line in path.read_text().splitlines()]
+    assert check['parent_id'] == poll['span_id'] and check['attributes'] == {'repo': 'argoai/av'}
+    assert check['duration'] >= 0 and poll['parent_id'] is None
+
+
+def test_otlp_file(tmp_path):
+    path = tmp_path / 'traces.json'
+    exporter = exporter_from_config(f'otlp:{path}')
+    assert isinstance(exporter, OtlpJsonExporter)
+    tracing.configure(exporter)
+    try:
+        with span('poll', queues=2):
+            with span('check', repo='argoai/av', dry_run=False):
+                pass
+            assert not path.exists()  # the trace is exported as a whole
+    finally:
+        tracing.configure(None)
+    request, = [json.loads(line) for line in path.read_text().splitlines()]
+    resource_spans, = request['resourceSpans']
+    assert resource_spans['resource']['attributes'][0]['value'] == {'stringValue': 'err-mergequeue'}
+    check, poll = resource_spans['scopeSpans'][0]['spans']
+    assert check['parentSpanId'] == poll['spanId'] and 'parentSpanId' not in poll
+    assert check['traceId'] == poll['traceId'] and len(poll['traceId']) == 32 and len(poll['spanId']) == 16
+    assert check['attributes'] == [{'key': 'repo', 'value': {'stringValue': 'argoai/av'}},
+                                   {'key': 'dry_run', 'value': {'boolValue': False}}]
+    assert poll['attributes'] == [{'key': 'queues', 'value': {'intValue': '2'}}]
+    assert int(poll['endTimeUnixNano']) >= int(poll['startTimeUnixNano']) and poll['status'] == {'code': 1}
@@ -0,0 +1,283 @@
+#    Copyright 2018 Argo AI, LLC.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Nested spans over a check cycle: poll -> check of a queue -> check of a PR ->
+fetches, merges and pulls -> GitHub requests, and the chat messages sent
+from them. Spans are only built when an exporter is configured, otherwise
+they cost a function call.
+
+Exporters write every finished span as a JSON line, or every finished trace
+as an OTLP/JSON export request, to a file (the OpenTelemetry collector reads
+those with its otlpjsonfile receiver) or to an OTLP/HTTP endpoint.
+"""
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+from typing import Any, Dict, Iterator, List, Optional
+import json
+import logging
+import os
+import time
+
+import requests
+
+log = logging.getLogger(__name__)
+
+SERVICE_NAME = 'err-mergequeue'
+# Spans kept by the OTLP exporter before exporting them even if their trace is not over.
+MAX_PENDING_SPANS = 2000
+OTLP_TIMEOUT = 5
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, name: str, parent: Optional['Span'], attributes: Dict[str, Any]):
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict:
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'start': self.start / 1e9, 'duration': (self.end - self.start) / 1e9,
+                'attributes': self.attributes, 'error': self.error}
+
+
+class NullSpan:
+    """
+    What the code gets when tracing is off.
+    """
+
+    def set(self, **attributes: Any):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Exporter:
+    def export(self, span: Span):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class MemoryExporter(Exporter):
+    """
+    Keeps the spans, for tests.
+    """
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+
+class JsonLinesExporter(Exporter):
+    """
+    One JSON line per span, appended to a file.
+    """
+
+    def __init__(self, path: str):
+        self.lock = Lock()
+        self.file = open(path, 'a')
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(span: Span) -> Dict:
+    otlp = {'traceId': span.trace_id, 'spanId': span.span_id, 'name': span.name, 'kind': 1,
+            'startTimeUnixNano': str(span.start), 'endTimeUnixNano': str(span.end),
+            'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}}
+    if span.parent_id:
+        otlp['parentSpanId'] = span.parent_id
+    return otlp
+
+
+def otlp_request(spans: List[Span]) -> Dict:
+    """
+    OTLP/JSON ExportTraceServiceRequest of some spans.
+    """
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+        'scopeSpans': [{'scope': {'name': __name__}, 'spans': [otlp_span(span) for span in spans]}]}]}
+
+
+class OtlpJsonExporter(Exporter):
+    """
+    The spans of a trace are exported together when its root span ends: POSTed
+    to an OTLP/HTTP endpoint (http://collector:4318/v1/traces) or appended
+    as a line to a file.
+    """
+
+    def __init__(self, target: str):
+        self.target = target
+        self.lock = Lock()
+        self.pending: List[Span] = []
+
+    def export(self, span: Span):
+        with self.lock:
+            self.pending.append(span)
+            if span.parent_id is not None and len(self.pending) < MAX_PENDING_SPANS:
+                return
+            spans, self.pending = self.pending, []
+        self.write(otlp_request(spans))
+
+    def write(self, request: Dict):
+        try:
+            if self.target.startswith(('http://', 'https://')):
+                requests.post(self.target, json=request, timeout=OTLP_TIMEOUT).raise_for_status()
+            else:
+                with self.lock, open(self.target, 'a') as otlp_file:
+                    otlp_file.write(json.dumps(request) + '\n')
+        except Exception:
+            log.exception('Could not export spans to %s.', self.target)
+
+    def close(self):
+        with self.lock:
+            spans, self.pending = self.pending, []
+        if spans:
+            self.write(otlp_request(spans))
+
+
+def exporter_from_config(value: Optional[str]) -> Optional[Exporter]:
+    """
+    `jsonl:<path>` or `otlp:<path or url>`, None to not trace.
+    """
+    if not value:
+        return None
+    kind, _, target = value.partition(':')
+    if kind == 'jsonl':
+        return JsonLinesExporter(target)
+    if kind == 'otlp':
+        return OtlpJsonExporter(target)
+    raise ValueError(f'Unknown trace exporter {value}, use jsonl:<path> or otlp:<path or url>')
+
+
+class Tracer:
+    def __init__(self, exporter: Exporter = None):
+        self.exporter = exporter
+        self.local = local()
+
+    def stack(self) -> List[Span]:
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def current(self):
+        """
+        The innermost span of this thread.
+        """
+        if self.exporter is None:
+            return NULL_SPAN
+        stack = self.stack()
+        return stack[-1] if stack else NULL_SPAN
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator:
+        exporter = self.exporter
+        if exporter is None:
+            yield NULL_SPAN
+            return
+        stack = self.stack()
+        span = Span(name, stack[-1] if stack else None, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            stack.pop()
+            span.end = time.time_ns()
+            exporter.export(span)
+
+    @contextmanager
+    def attach(self, parent) -> Iterator:
+        """
+        Make the spans started in this thread children of a span from another
+        thread.
+        """
+        if not isinstance(parent, Span):
+            yield
+            return
+        stack = self.stack()
+        stack.append(parent)
+        try:
+            yield
+        finally:
+            stack.remove(parent)
+
+
+tracer = Tracer()
+
+
+def configure(exporter: Optional[Exporter]):
+    previous, tracer.exporter = tracer.exporter, exporter
+    if previous is not None:
+        previous.close()
+
+
+def span(name: str, **attributes: Any):
+    return tracer.span(name, **attributes)
+
+
+def current():
+    return tracer.current()
+
+
+def traced(name: str = None):
+    """
+    Run the decorated function in a span.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer.exporter is None:  # not worth a context manager
+                return function(*args, **kwargs)
+            with tracer.span(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator